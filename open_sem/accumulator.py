@@ -0,0 +1,378 @@
+import os
+from amaranth import *
+from amaranth.sim import Settle, Passive
+from simulation import Simulator
+
+from commands import RegisterPort, CommitHandshake
+
+# Averages samples on the FPGA, so that only the averaged result crosses the
+# uplink. Samples arrive in the pixel domain in groups (a PixelScan bin, or a
+# PathScan point), tagged with their column, line and frame. Each sample counts
+# once, in the cycle it arrives (i_valid): a group sums the conversions made
+# during it, none if the pixel clock outruns the ADC, rather than the latest
+# conversion once per pixel.
+#
+#   ACC_MODE_OFF   : the latest sample at the end of each group is passed on
+#   ACC_MODE_PIXEL : the samples of each group are summed
+#   ACC_MODE_LINE  : group sums of 2^k consecutive lines are summed, column by
+#                    column, in a line buffer. Lines are tagged line >> k.
+#   ACC_MODE_FRAME : group sums of 2^k consecutive frames are summed, by
+#                    column and line, in a frame buffer
+#
+# Results are sums, not averages: they keep all the bits grown (saturating at
+# output_bits), and each comes with the count of samples summed (saturating at
+# count_bits), for the host to divide by. In ACC_MODE_OFF the count is 1.
+# Line and frame buffers are
+# block RAM addressed by column (and line), so only columns < 2^column_bits and
+# lines < 2^line_bits are averaged, others are dropped: use a region of
+# interest or stride to fit the frame. A last partial set of lines is dropped.
+#
+# The mode is written through the register port, and taken up at the next
+# frame end, so each frame is averaged throughout in one mode. It crosses to
+# the pixel domain by a CommitHandshake: a write whilst the last is still
+# pending is dropped, setting overrun (status bit 1, cleared by reading the
+# status). The mode in use is reset-less, so it is kept across a change of
+# pixel clock.
+ACC_MODE_OFF   = 0
+ACC_MODE_PIXEL = 1
+ACC_MODE_LINE  = 2
+ACC_MODE_FRAME = 3
+
+# Register port addresses
+ACC_ADDR_CONTROL = 0 # mode[1:0], k[5:2]
+ACC_ADDR_STATUS  = 1 # pending[0], overrun[1]
+
+def acc_control(mode, k_log2=0):
+    return mode | (k_log2 << 2)
+
+class Accumulator(Elaboratable):
+    def __init__(self, sample_bits=12, output_bits=16, max_k_log2=4, column_bits=8, line_bits=8, count_bits=12):
+        self.output_bits = output_bits
+        self.count_bits = count_bits
+        self.max_k_log2 = max_k_log2
+        self.column_bits = column_bits
+        self.line_bits = line_bits
+
+        ############ IN: configuration (sync domain)
+        self.port = RegisterPort("accumulator")
+
+        ############ IN: samples (pixel domain)
+        # i_sample holds the latest sample, i_valid pulses as a new one arrives
+        self.i_sample = Signal(sample_bits)
+        self.i_valid = Signal()
+        # High in the last cycle of each group, with or without a new sample
+        self.i_last = Signal()
+        self.i_column = Signal(16)
+        self.i_line = Signal(16)
+        self.i_frame = Signal(16)
+        # Pulse (one cycle) at the end of each frame
+        self.i_frame_end = Signal()
+
+        ############ OUT: results (pixel domain)
+        self.o_sample = Signal(output_bits)
+        self.o_count = Signal(count_bits)
+        self.o_valid = Signal()
+        self.o_column = Signal(16)
+        self.o_line = Signal(16)
+        self.o_frame = Signal(16)
+        # Pulses with or after the results of each frame's last group
+        self.o_frame_end = Signal()
+
+        ############ OUT: mode in use
+        self.mode = Signal(2, reset_less=True)
+        self.k_log2 = Signal(range(max_k_log2 + 1), reset_less=True)
+
+    def elaborate(self, platform):
+        m = Module()
+        port = self.port
+        max_value = (1 << self.output_bits) - 1
+
+        def saturate(x):
+            return Mux(x[self.output_bits:].any(), max_value, x[:self.output_bits])
+
+        max_count = (1 << self.count_bits) - 1
+
+        def saturate_count(x):
+            return Mux(x[self.count_bits:].any(), max_count, x[:self.count_bits])
+
+        ############################################################
+        # Sync domain: control register
+
+        m.submodules.control_cdc = control_cdc = CommitHandshake(o_domain="pixel")
+
+        control = Signal(6)
+        pending = control_cdc.pending
+        overrun = Signal()
+        status_read = Signal()
+        m.d.sync += port.ack.eq(port.stb & ~port.ack)
+        m.d.comb += port.rdata.eq(Mux(port.addr == ACC_ADDR_STATUS, Cat(pending, overrun), control))
+        # The status is read as it is acked, then overrun clears
+        m.d.sync += status_read.eq(port.stb & ~port.ack & ~port.we & (port.addr == ACC_ADDR_STATUS))
+        with m.If(status_read):
+            m.d.sync += overrun.eq(0)
+        with m.If(port.stb & ~port.ack & port.we & (port.addr == ACC_ADDR_CONTROL)):
+            with m.If(pending):
+                m.d.sync += overrun.eq(1)
+            with m.Else():
+                m.d.sync += control.eq(port.wdata)
+                m.d.comb += control_cdc.commit.eq(1)
+
+        ############################################################
+        # Pixel domain: take up the mode at frame ends
+
+        # Frames since the mode was taken up, for passes of frame mode. control
+        # is held steady whilst pending, so is safe to take across.
+        frame_pass = Signal(self.max_k_log2)
+        k_log2 = Mux(control[2:] > self.max_k_log2, self.max_k_log2, control[2:])
+        with m.If(self.i_frame_end):
+            m.d.pixel += frame_pass.eq(frame_pass + 1)
+            with m.If(control_cdc.o_pending):
+                m.d.comb += control_cdc.o_take.eq(1)
+                m.d.pixel += [
+                    self.mode.eq(control[:2]),
+                    self.k_log2.eq(k_log2),
+                ]
+                with m.If((self.mode != control[:2]) | (self.k_log2 != k_log2)):
+                    m.d.pixel += frame_pass.eq(0)
+
+        mode_pixel = self.mode != ACC_MODE_OFF
+        line_mode = self.mode == ACC_MODE_LINE
+        frame_mode = self.mode == ACC_MODE_FRAME
+
+        ############################################################
+        # Stage 1: sum each group
+
+        group_sum = Signal(self.output_bits)
+        group_count = Signal(self.count_bits)
+        group_first = Signal(reset=1)
+        total = saturate(Mux(group_first | ~mode_pixel, 0, group_sum) + self.i_sample)
+        total_count = saturate_count(Mux(group_first | ~mode_pixel, 0, group_count) + 1)
+
+        g = Signal(self.output_bits)
+        g_count = Signal(self.count_bits)
+        g_valid = Signal()
+        g_column = Signal(16)
+        g_line = Signal(16)
+        g_frame = Signal(16)
+        g_pass = Signal(self.max_k_log2)
+        g_frame_end = Signal()
+
+        m.d.pixel += [
+            g_valid.eq(0),
+            g_frame_end.eq(self.i_frame_end),
+        ]
+        with m.If(self.i_last):
+            m.d.pixel += [
+                g.eq(Mux(self.i_valid | ~mode_pixel, total, Mux(group_first, 0, group_sum))),
+                g_count.eq(Mux(self.i_valid | ~mode_pixel, total_count, Mux(group_first, 0, group_count))),
+                g_valid.eq(1),
+                g_column.eq(self.i_column),
+                g_line.eq(self.i_line),
+                g_frame.eq(self.i_frame),
+                g_pass.eq(Mux(frame_mode, frame_pass, self.i_line)),
+                group_first.eq(1),
+            ]
+        with m.Elif(self.i_valid):
+            m.d.pixel += [
+                group_sum.eq(total),
+                group_count.eq(total_count),
+                group_first.eq(0),
+            ]
+
+        ############################################################
+        # Stage 2: read the line / frame buffer
+
+        # Entries are Cat(sum, count)
+        mem = Memory(width=self.output_bits + self.count_bits, depth=1 << (self.column_bits + self.line_bits))
+        m.submodules.mem_r = mem_r = mem.read_port(domain="pixel", transparent=False)
+        m.submodules.mem_w = mem_w = mem.write_port(domain="pixel")
+
+        k_mask = ((C(1, self.max_k_log2 + 1) << self.k_log2) - 1)[:self.max_k_log2]
+        buffered = line_mode | frame_mode
+        in_window = (g_column < (1 << self.column_bits)) & (~frame_mode | (g_line < (1 << self.line_bits)))
+        group_pass = g_pass & k_mask
+
+        s = Signal(self.output_bits)
+        s_count = Signal(self.count_bits)
+        s_valid = Signal()
+        s_first = Signal()
+        s_last = Signal()
+        s_addr = Signal(len(mem_r.addr))
+        s_column = Signal(16)
+        s_line = Signal(16)
+        s_frame = Signal(16)
+        s_frame_end = Signal()
+
+        addr = Cat(g_column[:self.column_bits], Mux(frame_mode, g_line[:self.line_bits], 0))
+        m.d.comb += mem_r.addr.eq(addr)
+        m.d.pixel += [
+            s.eq(g),
+            s_count.eq(g_count),
+            s_valid.eq(g_valid & (~buffered | in_window)),
+            s_first.eq(~buffered | (group_pass == 0)),
+            s_last.eq(~buffered | (group_pass == k_mask)),
+            s_addr.eq(addr),
+            s_column.eq(g_column),
+            s_line.eq(Mux(line_mode, g_line >> self.k_log2, g_line)),
+            s_frame.eq(g_frame),
+            s_frame_end.eq(g_frame_end),
+        ]
+
+        ############################################################
+        # Stage 3: add and write back, or emit on the last pass
+
+        # The read of a buffer entry written the cycle before is stale
+        last_write = Signal()
+        last_addr = Signal(len(mem_w.addr))
+        last_data = Signal(len(mem_w.data))
+        previous = Mux(s_first, 0, Mux(last_write & (last_addr == s_addr), last_data, mem_r.data))
+        result = saturate(previous[:self.output_bits] + s)
+        result_count = saturate_count(previous[self.output_bits:] + s_count)
+
+        write = s_valid & ~s_last
+        m.d.comb += [
+            mem_w.addr.eq(s_addr),
+            mem_w.data.eq(Cat(result, result_count)),
+            mem_w.en.eq(write),
+        ]
+        m.d.pixel += [
+            last_write.eq(write),
+            last_addr.eq(s_addr),
+            last_data.eq(Cat(result, result_count)),
+            self.o_valid.eq(s_valid & s_last),
+            self.o_frame_end.eq(s_frame_end),
+        ]
+        with m.If(s_valid & s_last):
+            m.d.pixel += [
+                self.o_sample.eq(result),
+                self.o_count.eq(result_count),
+                self.o_column.eq(s_column),
+                self.o_line.eq(s_line),
+                self.o_frame.eq(s_frame),
+            ]
+
+        return m
+
+# Reference for the results of frames (lists of lines, of samples) scanned with
+# groups of 2^bin pixels along lines, the mode taken up from the first frame.
+# Pixels without a new sample are None; held is the sample before the frames.
+# Returns (sample, count, column, line, frame) of each result.
+def accumulate_reference(frames, mode, k_log2=0, bin=0, output_bits=16, column_bits=8, line_bits=8, held=0, count_bits=12):
+    saturate = lambda x: min(x, (1 << output_bits) - 1)
+    saturate_count = lambda x: min(x, (1 << count_bits) - 1)
+    K = 1 << k_log2
+    buffer = {}
+    results = []
+    for f, frame in enumerate(frames):
+        for l, line in enumerate(frame):
+            for c in range(-(-len(line) >> bin)):
+                group = [ s for s in line[c << bin:(c + 1) << bin] if s is not None ]
+                held = group[-1] if group else held
+                g = held if mode == ACC_MODE_OFF else saturate(sum(group))
+                n = 1 if mode == ACC_MODE_OFF else saturate_count(len(group))
+                if mode in (ACC_MODE_OFF, ACC_MODE_PIXEL):
+                    results.append((g, n, c, l, f))
+                    continue
+                if c >= 1 << column_bits or (mode == ACC_MODE_FRAME and l >= 1 << line_bits):
+                    continue
+                key, p = (c, l & (K - 1)) if mode == ACC_MODE_LINE else ((c, l), f & (K - 1))
+                total, count = buffer[key] if p else (0, 0)
+                total, count = saturate(g + total), saturate_count(n + count)
+                if p == K - 1:
+                    results.append((total, count, c, l >> k_log2 if mode == ACC_MODE_LINE else l, f))
+                else:
+                    buffer[key] = (total, count)
+    return results
+
+def sim_accumulator_1():
+    import numpy as np
+    rng = np.random.default_rng(3)
+    width, height, bin = 12, 6, 1
+    sample_bits, output_bits, column_bits, line_bits, count_bits = 8, 10, 3, 2, 3
+
+    for mode, k_log2 in [ (ACC_MODE_OFF, 0), (ACC_MODE_PIXEL, 0), (ACC_MODE_LINE, 1), (ACC_MODE_FRAME, 2), (ACC_MODE_LINE, 0) ]:
+        dut = Accumulator(sample_bits, output_bits, max_k_log2=3, column_bits=column_bits, line_bits=line_bits, count_bits=count_bits)
+        frames = rng.integers(0, 1 << sample_bits, (1 + 2 * (1 << k_log2), height, width)).tolist()
+        # Some pixels without a new sample, as with the pixel clock near the
+        # ADC's sample rate
+        frames = [ [ [ None if rng.random() < 0.3 else s for s in line ] for line in frame ] for frame in frames ]
+        results = []
+        statuses = []
+
+        sim = Simulator(dut)
+        sim.add_clock(1.0 / 100e6, domain="sync")
+        sim.add_clock(1.0 / 37e6, domain="pixel")
+
+        def access(addr, data=None):
+            port = dut.port
+            yield port.addr.eq(addr)
+            yield port.wdata.eq(data or 0)
+            yield port.we.eq(data is not None)
+            yield port.stb.eq(1)
+            yield
+            yield Settle()
+            while not (yield port.ack):
+                yield
+                yield Settle()
+            value = yield port.rdata
+            yield port.stb.eq(0)
+            yield
+            return value
+
+        # A second write whilst the first is pending (until the end of frame
+        # 0) is dropped
+        def host_proc():
+            yield from access(ACC_ADDR_CONTROL, acc_control(mode, k_log2))
+            yield from access(ACC_ADDR_CONTROL, acc_control(ACC_MODE_PIXEL, 3))
+            statuses.append((yield from access(ACC_ADDR_STATUS)))
+            statuses.append((yield from access(ACC_ADDR_STATUS)))
+
+        # As PixelScan: one sample per cycle, a blank cycle between lines and
+        # frame end pulses. The mode is taken up at the end of frame 0.
+        def pixel_proc():
+            for _ in range(20):
+                yield
+            for f, frame in enumerate(frames):
+                for l, line in enumerate(frame):
+                    for x, sample in enumerate(line):
+                        if sample is not None:
+                            yield dut.i_sample.eq(sample)
+                        yield dut.i_valid.eq(sample is not None)
+                        yield dut.i_last.eq(((x + 1) % (1 << bin) == 0) or x == width - 1)
+                        yield dut.i_column.eq(x >> bin)
+                        yield dut.i_line.eq(l)
+                        yield dut.i_frame.eq(f)
+                        yield
+                    yield dut.i_valid.eq(0)
+                    yield dut.i_last.eq(0)
+                    yield dut.i_frame_end.eq(l == height - 1)
+                    yield
+                    yield dut.i_frame_end.eq(0)
+            for _ in range(10):
+                yield
+
+        def monitor_proc():
+            yield Passive()
+            while True:
+                yield Settle()
+                if (yield dut.o_valid):
+                    results.append(((yield dut.o_sample), (yield dut.o_count), (yield dut.o_column), (yield dut.o_line), (yield dut.o_frame)))
+                yield
+
+        sim.add_sync_process(host_proc, domain="sync")
+        sim.add_sync_process(pixel_proc, domain="pixel")
+        sim.add_sync_process(monitor_proc, domain="pixel")
+        os.makedirs("sim", exist_ok=True)
+        with sim.write_vcd("sim/accumulator_1.vcd"):
+            sim.run()
+
+        expected = accumulate_reference(frames[:1], ACC_MODE_OFF, bin=bin)
+        held = ([ s for line in frames[0] for s in line if s is not None ] or [ 0 ])[-1]
+        later = accumulate_reference(frames[1:], mode, k_log2, bin, output_bits, column_bits, line_bits, held, count_bits)
+        expected += [ (s, n, c, l, f + 1) for s, n, c, l, f in later ]
+        assert results == expected, (mode, k_log2, results[:8], expected[:8])
+        assert statuses == [ 0b11, 0b01 ], statuses
+    print("accumulator: pixel, line and frame averaging with counts ok")
+
+if __name__ == "__main__":
+    sim_accumulator_1()
@@ -1,43 +1,263 @@
+import os
 from amaranth import *
+from amaranth.sim import Settle, Passive
+from simulation import Simulator
+
+from fixed_point import SignalFixedPoint
+from dsp import PipelinedMultiply, register, delay
 
 # Define derived samples from backscatter quadrant measurements
 # We will be able to stream these derived samples alongside the raw
+#
+#   sum    = xy_00 + xy_10 + xy_01 + xy_11
+#   x_diff = half + (xy_00 + xy_01) - (xy_10 + xy_11)
+#   y_diff = half + (xy_00 + xy_10) - (xy_01 + xy_11)
+#   cross  = half + (xy_00 + xy_11) - (xy_10 + xy_01)
+#
+# with half = 2^(quadrant_bits + 1), so that differences are unsigned and the
+# same width as sum.
+#
+# Quadrants arrive as separate sample streams, each with a valid strobe (as
+# from the XADC sequencer). Once all four have a new sample they enter the
+# pipeline, which registers each adder stage, and results come out `latency`
+# cycles later with o_valid.
+#
+# With contrast=True, differences are also normalized by the sum, giving
+# topographic (x, y) and compositional (cross) contrast at the full rate:
+#
+#   x_contrast = half_c + half_c * (x_diff - half) / sum    (half_c = 2^(contrast_bits-1))
+#
+# rounded and saturated to contrast_bits, and half_c where sum is 0. Rather than divide,
+# sum and differences are shifted left until the sum's MSB is set (a constant
+# shift for each count of leading zeros), the bits below the normalized sum's
+# MSB index a reciprocal ROM, and differences are multiplied by the reciprocal
+# in DSPs. With the default 2^11 entry ROM (one block RAM), contrast is within
+# 1 LSB of the exact ratio.
 class Backscatter(Elaboratable):
-    def __init__(self, quadrant_bits):
-        assert(len(quadrant_bits) == 4)
+    def __init__(self, quadrant_bits, contrast=False, contrast_bits=12, lut_bits=11):
+        assert(quadrant_bits > 0)
+        self.quadrant_bits = quadrant_bits
+        self.contrast = contrast
+        self.contrast_bits = contrast_bits
+        self.sum_bits = quadrant_bits + 2
+        self.lut_bits = min(lut_bits, self.sum_bits - 1)
+        self.recip_bits = contrast_bits + 4
+        self.latency = 7 if contrast else 2
 
         # in: ADC Samples from backscatter quadrants
         self.xy_00 = Signal(quadrant_bits)
         self.xy_10 = Signal(quadrant_bits)
         self.xy_01 = Signal(quadrant_bits)
         self.xy_11 = Signal(quadrant_bits)
+        # in: valid strobes, one per quadrant as ordered below
+        self.quadrants = [ self.xy_00, self.xy_10, self.xy_01, self.xy_11 ]
+        self.valid = Signal(4)
 
         # out: Derived signals
-        self.sum    = Signal.like(self.xy_00+self.xy_10+self.xy_01+self.xy_11)
+        self.sum    = Signal(self.sum_bits)
         self.x_diff = Signal.like(self.sum)
         self.y_diff = Signal.like(self.sum)
         self.cross  = Signal.like(self.sum)
 
+        # out: Contrast (with contrast=True)
+        self.x_contrast     = Signal(contrast_bits)
+        self.y_contrast     = Signal(contrast_bits)
+        self.cross_contrast = Signal(contrast_bits)
+
+        self.o_valid = Signal()
+
+    # Reciprocal ROM: 2^recip_bits / m, for m in [1, 2) at the centre of each entry
+    def reciprocal_table(self):
+        L = self.lut_bits
+        return [ round(2**self.recip_bits / (1 + (i + 0.5) / 2**L)) for i in range(2**L) ]
+
     def elaborate(self, platform):
         m = Module()
+        S = self.sum_bits
+        half = 2**(S-1)
+
+        ############################################################
+        # Join the quadrant streams, taking samples arriving this cycle
+
+        held = [ Signal.like(q, name="held{}".format(i)) for i, q in enumerate(self.quadrants) ]
+        fresh = Signal(4)
+        launch = (fresh | self.valid).all()
+        current = [ Mux(self.valid[i], q, held[i]) for i, q in enumerate(self.quadrants) ]
+        for i, q in enumerate(self.quadrants):
+            with m.If(self.valid[i]):
+                m.d.sync += held[i].eq(q)
+        m.d.sync += fresh.eq(Mux(launch, 0, fresh | self.valid))
+        xy_00, xy_10, xy_01, xy_11 = current
+
+        ############################################################
+        # Stage 1: pair sums
+
+        xx0 = register(m, xy_00 + xy_01, "xx0")
+        xx1 = register(m, xy_10 + xy_11, "xx1")
+        yy0 = register(m, xy_00 + xy_10, "yy0")
+        yy1 = register(m, xy_01 + xy_11, "yy1")
+        dd0 = register(m, xy_00 + xy_11, "dd0")
+        dd1 = register(m, xy_10 + xy_01, "dd1")
+        valid1 = Signal()
+        m.d.sync += valid1.eq(launch)
+
+        ############################################################
+        # Stage 2: sum and differences
+
+        total = register(m, (xx0 + xx1)[:S], "total")
+        diffs = [ register(m, a - b, name) for a, b, name in [ (xx0, xx1, "dx"), (yy0, yy1, "dy"), (dd0, dd1, "dc") ] ]
+        valid2 = Signal()
+        m.d.sync += valid2.eq(valid1)
+
+        outputs = [ total ] + [ (half + d)[:S] for d in diffs ]
+        latency = 2
+
+        if self.contrast:
+            ########################################################
+            # Stage 3: normalize, a constant shift per leading zero count
+
+            norm_sum = Signal(S)
+            norm_diffs = [ Signal(signed(S + 1), name="norm_" + n) for n in [ "dx", "dy", "dc" ] ]
+            zero3 = Signal()
+            valid3 = Signal()
+            m.d.sync += valid3.eq(valid2)
+            m.d.sync += zero3.eq(0)
+            for lz in range(S):
+                with (m.If if lz == 0 else m.Elif)(total[S-1-lz]):
+                    m.d.sync += norm_sum.eq(total << lz)
+                    m.d.sync += [ n.eq(d << lz) for n, d in zip(norm_diffs, diffs) ]
+            with m.Else():
+                m.d.sync += zero3.eq(1)
+
+            ########################################################
+            # Stage 4: reciprocal of the normalized sum
+
+            L = self.lut_bits
+            rom = Memory(width=self.recip_bits + 1, depth=2**L, init=self.reciprocal_table())
+            m.submodules.recip_rom = rom_r = rom.read_port(domain="sync", transparent=False)
+            m.d.comb += rom_r.addr.eq(norm_sum[S-1-L:S-1])
+            recip = SignalFixedPoint(value=Signal(signed(self.recip_bits + 2), name="recip"), frac_bits=0)
+            m.d.comb += recip.s.eq(rom_r.data)
+            norm_diffs = [ delay(m, d, 1, d.name) for d in norm_diffs ]
+            zero4 = delay(m, zero3, 1, "zero")
+            valid4 = delay(m, valid3, 1, "valid")
+
+            ########################################################
+            # Stages 5, 6: multiply by the reciprocal
+
+            multiply_latency = 2
+            products = []
+            for i, d in enumerate(norm_diffs):
+                a = SignalFixedPoint(value=d, frac_bits=0)
+                mul = PipelinedMultiply(a, recip, multiply_latency)
+                m.submodules["contrast_mul{}".format(i)] = mul
+                m.d.comb += [ mul.a.eq(a), mul.b.eq(recip) ]
+                products.append(mul.p.s)
+            zero6 = delay(m, zero4, multiply_latency, "zero_p")
+            valid6 = delay(m, valid4, multiply_latency, "valid_p")
+
+            ########################################################
+            # Stage 7: scale and saturate to contrast_bits
+
+            # product = (diff / sum) * 2^(S - 1 + recip_bits)
+            shift = S + self.recip_bits - self.contrast_bits
+            half_c = 2**(self.contrast_bits - 1)
+            max_c = 2**self.contrast_bits - 1
+            contrasts = [ self.x_contrast, self.y_contrast, self.cross_contrast ]
+            for c, p in zip(contrasts, products):
+                value = half_c + ((p + 2**(shift - 1)) >> shift)
+                with m.If(zero6):
+                    m.d.sync += c.eq(half_c)
+                with m.Elif(value < 0):
+                    m.d.sync += c.eq(0)
+                with m.Elif(value > max_c):
+                    m.d.sync += c.eq(max_c)
+                with m.Else():
+                    m.d.sync += c.eq(value)
+            m.d.sync += self.o_valid.eq(valid6)
+
+            outputs = [ delay(m, o, self.latency - latency, "out{}".format(i)) for i, o in enumerate(outputs) ]
+        else:
+            m.d.comb += self.o_valid.eq(valid2)
+
+        m.d.comb += [ o.eq(v) for o, v in zip([ self.sum, self.x_diff, self.y_diff, self.cross ], outputs) ]
+
+        return m
+
+# Bit exact reference for one set of quadrants (xy_00, xy_10, xy_01, xy_11):
+# returns (sum, x_diff, y_diff, cross, x_contrast, y_contrast, cross_contrast)
+def backscatter_reference(dut : Backscatter, xy_00, xy_10, xy_01, xy_11):
+    S = dut.sum_bits
+    total = xy_00 + xy_10 + xy_01 + xy_11
+    diffs = [ (xy_00 + xy_01) - (xy_10 + xy_11), (xy_00 + xy_10) - (xy_01 + xy_11), (xy_00 + xy_11) - (xy_10 + xy_01) ]
+    half_c = 2**(dut.contrast_bits - 1)
+    if total == 0:
+        contrasts = [ half_c ] * 3
+    else:
+        lz = S - total.bit_length()
+        index = ((total << lz) >> (S - 1 - dut.lut_bits)) & (2**dut.lut_bits - 1)
+        recip = dut.reciprocal_table()[index]
+        shift = S + dut.recip_bits - dut.contrast_bits
+        contrasts = [ min(max(half_c + (((d << lz) * recip + 2**(shift - 1)) >> shift), 0), 2**dut.contrast_bits - 1) for d in diffs ]
+    return tuple([ total ] + [ 2**(S-1) + d for d in diffs ] + contrasts)
+
+def sim_backscatter_1(vectors=200):
+    import random
+    random.seed(5)
+    q = 12
+    dut = Backscatter(q, contrast=True)
+    top = 2**q - 1
+    quads = [ [ random.randint(0, top) for _ in range(4) ] for _ in range(vectors) ]
+    quads += [ [ 0, 0, 0, 0 ], [ top, 0, 0, 0 ], [ 0, top, top, 0 ], [ 1, 0, 0, 0 ], [ top ] * 4 ]
+    results = []
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0 / 100e6, domain="sync")
+
+    # Quadrant samples arrive in turn (as from a sequencer), or all at once
+    def input_proc():
+        for n, values in enumerate(quads):
+            order = [ [ 0, 1, 2, 3 ] ] if n % 3 == 0 else [ [ i ] for i in random.sample(range(4), 4) ]
+            for group in order:
+                for i in group:
+                    yield dut.quadrants[i].eq(values[i])
+                yield dut.valid.eq(sum(1 << i for i in group))
+                yield
+                yield dut.valid.eq(0)
+                for _ in range(random.randint(0, 1)):
+                    yield
+        for _ in range(dut.latency + 2):
+            yield
+
+    def output_proc():
+        yield Passive()
+        while True:
+            yield Settle()
+            if (yield dut.o_valid):
+                result = []
+                for s in [ dut.sum, dut.x_diff, dut.y_diff, dut.cross, dut.x_contrast, dut.y_contrast, dut.cross_contrast ]:
+                    result.append((yield s))
+                results.append(tuple(result))
+            yield
+
+    sim.add_sync_process(input_proc, domain="sync")
+    sim.add_sync_process(output_proc, domain="sync")
+    os.makedirs("sim", exist_ok=True)
+    with sim.write_vcd("sim/backscatter_1.vcd"):
+        sim.run()
+
+    expected = [ backscatter_reference(dut, *v) for v in quads ]
+    mismatch = [ i for i, (r, e) in enumerate(zip(results, expected)) if r != e ]
+    assert len(results) == len(expected) and not mismatch, (len(results), len(expected), mismatch[:1] and (results[mismatch[0]], expected[mismatch[0]]))
+
+    # The reciprocal ROM keeps contrast within 1 LSB of the exact ratio
+    half_c = 2**(dut.contrast_bits - 1)
+    for v, r in zip(quads, results):
+        total = sum(v)
+        if total:
+            exact = half_c + half_c * ((v[0] + v[2]) - (v[1] + v[3])) / total
+            assert abs(r[4] - min(exact, 2 * half_c - 1)) <= 1.0, (v, r[4], exact)
+    print("backscatter: pipelined sums, differences and contrast ok (latency {})".format(dut.latency))
 
-        # sum terms
-        xx0 = Signal.like(self.xy_00+self.xy_10)
-        xx1 = Signal.like(xx0)
-        yy0 = Signal.like(xx0)
-        yy1 = Signal.like(xx0)
-
-        # horizontal and vertical sums
-        m.d.comb += xx0.eq(self.xy_00 + self.xy_01)
-        m.d.comb += xx1.eq(self.xy_10 + self.xy_11)
-        m.d.comb += yy0.eq(self.xy_00 + self.xy_10)
-        m.d.comb += yy1.eq(self.xy_01 + self.xy_11)
-
-        # Compute output signals
-        half_val = 2**(self.sum.shape().width-1)
-        m.d.comb += self.sum.eq(xx0 + xx1)
-        m.d.comb += self.x_diff.eq( half_val + xx0 - xx1 )
-        m.d.comb += self.y_diff.eq( half_val + yy0 - yy1 )
-        m.d.comb += self.cross.eq( half_val + self.xy_00 + self.xy_11 - self.xy_10 - self.xy_01 )
-
-        return m
\ No newline at end of file
+if __name__ == "__main__":
+    sim_backscatter_1()
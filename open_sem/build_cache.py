@@ -0,0 +1,237 @@
+import os
+import re
+import glob
+import json
+import shutil
+import hashlib
+
+import amaranth
+from amaranth.build.run import LocalBuildProducts
+
+# Content addressed cache for Vivado builds.
+#
+# A build is keyed by the hash of its build plan (the generated Verilog,
+# constraints and Tcl script): an unchanged design reuses the cached bitstream
+# and reports without running Vivado.
+#
+# Otherwise Vivado runs incrementally. Each module of the generated Verilog is
+# hashed (its text, less source locations, and the hashes of the modules it
+# instantiates), and the cached build sharing the most module hashes is the
+# reference: its synthesized and routed checkpoints are copied into the build
+# as reference_synth.dcp and reference_route.dcp, which the Tcl hooks below
+# read with read_checkpoint -incremental. Vivado then reuses the synthesis and
+# placement of the unchanged modules, and reworks the changed ones.
+#
+#   products = cached_build(platform, Top())
+
+CACHE_PRODUCTS = [ "{name}.bit", "{name}.bin", "{name}_synth.dcp", "{name}_route.dcp", "{name}.log", "*.rpt" ]
+
+# Vivado overrides for incremental builds, reading reference checkpoints if
+# present in the build directory: the synthesized one before synth_design, and
+# the routed one before the template's opt_design, which starts implementation
+def incremental_overrides(name="top"):
+    return {
+        "script_after_read":
+            "if {[file exists reference_synth.dcp]} { read_checkpoint -incremental reference_synth.dcp }",
+        "script_after_synth":
+            "write_checkpoint -force {name}_synth.dcp\n"
+            "if {{[file exists reference_route.dcp]}} {{ read_checkpoint -incremental reference_route.dcp }}".format(name=name),
+    }
+
+def plan_digest(plan):
+    digest = hashlib.sha256(amaranth.__version__.encode())
+    for filename in sorted(plan.files):
+        content = plan.files[filename]
+        digest.update(filename.encode() + b"\0")
+        digest.update(content.encode() if isinstance(content, str) else content)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+_verilog_module = re.compile(r"^module\s+(\\\S+|\w+)\s*[(#;].*?^endmodule", re.M | re.S)
+_verilog_src = re.compile(r'\(\*\s*src\s*=\s*"[^"]*"\s*\*\)\s*')
+
+# Text of each module of generated Verilog, by module name ("top.xadc")
+def verilog_modules(verilog):
+    return { m.group(1).lstrip("\\"): m.group(0) for m in _verilog_module.finditer(verilog) }
+
+# Hashes of the modules of generated Verilog, by module name
+def module_digests(verilog):
+    texts = { name: _verilog_src.sub("", text) for name, text in verilog_modules(verilog).items() }
+    children = { name: [ c for c in texts if c != name and re.search(r"(^|\s)\\?{}\s".format(re.escape(c)), text) ]
+                 for name, text in texts.items() }
+    digests = {}
+    def digest(name):
+        if name not in digests:
+            h = hashlib.sha256(texts[name].encode())
+            for child in sorted(children[name]):
+                h.update(digest(child).encode())
+            digests[name] = h.hexdigest()
+        return digests[name]
+    for name in texts:
+        digest(name)
+    return digests
+
+class BuildCache:
+    def __init__(self, directory="build/cache"):
+        self.directory = directory
+
+    def _entry(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def lookup(self, digest, name="top"):
+        entry = self._entry(digest)
+        return entry if os.path.exists(os.path.join(entry, "modules.json")) else None
+
+    def modules(self, digest):
+        with open(os.path.join(self._entry(digest), "modules.json")) as f:
+            return json.load(f)
+
+    # Cached build sharing the most modules: (digest, modules in common), or None
+    def reference(self, modules):
+        best = None
+        if not os.path.isdir(self.directory):
+            return None
+        for digest in os.listdir(self.directory):
+            try:
+                cached = self.modules(digest)
+            except (FileNotFoundError, ValueError):
+                continue
+            common = [ m for m, d in modules.items() if cached.get(m) == d ]
+            if common and (best is None or len(common) > len(best[1])):
+                best = (digest, common)
+        return best
+
+    def store(self, digest, build_dir, modules, name="top"):
+        entry = self._entry(digest)
+        os.makedirs(entry, exist_ok=True)
+        for pattern in CACHE_PRODUCTS:
+            for path in glob.glob(os.path.join(build_dir, pattern.format(name=name))):
+                shutil.copy2(path, entry)
+        # Written last, as builds may run in parallel
+        with open(os.path.join(entry, "modules.json.tmp"), "w") as f:
+            json.dump(modules, f, indent=1, sort_keys=True)
+        os.replace(os.path.join(entry, "modules.json.tmp"), os.path.join(entry, "modules.json"))
+
+    def restore(self, digest, build_dir):
+        os.makedirs(build_dir, exist_ok=True)
+        entry = self._entry(digest)
+        for filename in os.listdir(entry):
+            if not filename.startswith("modules.json"):
+                shutil.copy2(os.path.join(entry, filename), build_dir)
+
+# Builds design as platform.build() would, through the cache
+def cached_build(platform, design, name="top", build_dir="build", cache=None, do_program=False, program_opts={}, **kwargs):
+    cache = cache or BuildCache(os.path.join(build_dir, "cache"))
+    plan = platform.prepare(design, name, **{ **incremental_overrides(name), **kwargs })
+    digest = plan_digest(plan)
+    modules = module_digests(plan.files["{}.v".format(name)])
+
+    if cache.lookup(digest, name):
+        print("build cache: {} unchanged, reusing bitstream {}".format(name, digest[:12]))
+        cache.restore(digest, build_dir)
+        products = LocalBuildProducts(build_dir)
+    else:
+        for reference in [ "reference_synth.dcp", "reference_route.dcp" ]:
+            if os.path.exists(os.path.join(build_dir, reference)):
+                os.remove(os.path.join(build_dir, reference))
+        reference = cache.reference(modules)
+        if reference:
+            ref_digest, common = reference
+            changed = sorted(set(modules) - set(common))
+            print("build cache: incremental from {}, {} of {} modules changed: {}".format(
+                ref_digest[:12], len(changed), len(modules), ", ".join(changed)))
+            os.makedirs(build_dir, exist_ok=True)
+            entry = cache._entry(ref_digest)
+            for stage in [ "synth", "route" ]:
+                checkpoint = os.path.join(entry, "{}_{}.dcp".format(name, stage))
+                if os.path.exists(checkpoint):
+                    shutil.copy2(checkpoint, os.path.join(build_dir, "reference_{}.dcp".format(stage)))
+        else:
+            print("build cache: no cached build to start from, full build")
+        products = plan.execute_local(build_dir)
+        cache.store(digest, build_dir, modules, name)
+
+    if do_program:
+        platform.toolchain_program(products, name, **program_opts)
+    return products
+
+# Builds a small design three times through the cache with the stand-in for
+# Vivado (see sweep_build.py): unchanged, the second build must reuse the
+# first; with one submodule changed, the third must start from the first, with
+# that submodule and top changed
+def check_build_cache():
+    import io
+    import contextlib
+    from amaranth import Elaboratable, Module
+    from amaranth.build import Resource, Pins, Clock, Attrs
+    from amaranth.vendor.xilinx import XilinxPlatform
+    from sweep_build import mock_toolchain
+    from ledbar import LedBar
+    from pwm import PWM
+
+    # The FPGA of the board (the Alchitry Au+ of sem_board.py), with just a
+    # clock and an LED
+    class Platform(XilinxPlatform):
+        device = "xc7a100t"
+        package = "ftg256"
+        speed = "1"
+        default_clk = "clk100"
+        resources = [
+            Resource("clk100", 0, Pins("N14", dir="i"), Clock(100e6), Attrs(IOSTANDARD="LVCMOS33")),
+            Resource("led", 0, Pins("K13", dir="o"), Attrs(IOSTANDARD="LVCMOS33")),
+        ]
+        connectors = []
+
+    class Design(Elaboratable):
+        def __init__(self, ledbar_width):
+            self.ledbar_width = ledbar_width
+
+        def elaborate(self, platform):
+            m = Module()
+            pwm = m.submodules.pwm = PWM(256)
+            ledbar = m.submodules.ledbar = LedBar(self.ledbar_width, 4)
+            led = platform.request("led", 0)
+            m.d.comb += [
+                pwm.input.eq(5),
+                ledbar.value.eq(77),
+                led.o.eq(pwm.pwm ^ ledbar.bar[0]),
+            ]
+            return m
+
+    directory = "sim/build_cache_1"
+    shutil.rmtree(directory, ignore_errors=True)
+    build_dir = os.path.join(directory, "build")
+    vivado = os.environ.get("VIVADO")
+    os.environ["VIVADO"] = mock_toolchain(directory)
+    try:
+        def build(design):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                cached_build(Platform(), design, build_dir=build_dir)
+            return output.getvalue()
+
+        first = build(Design(12))
+        assert "full build" in first, first
+        assert os.path.exists(os.path.join(build_dir, "top.bit"))
+        cache = BuildCache(os.path.join(build_dir, "cache"))
+        digests = os.listdir(cache.directory)
+        assert len(digests) == 1, digests
+
+        second = build(Design(12))
+        assert "unchanged, reusing bitstream {}".format(digests[0][:12]) in second, second
+        assert os.listdir(cache.directory) == digests
+
+        third = build(Design(8))
+        match = re.search(r"incremental from (\w+), (\d+) of (\d+) modules changed: (.*)", third)
+        assert match, third
+        assert digests[0].startswith(match.group(1)), (match.group(1), digests)
+        assert match.group(4).split(", ") == [ "top", "top.ledbar" ], match.group(4)
+        for stage in [ "synth", "route" ]:
+            assert os.path.exists(os.path.join(build_dir, "reference_{}.dcp".format(stage)))
+        assert len(os.listdir(cache.directory)) == 2
+    finally:
+        if vivado is None:
+            del os.environ["VIVADO"]
+        else:
+            os.environ["VIVADO"] = vivado
+    print("build cache: reuse, and incremental from the closest build ok")
@@ -0,0 +1,284 @@
+import os
+from amaranth import *
+from amaranth.lib.cdc import ResetSynchronizer
+from amaranth.sim import Settle
+from simulation import Simulator
+
+from commands import RegisterPort
+
+# Pixel clock generation. An MMCME2_ADV multiplies the 100 MHz system clock up
+# to its VCO and divides it back down (CLKOUT0) into the "pixel" domain. The
+# divider can be changed at runtime over the MMCM's DRP, following XAPP888:
+# hold the MMCM in reset, read-modify-write its ClkReg1 / ClkReg2 for CLKOUT0,
+# then release reset and wait for lock. The pixel domain is held in reset
+# whilst the MMCM is unlocked, so pixel domain state which must outlive a
+# change of divider (committed scan configuration, frame counts) is reset-less.
+#
+# Pixel clock = input_frequency * vco_multiply / divider
+#   With the defaults, VCO = 1 GHz and divider 8..126 gives 125 MHz .. 7.9 MHz
+#
+# The XADC samples at 1 MSPS at most, so slower pixel rates come from the
+# scans dwelling several pixel clocks on each pixel (PixelScan's and
+# PathScan's dwell, up to 65535 clocks) rather than from the divider.
+
+# CLKOUT0 DRP registers (XAPP888), with the bits kept on read-modify-write
+MMCM_CLKOUT0_REG1 = 0x08
+MMCM_CLKOUT0_REG2 = 0x09
+MMCM_CLKOUT0_REG1_KEEP = 0x1000
+MMCM_CLKOUT0_REG2_KEEP = 0x8000
+
+# The pixel domain is timed for PIXEL_FMAX, which sets the smallest divider
+PIXEL_FMAX = 125e6
+PIXEL_DIVIDER_MAX = 126
+
+def pixel_divider_min(input_frequency=100e6, vco_multiply=10, fmax=PIXEL_FMAX):
+    return max(1, -(-round(input_frequency * vco_multiply) // round(fmax)))
+
+PIXEL_DIVIDER_MIN = pixel_divider_min()
+
+# Register port addresses
+PIXEL_CLOCK_ADDR_DIVIDER = 0
+PIXEL_CLOCK_ADDR_STATUS  = 1
+
+# Reference for the register contents programmed for an integer divider
+def clkout_registers(divider : int):
+    assert 1 <= divider <= PIXEL_DIVIDER_MAX
+    high = divider // 2
+    low = divider - high
+    edge = divider & 1
+    no_count = divider == 1
+    reg1 = (high << 6) | low
+    reg2 = (edge << 7) | (no_count << 6)
+    return reg1, reg2
+
+# The MMCM's dynamic reconfiguration port (clocked by sync), plus its reset and lock
+class MMCMDRP:
+    def __init__(self):
+        self.daddr  = Signal(7)
+        self.di     = Signal(16)
+        self.do     = Signal(16)
+        self.den    = Signal()
+        self.dwe    = Signal()
+        self.drdy   = Signal()
+        self.rst    = Signal()
+        self.locked = Signal()
+
+# Reprograms the CLKOUT0 divider over the DRP. Dividers outside
+# [divider_min, PIXEL_DIVIDER_MAX] are ignored.
+class DividerReconfig(Elaboratable):
+    def __init__(self, drp : MMCMDRP, divider : int, divider_min=PIXEL_DIVIDER_MIN):
+        assert divider_min <= divider <= PIXEL_DIVIDER_MAX
+        self.drp = drp
+        self.divider_min = divider_min
+
+        # Host access: divider (write to reprogram) and status
+        self.port = RegisterPort("pixel_clock")
+
+        # Out: current divider, and reprogramming in progress
+        self.divider = Signal(range(PIXEL_DIVIDER_MAX + 1), reset=divider)
+        self.busy = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        drp = self.drp
+        port = self.port
+
+        start = Signal()
+        readback = Signal(16)
+
+        # Divider to register fields as in clkout_registers
+        high = self.divider >> 1
+        low = self.divider - high
+        edge = self.divider[0]
+        no_count = self.divider == 1
+        steps = [
+            (MMCM_CLKOUT0_REG1, MMCM_CLKOUT0_REG1_KEEP, Cat(low[:6], high[:6])),
+            (MMCM_CLKOUT0_REG2, MMCM_CLKOUT0_REG2_KEEP, Cat(C(0, 6), no_count, edge)),
+        ]
+
+        # Register port: acks the cycle after stb
+        m.d.sync += port.ack.eq(port.stb & ~port.ack)
+        m.d.comb += port.rdata.eq(Mux(port.addr == PIXEL_CLOCK_ADDR_STATUS, Cat(drp.locked, self.busy), self.divider))
+        with m.If(port.stb & ~port.ack & port.we & (port.addr == PIXEL_CLOCK_ADDR_DIVIDER) & ~self.busy):
+            with m.If((port.wdata >= self.divider_min) & (port.wdata <= PIXEL_DIVIDER_MAX)):
+                m.d.sync += self.divider.eq(port.wdata)
+                m.d.comb += start.eq(1)
+
+        with m.FSM() as fsm:
+            with m.State("IDLE"):
+                with m.If(start):
+                    m.next = "READ0"
+
+            for i, (addr, keep, value) in enumerate(steps):
+                last = i == len(steps) - 1
+                with m.State("READ{}".format(i)):
+                    m.d.comb += [
+                        drp.daddr.eq(addr),
+                        drp.den.eq(1),
+                    ]
+                    m.next = "WAIT_READ{}".format(i)
+
+                with m.State("WAIT_READ{}".format(i)):
+                    with m.If(drp.drdy):
+                        m.d.sync += readback.eq(drp.do)
+                        m.next = "WRITE{}".format(i)
+
+                with m.State("WRITE{}".format(i)):
+                    m.d.comb += [
+                        drp.daddr.eq(addr),
+                        drp.di.eq((readback & keep) | value),
+                        drp.den.eq(1),
+                        drp.dwe.eq(1),
+                    ]
+                    m.next = "WAIT_WRITE{}".format(i)
+
+                with m.State("WAIT_WRITE{}".format(i)):
+                    with m.If(drp.drdy):
+                        m.next = "WAIT_LOCK" if last else "READ{}".format(i+1)
+
+            with m.State("WAIT_LOCK"):
+                with m.If(drp.locked):
+                    m.next = "IDLE"
+
+        # MMCM is held in reset whilst its registers change
+        m.d.comb += [
+            self.busy.eq(~fsm.ongoing("IDLE")),
+            drp.rst.eq(self.busy & ~fsm.ongoing("WAIT_LOCK")),
+        ]
+        return m
+
+# Creates the "pixel" clock domain from sync through an MMCM, with its divider
+# programmable through port (see DividerReconfig)
+class PixelClock(Elaboratable):
+    def __init__(self, input_frequency=100e6, vco_multiply=10, divider=100):
+        assert 600e6 <= input_frequency * vco_multiply <= 1200e6, "VCO out of range"
+        self.input_frequency = input_frequency
+        self.vco_multiply = vco_multiply
+
+        self.drp = MMCMDRP()
+        self.reconfig = DividerReconfig(self.drp, divider, pixel_divider_min(input_frequency, vco_multiply))
+        self.port = self.reconfig.port
+        self.divider = self.reconfig.divider
+
+    def frequency(self, divider):
+        return self.input_frequency * self.vco_multiply / divider
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.reconfig = self.reconfig
+        drp = self.drp
+
+        m.domains.pixel = ClockDomain("pixel")
+
+        feedback = Signal()
+        clkout0 = Signal()
+        m.submodules.mmcm = Instance("MMCME2_ADV",
+            p_BANDWIDTH = "OPTIMIZED",
+            p_CLKIN1_PERIOD = 1e9 / self.input_frequency,
+            p_DIVCLK_DIVIDE = 1,
+            p_CLKFBOUT_MULT_F = float(self.vco_multiply),
+            p_CLKOUT0_DIVIDE_F = float(self.divider.reset),
+            p_CLKOUT0_PHASE = 0.0,
+            p_CLKOUT0_DUTY_CYCLE = 0.5,
+
+            i_CLKIN1 = ClockSignal("sync"),
+            i_CLKIN2 = 0,
+            i_CLKINSEL = 1,
+            i_CLKFBIN = feedback,
+            o_CLKFBOUT = feedback,
+            o_CLKOUT0 = clkout0,
+            i_RST = drp.rst,
+            i_PWRDWN = 0,
+            o_LOCKED = drp.locked,
+
+            i_DCLK = ClockSignal("sync"),
+            i_DADDR = drp.daddr,
+            i_DI = drp.di,
+            o_DO = drp.do,
+            i_DEN = drp.den,
+            i_DWE = drp.dwe,
+            o_DRDY = drp.drdy,
+
+            i_PSCLK = 0,
+            i_PSEN = 0,
+            i_PSINCDEC = 0,
+        )
+        m.submodules.bufg = Instance("BUFG", i_I=clkout0, o_O=ClockSignal("pixel"))
+        m.submodules.pixel_reset = ResetSynchronizer(~drp.locked, domain="pixel")
+
+        return m
+
+def sim_clocking_1():
+    drp = MMCMDRP()
+    dut = DividerReconfig(drp, divider=100)
+
+    # Model of the MMCM's DRP registers: drdy a few cycles after den, and lock
+    # some time after reset is released
+    regs = { MMCM_CLKOUT0_REG1 : 0x1000 | (50 << 6) | 50, MMCM_CLKOUT0_REG2 : 0xfc00 }
+    written = []
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0 / 100e6, domain="sync")
+
+    def mmcm_proc():
+        lock_count = 0
+        for _ in range(400):
+            yield Settle()
+            if (yield drp.den):
+                addr, we, di = (yield drp.daddr), (yield drp.dwe), (yield drp.di)
+                for _ in range(3):
+                    yield
+                if we:
+                    regs[addr] = di
+                    written.append((addr, di))
+                yield drp.do.eq(regs.get(addr, 0))
+                yield drp.drdy.eq(1)
+                yield
+                yield drp.drdy.eq(0)
+                continue
+            if (yield drp.rst):
+                lock_count = 0
+                yield drp.locked.eq(0)
+            else:
+                lock_count += 1
+                yield drp.locked.eq(lock_count > 10)
+            yield
+
+    def host_proc():
+        port = dut.port
+        for _ in range(20):
+            yield
+        for divider in [PIXEL_DIVIDER_MIN, 33, PIXEL_DIVIDER_MIN - 1, 0]:
+            yield port.addr.eq(PIXEL_CLOCK_ADDR_DIVIDER)
+            yield port.wdata.eq(divider)
+            yield port.we.eq(1)
+            yield port.stb.eq(1)
+            yield
+            while not (yield port.ack):
+                yield
+            yield port.stb.eq(0)
+            yield
+            yield Settle()
+            while (yield dut.busy):
+                yield
+                yield Settle()
+            for _ in range(20):
+                yield
+
+    sim.add_sync_process(mmcm_proc, domain="sync")
+    sim.add_sync_process(host_proc, domain="sync")
+
+    os.makedirs("sim", exist_ok=True)
+    with sim.write_vcd("sim/clocking_1.vcd"):
+        sim.run()
+
+    # Dividers below the minimum are ignored
+    expected = []
+    for divider in [PIXEL_DIVIDER_MIN, 33]:
+        reg1, reg2 = clkout_registers(divider)
+        expected += [ (MMCM_CLKOUT0_REG1, 0x1000 | reg1), (MMCM_CLKOUT0_REG2, 0x8000 | reg2) ]
+    assert written == expected, [ (hex(a), hex(d)) for a, d in written ]
+    print("clocking: divider reprogrammed over DRP ok")
+
+if __name__ == "__main__":
+    sim_clocking_1()
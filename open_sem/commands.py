@@ -0,0 +1,299 @@
+import os
+from amaranth import *
+from amaranth.lib.cdc import FFSynchronizer
+from amaranth.sim import Settle
+from simulation import Simulator
+
+# Host to FPGA commands arrive on the FT60x read fifo, two words each (16 bit for FT600)
+#
+#   word 0 : opcode[15:12], target[11:7], address[6:0]
+#   word 1 : data (ignored for reads)
+#
+# Block writes stream any number of words to one address (for example a
+# target's data fifo) without a header per word:
+#
+#   word 0 : OP_WRITE_BLOCK, target, address
+#   word 1 : count, at most MAX_BLOCK_WORDS
+#   word 2.. count words, each written to address in turn
+#
+# Words with an unknown opcode are skipped. A word without all its bytes
+# valid, or a block count over MAX_BLOCK_WORDS, abandons the command being
+# decoded and is skipped too. So a command in progress takes at most
+# MAX_BLOCK_WORDS + 1 more words, and the host resyncs by sending
+# MAX_BLOCK_WORDS + 2 zero words: whatever was being decoded (writing zeros),
+# the last is skipped as a header. Reads are answered on the uplink with a
+# two word register packet (see packetizer.py): word 0 echoed, then the value
+# read.
+OP_WRITE = 0xA
+OP_READ  = 0xB
+OP_WRITE_BLOCK = 0xC
+
+# Command targets
+TARGET_XADC = 0
+TARGET_PIXEL_CLOCK = 1
+TARGET_PATH_SCAN = 2
+TARGET_PIXEL_SCAN = 3
+TARGET_ACCUMULATOR = 4
+TARGET_SAMPLE_MUX = 5
+TARGET_SAMPLE_PACKER = 6
+
+# Longest block write: a path list of PathScan's max_points (x, y) words
+MAX_BLOCK_WORDS = 2048
+
+def command_word(op, target, address):
+    assert 0 <= target < 32 and 0 <= address < 128
+    return (op << 12) | (target << 7) | address
+
+# A register access port, driven by CommandDecoder and served by a module.
+# stb is held until the module pulses ack (with rdata for reads).
+class RegisterPort:
+    def __init__(self, name, addr_bits=7, data_bits=16):
+        self.addr  = Signal(addr_bits, name=name + "_addr")
+        self.wdata = Signal(data_bits, name=name + "_wdata")
+        self.we    = Signal(name=name + "_we")
+        self.stb   = Signal(name=name + "_stb")
+        self.ack   = Signal(name=name + "_ack")
+        self.rdata = Signal(data_bits, name=name + "_rdata")
+
+# Hands a commit of register values from i_domain across to o_domain. The
+# i_domain side pulses commit, then holds the values steady whilst pending;
+# o_domain sees o_pending until it pulses o_take, having copied them.
+# Requests and takes are toggles in reset-less flops, so a commit in flight
+# survives a reset of either domain (such as the pixel domain's, whilst its
+# clock relocks), being taken once the domain runs again.
+class CommitHandshake(Elaboratable):
+    def __init__(self, i_domain="sync", o_domain="pixel"):
+        self.i_domain = i_domain
+        self.o_domain = o_domain
+
+        # i_domain: commits are ignored whilst one is pending
+        self.commit  = Signal()
+        self.pending = Signal()
+
+        # o_domain
+        self.o_pending = Signal()
+        self.o_take    = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        request = Signal(reset_less=True)
+        taken   = Signal(reset_less=True)
+        o_request = Signal()
+        i_taken   = Signal()
+        m.submodules.request_cdc = FFSynchronizer(request, o_request, o_domain=self.o_domain)
+        m.submodules.taken_cdc = FFSynchronizer(taken, i_taken, o_domain=self.i_domain)
+
+        with m.If(self.commit & ~self.pending):
+            m.d[self.i_domain] += request.eq(~request)
+        with m.If(self.o_take & self.o_pending):
+            m.d[self.o_domain] += taken.eq(o_request)
+        m.d.comb += [
+            self.pending.eq(request != i_taken),
+            self.o_pending.eq(o_request != taken),
+        ]
+        return m
+
+# Decodes host commands and performs them on the RegisterPort of each target
+class CommandDecoder(Elaboratable):
+    def __init__(self, targets : list[RegisterPort], word_bits=16, data_bytes=2, max_block=MAX_BLOCK_WORDS):
+        self.targets = targets
+        self.word_bits = word_bits
+        self.data_bytes = data_bytes
+        self.max_block = max_block
+
+        # In: word stream from FT60x (data followed by byte valid bits)
+        self.i_data  = Signal(word_bits + data_bytes)
+        self.i_valid = Signal()
+        self.i_ready = Signal()
+
+        # Out: read responses (header word, value)
+        self.resp_data  = Signal(word_bits)
+        self.resp_valid = Signal()
+        self.resp_ready = Signal()
+
+        # Out: number of malformed words skipped (and commands abandoned)
+        self.skipped = Signal(16)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        header = Signal(self.word_bits)
+        value  = Signal(self.word_bits)
+        remaining = Signal(self.word_bits)
+        op     = header[12:16]
+        target = header[7:12]
+        addr   = header[0:7]
+
+        word = self.i_data[:self.word_bits]
+        word_valid = self.i_data[self.word_bits:] == (1 << self.data_bytes) - 1
+        take = Signal()
+        m.d.comb += take.eq(self.i_valid & self.i_ready)
+
+        port_ack = Signal()
+        port_rdata = Signal(self.word_bits)
+        for i, port in enumerate(self.targets):
+            with m.If(target == i):
+                m.d.comb += [
+                    port_ack.eq(port.ack),
+                    port_rdata.eq(port.rdata),
+                ]
+
+        with m.FSM():
+            with m.State("HEADER"):
+                m.d.comb += self.i_ready.eq(1)
+                with m.If(take):
+                    op_in = word[12:16]
+                    target_in = word[7:12]
+                    with m.If(word_valid & ((op_in == OP_WRITE) | (op_in == OP_READ) | (op_in == OP_WRITE_BLOCK)) & (target_in < len(self.targets))):
+                        m.d.sync += header.eq(word)
+                        m.next = "DATA"
+                    with m.Else():
+                        m.d.sync += self.skipped.eq(self.skipped + 1)
+
+            with m.State("DATA"):
+                m.d.comb += self.i_ready.eq(1)
+                with m.If(take):
+                    with m.If(~word_valid | ((op == OP_WRITE_BLOCK) & (word > self.max_block))):
+                        m.d.sync += self.skipped.eq(self.skipped + 1)
+                        m.next = "HEADER"
+                    with m.Elif(op == OP_WRITE_BLOCK):
+                        m.d.sync += remaining.eq(word)
+                        m.next = "BLOCK"
+                    with m.Else():
+                        m.d.sync += value.eq(word)
+                        m.next = "ACCESS"
+
+            with m.State("BLOCK"):
+                with m.If(remaining == 0):
+                    m.next = "HEADER"
+                with m.Else():
+                    m.d.comb += self.i_ready.eq(1)
+                    with m.If(take & ~word_valid):
+                        m.d.sync += self.skipped.eq(self.skipped + 1)
+                        m.next = "HEADER"
+                    with m.Elif(take):
+                        m.d.sync += [
+                            value.eq(word),
+                            remaining.eq(remaining - 1),
+                        ]
+                        m.next = "ACCESS"
+
+            with m.State("ACCESS"):
+                for i, port in enumerate(self.targets):
+                    with m.If(target == i):
+                        m.d.comb += [
+                            port.stb.eq(1),
+                            port.addr.eq(addr),
+                            port.wdata.eq(value),
+                            port.we.eq(op != OP_READ),
+                        ]
+                with m.If(port_ack):
+                    with m.If(op == OP_READ):
+                        m.d.sync += value.eq(port_rdata)
+                        m.next = "RESPOND_HEADER"
+                    with m.Elif(op == OP_WRITE_BLOCK):
+                        m.next = "BLOCK"
+                    with m.Else():
+                        m.next = "HEADER"
+
+            with m.State("RESPOND_HEADER"):
+                m.d.comb += [
+                    self.resp_data.eq(header),
+                    self.resp_valid.eq(1),
+                ]
+                with m.If(self.resp_ready):
+                    m.next = "RESPOND_VALUE"
+
+            with m.State("RESPOND_VALUE"):
+                m.d.comb += [
+                    self.resp_data.eq(value),
+                    self.resp_valid.eq(1),
+                ]
+                with m.If(self.resp_ready):
+                    m.next = "HEADER"
+
+        return m
+
+def sim_commands_1():
+    # Two simple register files as targets, acking a cycle after stb
+    ports = [ RegisterPort("t0"), RegisterPort("t1") ]
+    max_block = 4
+    dut = CommandDecoder(ports, max_block=max_block)
+
+    class Top(Elaboratable):
+        def elaborate(self, platform):
+            m = Module()
+            m.submodules.dut = dut
+            for p in ports:
+                regs = Array([ Signal(16) for _ in range(4) ])
+                m.d.sync += p.ack.eq(p.stb & ~p.ack)
+                m.d.comb += p.rdata.eq(regs[p.addr[:2]])
+                with m.If(p.stb & ~p.ack & p.we):
+                    m.d.sync += regs[p.addr[:2]].eq(p.wdata)
+            return m
+
+    sim = Simulator(Top())
+    sim.add_clock(1.0 / 100e6, domain="sync")
+
+    # Words are all bytes valid, unless given as (word, byte valid bits)
+    words = [
+        0x0000, # junk, skipped
+        command_word(OP_WRITE, 1, 2), 0x1234,
+        command_word(OP_WRITE, 0, 2), 0x5678,
+        command_word(OP_READ, 1, 2), 0,
+        command_word(OP_READ, 0, 2), 0,
+        command_word(OP_WRITE_BLOCK, 1, 1), 3, 0x1111, 0x2222, 0x3333,
+        command_word(OP_READ, 1, 1), 0,
+        # A partly valid data word abandons the write
+        command_word(OP_WRITE, 1, 3), (0x9999, 0b01),
+        command_word(OP_READ, 1, 3), 0,
+        # So does a block count over the maximum
+        command_word(OP_WRITE_BLOCK, 1, 0), max_block + 1,
+        command_word(OP_READ, 1, 0), 0,
+        # Resync part way through a block: its last words are zeros, and the
+        # rest are skipped
+        command_word(OP_WRITE_BLOCK, 0, 1), max_block, 0xaaaa,
+    ] + [ 0 ] * (max_block + 2) + [
+        command_word(OP_READ, 0, 1), 0,
+    ]
+    responses = []
+    skipped = []
+
+    def host_proc():
+        for w in words:
+            w, valid = w if isinstance(w, tuple) else (w, 0b11)
+            yield dut.i_data.eq(Cat(C(w, 16), C(valid, 2)))
+            yield dut.i_valid.eq(1)
+            yield Settle()
+            while not (yield dut.i_ready):
+                yield
+                yield Settle()
+            yield
+        yield dut.i_valid.eq(0)
+
+    def resp_proc():
+        yield dut.resp_ready.eq(1)
+        for _ in range(200):
+            yield Settle()
+            if (yield dut.resp_valid):
+                responses.append((yield dut.resp_data))
+            yield
+        skipped.append((yield dut.skipped))
+
+    sim.add_sync_process(host_proc, domain="sync")
+    sim.add_sync_process(resp_proc, domain="sync")
+
+    os.makedirs("sim", exist_ok=True)
+    with sim.write_vcd("sim/commands_1.vcd"):
+        sim.run()
+
+    assert responses == [ command_word(OP_READ, 1, 2), 0x1234, command_word(OP_READ, 0, 2), 0x5678,
+                          command_word(OP_READ, 1, 1), 0x3333, command_word(OP_READ, 1, 3), 0,
+                          command_word(OP_READ, 1, 0), 0, command_word(OP_READ, 0, 1), 0 ], [ hex(r) for r in responses ]
+    # The junk word, two abandoned commands and the resync words left over
+    assert skipped == [ 3 + 3 ], skipped
+    print("commands: ok")
+
+if __name__ == "__main__":
+    sim_commands_1()
@@ -1,21 +1,14 @@
 import os
 from amaranth import *
-from amaranth.sim import Simulator
+from simulation import Simulator
 from fixed_point import *
+from dsp import PipelinedMultiply
 import functools
 
-# https://stackoverflow.com/questions/12370379/flat-permutations-of-n-tuple-breadth-first
-def seq(n, k):
-    if (k == 0):
-        yield ()
-        return
-
-    for i in range(n+1):
-        for subseq in seq(i, k-1):
-            for j in range(k):
-                yield subseq[:j] + (i,) + subseq[j:]
-                if j != k-1 and subseq[j] == i:
-                    break
+# Every on/off state of n pwm outputs. Bit i of the index is output i, so the
+# index of the chosen option can drive the pwm outputs directly.
+def pwm_options(n):
+    return [ tuple((x >> i) & 1 for i in range(n)) for x in range(2**n) ]
 
 # def ternary_op(cond : Value, case_true: Value, case_false : Value):
 #     assert cond.shape().width == 1
@@ -27,35 +20,92 @@ def seq(n, k):
 #     assert ret.shape().width == out_bits
 #     return ret
 
+# Pipeline stage: a value or fixed point value held in a named signal, either
+# registered or combinational. Amaranth walks expressions as trees, so shared
+# subexpressions should be put in a signal to stop them being rebuilt and
+# revisited by every expression using them.
+def stage(m : Module, x, registered : bool, name : str):
+    domain = m.d.sync if registered else m.d.comb
+    if isinstance(x, SignalFixedPoint):
+        r = SignalFixedPoint(value=Signal(x.s.shape(), name=name), frac_bits=x.qf)
+        domain += r.s.eq(x.s)
+    else:
+        r = Signal(x.shape(), name=name)
+        domain += r.eq(x)
+    return r
 
-def argmin( vals : list ):
+# Balanced comparator tree returning the index of the smallest value (the last
+# one on ties). A register is placed after each level listed in register_levels.
+def argmin_tree(m : Module, vals : list, register_levels=()):
     def idx_least(a,b):
         assert a[1].shape().width == b[1].shape().width
         a_less_b = a[1] < b[1]
-        # return ( ternary_op(a_less_b, a[0], b[0]), ternary_op(a_less_b, a[1].as_unsigned(), b[1].as_unsigned()).as_signed() )
         return ( Mux(a_less_b, a[0], b[0]), Mux(a_less_b, a[1].as_unsigned(), b[1].as_unsigned()).as_signed() )
 
     list_idx_bits = C(len(vals)-1).shape().width
-    idx_vals = [ (C(idx,list_idx_bits), vals[idx]) for idx in range(len(vals))]
-    (idx, _) = functools.reduce( idx_least, idx_vals )
-    return idx
+    level = [ (C(idx,list_idx_bits), vals[idx]) for idx in range(len(vals))]
+    depth = 0
+    while len(level) > 1:
+        pairs = [ idx_least(level[i], level[i+1]) for i in range(0, len(level) - 1, 2) ]
+        registered = depth in register_levels
+        level = [ ( stage(m, idx, registered, "argmin{}_{}_idx".format(depth, k)),
+                    stage(m, val, registered, "argmin{}_{}_val".format(depth, k)) )
+                  for k, (idx, val) in enumerate(pairs) ] + ([level[-1]] if len(level) % 2 else [])
+        depth += 1
+    return level[0][0]
+
+# Number of levels in argmin_tree for n values
+def argmin_tree_depth(n):
+    return (n-1).bit_length()
 
 # Drive the x,y deflection beams for raster scanning.
 # The DAC for the y-deflection is driven directly.
 # The x-beam is driven through the parameters of an
 # external analog linear ramp generator.
+#
+# Each update, every combination of pwm outputs is tried against a model of the
+# external RC filter and the one leaving v_out closest to input is chosen.
+# With latency > 1 the search is pipelined over that many cycles, and the pwm
+# outputs are held for the whole period (so the filter model steps by
+# latency * delta_time per update).
+#
+# With precomputed=True the filter coefficients are folded together in Python
+# so that the whole search needs a single constant multiply, leaving only
+# constant adds per option. It is the cheaper choice when running the DAC in a
+# faster clock domain (use DomainRenamer to move it out of sync). With the
+# exact search it follows exactly the same v_out trajectory; with guard_bits,
+# the two engines truncate different products (each k_i * v_out, or the one
+# folded product), so their trajectories can differ by the truncation error.
+#
+# By default the search is exact (products keep all 2*frac_bits fractional
+# bits). With guard_bits set, products are truncated to frac_bits + guard_bits
+# fractional bits before being summed, which narrows every adder, comparator
+# and the outcome mux at the cost of a small error in the filter model (see
+# dac_model.py for the same arithmetic in software).
+#
+# With dsp_latency set, the products are PipelinedMultiply's (dsp.py) with that
+# many of the DAC's latency cycles given to their DSP48 registers, rather than
+# a single register after a combinational multiply.
 class DAC(Elaboratable):
     def __init__(self,
             delta_time : float,
             capacitor : float,
             resistors : list[float],
-            output_pwm
+            output_pwm,
+            frac_bits : int = 20,
+            latency : int = 1,
+            precomputed : bool = False,
+            guard_bits : int = None,
+            dsp_latency : int = None
             ):
         # Constants
-        self.frac_bits = 20
+        self.frac_bits = frac_bits
         self.n = len(resistors)
+        self.latency = latency
+        self.precomputed = precomputed
+        self.guard_bits = guard_bits
         self.delta_t_inv_tau = [
-            SignalFixedPoint(1, self.frac_bits, constant= delta_time/(capacitor*R), signed=True ) for R in resistors
+            SignalFixedPoint(1, self.frac_bits, constant= latency*delta_time/(capacitor*R), signed=True ).trim() for R in resistors
         ]
         
         # Output (tristate)
@@ -72,74 +122,217 @@ class DAC(Elaboratable):
         self.v_out.s.name = "vout"
         
         # possible pwm array states
-        self.options = [ Cat([C(y,1) for y in list(x)]) for x in list(seq(1,self.n)) ]
+        self.options = pwm_options(self.n)
         self.n_ops = len(self.options)
+
+        # Pipeline registers go after the products, then the errors, then spread over the tree
+        tree_depth = argmin_tree_depth(self.n_ops)
+        regs = latency - 1
+        self.dsp_latency = dsp_latency
+        product_regs = min(regs, 1) if dsp_latency is None else dsp_latency
+        assert 1 + product_regs <= latency <= 2 + product_regs + tree_depth, \
+            "latency must be in [{}, {}]".format(1 + product_regs, 2 + product_regs + tree_depth)
+        self.register_products = product_regs >= 1
+        self.register_errors = regs - product_regs >= 1
+        tree_regs = max(0, regs - product_regs - 1)
+        self.register_levels = { ((k+1) * (tree_depth+1)) // (tree_regs+1) - 1 for k in range(tree_regs) }
         
     @staticmethod
     def info(name, fixed):
         print(name, fixed.s.shape(), fixed.s.shape().width - fixed.qf, fixed.qf)
+
+    # Products of v_out, trimmed to the guard bits if set. |k|, |v_out| < 1 so
+    # two integer bits always hold them.
+    def trim_product(self, p):
+        if self.guard_bits is None:
+            return p
+        return p.resize(2, self.frac_bits + self.guard_bits)
+
+    # k * v_out held in a signal, registered (or in a DSP pipeline) as configured
+    def product(self, m, k, name):
+        if self.dsp_latency is None:
+            return stage(m, self.trim_product(k * self.v_out), self.register_products, name)
+        mul = PipelinedMultiply(k, self.v_out, self.dsp_latency)
+        m.submodules[name] = mul
+        m.d.comb += [
+            mul.a.eq(k),
+            mul.b.eq(self.v_out),
+        ]
+        return stage(m, self.trim_product(mul.p), False, name)
         
-    def delta_v(self, pwms):
-        # TODO can factor delta_t_inv_tau out to compute multiplication just once with self.v_out shared between all delta_v's
-        diffs = [ SignalFixedPoint(value=pwm,frac_bits=0) - self.v_out for pwm in pwms]
-        
-        dvs = [self.delta_t_inv_tau[i] * diffs[i] for i in range(self.n)]
-        sum = functools.reduce(lambda a, b: a+b, dvs)
-        return sum
+    # v_out + delta_v for every option, sharing one multiply per resistor between them:
+    #   sum_i k_i * (pwm_i - v_out) = sum_i (pwm_i ? k_i - k_i*v_out : -k_i*v_out)
+    # Partial sums over the first j outputs are shared by all options that agree
+    # on those outputs, so 2^(n+1) adders are built rather than n * 2^n.
+    def option_outcomes(self, m):
+        products = [ self.product(m, k, "product{}".format(i))
+                     for i, k in enumerate(self.delta_t_inv_tau) ]
+        high = [ k - p for k, p in zip(self.delta_t_inv_tau, products) ]
+        low  = [ -p for p in products ]
+
+        high = [ stage(m, h, False, "high{}".format(i)) for i, h in enumerate(high) ]
+        low  = [ stage(m, l, False, "low{}".format(i)) for i, l in enumerate(low) ]
+
+        sums = [ self.v_out ]
+        for i in range(self.n):
+            sums = [ s + low[i] for s in sums ] + [ s + high[i] for s in sums ]
+            sums = [ stage(m, s, False, "partial{}_{}".format(i, k)) for k, s in enumerate(sums) ]
+        return sums
     
+    # v_out + delta_v for every option, as a single multiply shared by all options:
+    #   v_out + sum_i k_i * (pwm_i - v_out) = v_out * (1 - sum_i k_i) + sum_{i: pwm_i} k_i
+    # Returns the decayed v_out and the constant to add for each option.
+    def precomputed_terms(self, m):
+        k = [ d.value_rep() for d in self.delta_t_inv_tau ]
+        gain = (1 << self.frac_bits) - sum(k)
+        decay = SignalFixedPoint(value=Const(gain, signed(gain.bit_length() + 1)), frac_bits=self.frac_bits)
+        base = self.product(m, decay, "vout_decay")
+
+        offsets = []
+        for opt in self.options:
+            c = sum(k[i] for i in range(self.n) if opt[i])
+            offsets.append( SignalFixedPoint(value=Const(c, signed(c.bit_length() + 1)), frac_bits=self.frac_bits) )
+        return base, offsets
+
     def elaborate(self, platform):
         m = Module()
+
+        # Hold the input steady whilst the pipeline evaluates it
+        update = Signal()
+        if self.latency > 1:
+            phase = Signal(range(self.latency))
+            m.d.sync += phase.eq(Mux(update, 0, phase + 1))
+            m.d.comb += update.eq(phase == self.latency - 1)
+
+            target = SignalFixedPoint(value=Signal(self.input.s.shape(), name="input_held"), frac_bits=self.input.qf)
+            with m.If(update):
+                m.d.sync += target.s.eq(self.input.s)
+        else:
+            m.d.comb += update.eq(1)
+            target = self.input
         
-        deltas = [ self.delta_v(opt) for opt in self.options]
-        # deltas = [SignalFixedPoint(1,self.frac_bits+1,signed=True) for _ in range(self.n_ops)]
-        # m.d.sync += [deltas[i].eq(self.delta_v(self.options[i])) for i in range(self.n_ops)]        
-        
-        outcomes = [ self.v_out + delta for delta in deltas]
-        errors = [ abs((o - self.input).s) for o in outcomes]
-        # errors = [Signal(self.frac_bits+1) for _ in range(self.n_ops)]
-        # m.d.sync += [ errors[i].eq(abs((outcomes[i] - self.input).s)) for i in range(self.n_ops) ]
+        if self.precomputed:
+            base, offsets = self.precomputed_terms(m)
+            base_error = stage(m, base - target, False, "base_error")
+            outcomes = [ base + c for c in offsets ]
+            errors = [ abs((base_error + c).s) for c in offsets ]
+        else:
+            outcomes = self.option_outcomes(m)
+            errors = [ abs((o - target).s) for o in outcomes]
+        outcomes = [ stage(m, o, self.register_errors, "outcome{}".format(i)) for i, o in enumerate(outcomes) ]
+        errors = [ stage(m, e, self.register_errors, "errors{}".format(i)) for i, e in enumerate(errors) ]
                 
-        least_idx = argmin(errors)
-        least_pwm = Cat(self.options).word_select(least_idx, self.n )
+        least_idx = argmin_tree(m, errors, self.register_levels)
+        least_pwm = least_idx
         least_vouts = Cat([o.s for o in outcomes]).word_select(least_idx, outcomes[0].s.shape().width )
         least_vout = SignalFixedPoint(value=least_vouts, frac_bits=outcomes[0].qf)
                 
-        m.d.sync += [
-            self.pwm.eq( least_pwm ),
-            self.v_out.eq( least_vout ),
-        ]
-        
-        for i in range(self.n_ops):
-            deltas[i].s.name = "delta" + str(i)
-            errors[i].name = "errors" + str(i)
-        
-        # # debug signals        
-        # v0 = SignalFixedPoint(1,0, constant=0.0)
-        # v1 = SignalFixedPoint(1,0, constant=1.0)
-        # diff0 = v0 - self.v_out
-        # diff1 = v1 - self.v_out
-
-        # for i in range(len(self.options)):
-        #     m.d.comb += [
-        #         Signal(outcomes[i].s.shape().width, name="outcome{}".format(i)).eq(outcomes[i].s),
-        #         Signal(errors[i].shape().width, name="errors{}".format(i)).eq(errors[i]),
-        #         Signal(self.options[i].shape(),name="opt"+str(i)).eq(self.options[i]),            
-        #     ]
-
-        
-        # m.d.comb += [
-        #     Signal(least_idx.shape(),name="least_idx").eq(least_idx),
-        #     Signal(least_pwm.shape(),name="least_pwm").eq(least_pwm),
-        #     Signal(v0.s.shape(),name="v0").eq(v0.s),
-        #     Signal(v1.s.shape(),name="v1").eq(v1.s),            
-        #     Signal(diff0.s.shape(),name="diff0").eq(diff0.s),
-        #     Signal(diff1.s.shape(),name="diff1").eq(diff1.s),            
-        # ]
+        with m.If(update):
+            m.d.sync += [
+                self.pwm.eq( least_pwm ),
+                self.v_out.eq( least_vout ),
+            ]
         
         return m
         
         
         
+# Number of distinct expression nodes in a fragment (shared subexpressions count once)
+def ast_node_count(fragment):
+    from amaranth.hdl.ast import Statement
+    seen = set()
+    stack = []
+    def add_fragment(f):
+        stack.extend(f.statements)
+        for sub, _ in f.subfragments:
+            add_fragment(sub)
+    add_fragment(fragment)
+
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        for attr in ("operands", "parts", "elems", "lhs", "rhs", "value", "offset", "index", "test", "cases"):
+            child = getattr(node, attr, None)
+            if isinstance(child, dict):
+                child = [ s for stmts in child.values() for s in stmts ]
+            for c in (child if isinstance(child, (list, tuple)) else [child]):
+                if isinstance(c, (Value, Statement)):
+                    stack.append(c)
+    return len(seen)
+
+# Report elaboration time and expression size of the DAC as the ladder grows
+def bench_dac_elaboration(max_resistors=6):
+    import time
+    results = []
+    for n in range(1, max_resistors + 1):
+        for precomputed in [False, True]:
+            resistors = [ 1e2 * 10**i for i in range(n) ]
+            start = time.perf_counter()
+            dut = DAC(delta_time=1.0/100e6, capacitor=1e-7, resistors=resistors,
+                      output_pwm=Signal(n), precomputed=precomputed)
+            fragment = Fragment.get(dut, None)
+            elapsed = time.perf_counter() - start
+            nodes = ast_node_count(fragment)
+            results.append((n, precomputed, elapsed, nodes))
+            print("dac n={} {:11s}: {:8.3f}s elaboration, {:7d} AST nodes".format(
+                n, "precomputed" if precomputed else "shared", elapsed, nodes))
+    return results
+
+# Check that both DAC engines follow the same v_out / pwm trajectory, as they
+# do with the exact search (no guard_bits)
+def sim_dac_engines(resistors=[1e2, 1e3, 1e5], latency=1, cycles=400):
+    period = 1.0/100e6
+    trajectories = []
+    for precomputed in [False, True]:
+        pwm = Signal(len(resistors))
+        dut = DAC(delta_time=period, capacitor=1e-7, resistors=resistors, output_pwm=pwm,
+                  latency=latency, precomputed=precomputed, guard_bits=None)
+        sim = Simulator(dut)
+        sim.add_clock(period, domain="sync")
+        trajectory = []
+
+        def sync_loop():
+            for i in range(cycles):
+                target = 0.2 if i < cycles // 2 else 0.8
+                yield dut.input.s.eq(dut.input.to_binary(target))
+                yield
+                trajectory.append(((yield dut.v_out.s), (yield pwm)))
+
+        sim.add_sync_process(sync_loop, domain="sync")
+        sim.run()
+        trajectories.append(trajectory)
+
+    assert trajectories[0] == trajectories[1], "precomputed DAC engine diverged"
+    print("dac: engines agree over {} cycles, v_out = {}".format(cycles, dut.v_out.compute_value(trajectories[1][-1][0])))
+
+# Step response from reset to target: returns (cycles until v_out stays within
+# tolerance of target, mean absolute error of v_out once settled)
+def sim_dac_settling(target=0.6, resistors=[1e2, 1e3, 1e5], cycles=1000, tolerance=1e-3):
+    period = 1.0/100e6
+    pwm = Signal(len(resistors))
+    dut = DAC(delta_time=period, capacitor=1e-7, resistors=resistors, output_pwm=pwm)
+    sim = Simulator(dut)
+    sim.add_clock(period, domain="sync")
+    v_out = []
+
+    def sync_loop():
+        yield dut.input.s.eq(dut.input.to_binary(target))
+        for i in range(cycles):
+            yield
+            v_out.append(dut.v_out.compute_value((yield dut.v_out.s)))
+
+    sim.add_sync_process(sync_loop, domain="sync")
+    sim.run()
+
+    errors = [ abs(v - target) for v in v_out ]
+    settled = next(i for i in range(cycles, 0, -1) if errors[i - 1] > tolerance)
+    assert settled < cycles, "dac did not settle within {} cycles".format(cycles)
+    error = sum(errors[settled:]) / (cycles - settled)
+    print("dac: settled to {} in {} cycles, mean error {:.2e}".format(target, settled, error))
+    return settled, error
+
 if __name__ == "__main__":
     from sem_board import OpenSemPlatform
     platform = OpenSemPlatform()
@@ -171,3 +364,6 @@ if __name__ == "__main__":
     os.makedirs("sim", exist_ok=True)
     with sim.write_vcd("sim/dac.vcd"):
         sim.run()
+
+    sim_dac_engines()
+    bench_dac_elaboration()
@@ -0,0 +1,210 @@
+import time
+import concurrent.futures
+import numpy as np
+
+# Bit exact NumPy model of DAC (dac.py), for sweeping capacitor / resistors /
+# frac_bits / latency. Cycles are stepped in Python, so a single DAC runs at
+# some 4e4 to 6e4 cycles/s (about 20x pysim's 2.4e3 on the same DAC); the gain
+# is from batching, as a batch of 64 steps at nearly the same rate, some 2e6
+# to 3e6 DAC cycles/s in all (bench_dac_model).
+#
+# All values are integers in the DAC's fixed point representation (frac_bits
+# fractional bits). Each update, with k_i the filter coefficients, the outcome
+# of every pwm option is evaluated exactly at 2*frac_bits:
+#   outcome = v_out * (2^f - sum_i k_i) + (sum_{i: pwm_i} k_i) << f
+# and the option with the smallest |outcome - input << f| is taken (the last on
+# ties, as argmin_tree). v_out then takes the outcome shifted down by f bits
+# (rounding to -inf) and wrapped to its 1+f bit signed width, as
+# SignalFixedPoint.eq does.
+#
+# With guard_bits g, outcomes are at f+g fractional bits, with the products of
+# v_out truncated (rounding to -inf) to that precision: each k_i * v_out for the
+# shared engine, or the single (2^f - sum_i k_i) * v_out for the precomputed one.
+
+def wrap_signed(x, bits):
+    half = 1 << (bits - 1)
+    return ((x + half) & ((1 << bits) - 1)) - half
+
+# Fixed point representation of a constant, as SignalFixedPoint(1, f, constant=c, signed=True)
+def fixed_rep(c, frac_bits):
+    return wrap_signed(round(c * 2**frac_bits), 1 + frac_bits)
+
+def pwm_options(n):
+    return np.array([ [ (x >> i) & 1 for i in range(n) ] for x in range(2**n) ], dtype=np.int64)
+
+# Simulates a batch of DACs which share the number of resistors, frac_bits, latency and guard_bits
+class DACModel:
+    def __init__(self, delta_time, capacitor, resistors, frac_bits=20, latency=1, guard_bits=None, precomputed=False):
+        resistors = np.atleast_2d(np.asarray(resistors, dtype=float))
+        batch, n = resistors.shape
+        delta_time = np.broadcast_to(np.asarray(delta_time, dtype=float), (batch,))
+        capacitor = np.broadcast_to(np.asarray(capacitor, dtype=float), (batch,))
+        assert 2 * frac_bits + n + 2 < 63, "model needs outcomes to fit in int64"
+
+        self.batch = batch
+        self.n = n
+        self.frac_bits = frac_bits
+        self.latency = latency
+        self.guard_bits = guard_bits
+        self.precomputed = precomputed
+        # Without guard bits outcomes keep all f fractional bits of the products
+        self.g = frac_bits if guard_bits is None else guard_bits
+        assert self.g <= frac_bits
+
+        # Per DAC coefficients, quantized exactly as the hardware constants are
+        self.k = np.array([ [ fixed_rep(latency * delta_time[b] / (capacitor[b] * resistors[b, i]), frac_bits)
+                              for i in range(n) ] for b in range(batch) ], dtype=np.int64)
+        self.options = pwm_options(n)
+        self.gain = (1 << frac_bits) - self.k.sum(axis=1)
+        self.offsets = (self.k @ self.options.T) << self.g
+
+    # Input representation for an array of values in [0,1] (floats), or representations (ints)
+    def input_rep(self, inputs):
+        inputs = np.asarray(inputs)
+        if np.issubdtype(inputs.dtype, np.integer):
+            return inputs.astype(np.int64)
+        return wrap_signed(np.round(inputs * 2**self.frac_bits).astype(np.int64), 1 + self.frac_bits)
+
+    # inputs: (cycles,) or (batch, cycles) values applied before each clock edge.
+    # Returns v_out (as representation) and pwm after each edge, each (batch, cycles).
+    def run(self, inputs):
+        f = self.frac_bits
+        g = self.g
+        L = self.latency
+        inputs = np.broadcast_to(self.input_rep(inputs), (self.batch, np.shape(inputs)[-1]))
+        cycles = inputs.shape[1]
+
+        v = np.full(self.batch, 1 << (f - 1), dtype=np.int64)
+        pwm = np.zeros(self.batch, dtype=np.int64)
+        held = np.zeros(self.batch, dtype=np.int64)
+        rows = np.arange(self.batch)
+        last = len(self.options) - 1
+
+        # Compact outputs, as sweeps ship them back between processes
+        v_out = np.empty((self.batch, cycles), dtype=np.int32 if f < 31 else np.int64)
+        pwm_out = np.empty((self.batch, cycles), dtype=np.uint8 if self.n <= 8 else np.uint16)
+
+        # Only every L'th edge changes anything
+        for t in range(L - 1, cycles, L):
+            target = inputs[:, t] if L == 1 else held
+            if self.precomputed:
+                decayed = (v * self.gain) >> (f - g)
+            else:
+                decayed = (v << g) - ((self.k * v[:, None]) >> (f - g)).sum(axis=1)
+            outcome = decayed[:, None] + self.offsets
+            error = np.abs(outcome - (target << g)[:, None])
+            best = last - np.argmin(error[:, ::-1], axis=1)
+            v_next = wrap_signed(outcome[rows, best] >> g, 1 + f)
+
+            start = t - L + 1
+            v_out[:, start:t] = v[:, None]
+            pwm_out[:, start:t] = pwm[:, None]
+            v, pwm = v_next, best
+            v_out[:, t] = v
+            pwm_out[:, t] = pwm
+            if L > 1:
+                held = inputs[:, t]
+
+        tail = cycles - (cycles % L if L > 1 else 0)
+        v_out[:, tail:] = v[:, None]
+        pwm_out[:, tail:] = pwm[:, None]
+        return v_out, pwm_out
+
+    def to_float(self, rep):
+        return rep / 2**self.frac_bits
+
+def _run_batch(args):
+    params, inputs = args
+    model = DACModel(
+        [ p["delta_time"] for p in params ],
+        [ p["capacitor"] for p in params ],
+        [ p["resistors"] for p in params ],
+        params[0].get("frac_bits", 20), params[0].get("latency", 1),
+        params[0].get("guard_bits"), params[0].get("precomputed", False))
+    return model.run(inputs)
+
+# Run the model for a list of parameter sets (dicts of DACModel arguments, one
+# resistor list each) across a process pool. Parameter sets are batched together
+# where they share the number of resistors, frac_bits, latency and guard_bits.
+# Returns a (v_out, pwm) pair per parameter set, in order.
+def sweep(param_sets, inputs, processes=None, batch_size=64):
+    groups = {}
+    for i, p in enumerate(param_sets):
+        key = (len(p["resistors"]), p.get("frac_bits", 20), p.get("latency", 1), p.get("guard_bits"), p.get("precomputed", False))
+        groups.setdefault(key, []).append(i)
+
+    jobs = []
+    for indices in groups.values():
+        for b in range(0, len(indices), batch_size):
+            jobs.append(indices[b:b+batch_size])
+
+    results = [ None ] * len(param_sets)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        batches = pool.map(_run_batch, [ ([ param_sets[i] for i in job ], inputs) for job in jobs ])
+        for job, (v_out, pwm) in zip(jobs, batches):
+            for row, i in enumerate(job):
+                results[i] = (v_out[row], pwm[row])
+    return results
+
+# Compare the model against the HDL simulator cycle by cycle on a short run
+def check_dac_model(resistors=[1e2, 1e3, 1e5], capacitor=1e-7, frac_bits=20, latency=1, precomputed=False, guard_bits=None, dsp_latency=None, cycles=300):
+    from amaranth import Signal
+    from amaranth.sim import Settle
+    from simulation import Simulator
+    from dac import DAC
+
+    period = 1.0/100e6
+    inputs = np.where(np.arange(cycles) < cycles // 2, 0.2, 0.8)
+
+    pwm = Signal(len(resistors))
+    dut = DAC(delta_time=period, capacitor=capacitor, resistors=resistors, output_pwm=pwm,
+              frac_bits=frac_bits, latency=latency, precomputed=precomputed, guard_bits=guard_bits, dsp_latency=dsp_latency)
+    model = DACModel(period, capacitor, resistors, frac_bits, latency, guard_bits, precomputed)
+    reps = model.input_rep(inputs)
+
+    sim = Simulator(dut)
+    sim.add_clock(period, domain="sync")
+    hdl = []
+    def sync_loop():
+        for t in range(cycles):
+            yield dut.input.s.eq(int(reps[t]))
+            yield
+            yield Settle()
+            hdl.append(((yield dut.v_out.s), (yield pwm)))
+    sim.add_sync_process(sync_loop, domain="sync")
+    sim.run()
+
+    # The first clock edge comes before the testbench's first write, with input at reset
+    v_out, pwm_out = model.run(np.concatenate([[0], reps]))
+    expected = list(zip(v_out[0, 1:].tolist(), pwm_out[0, 1:].tolist()))
+    mismatch = [ t for t in range(cycles) if hdl[t] != expected[t] ]
+    assert not mismatch, "model diverges from HDL at cycle {}: {} != {}".format(mismatch[0], expected[mismatch[0]], hdl[mismatch[0]])
+    print("dac_model: matches HDL for {} cycles (resistors={}, frac_bits={}, latency={}, precomputed={}, guard_bits={}, dsp_latency={})".format(
+        cycles, resistors, frac_bits, latency, precomputed, guard_bits, dsp_latency))
+
+# Cycles per second of the model over a sweep of capacitor values
+def bench_dac_model(cycles=100000, batch=64, processes=None):
+    inputs = 0.5 + 0.4 * np.sin(np.arange(cycles) * 2e-4)
+    params = [ dict(delta_time=1e-8, capacitor=c, resistors=[1e2, 1e3, 1e5]) for c in np.geomspace(1e-8, 1e-6, batch) ]
+
+    for group in [ params[:1], params ]:
+        start = time.perf_counter()
+        DACModel(1e-8, [p["capacitor"] for p in group], [p["resistors"] for p in group]).run(inputs)
+        elapsed = time.perf_counter() - start
+        print("dac_model: {:.3g} cycles/s per DAC, {:.2f}M in all ({} DACs x {} cycles, one process)".format(
+            cycles / elapsed, len(group) * cycles / elapsed / 1e6, len(group), cycles))
+
+    start = time.perf_counter()
+    sweep(params * 4, inputs, processes, batch_size=batch)
+    elapsed = time.perf_counter() - start
+    print("dac_model: {:.2f}M cycles/s ({} DACs x {} cycles, process pool)".format(4 * batch * cycles / elapsed / 1e6, 4 * batch, cycles))
+
+if __name__ == "__main__":
+    check_dac_model()
+    check_dac_model(resistors=[1e2, 1e5], latency=3)
+    check_dac_model(resistors=[3e2, 1e4], frac_bits=14, precomputed=True)
+    check_dac_model(guard_bits=4)
+    check_dac_model(guard_bits=3, precomputed=True, latency=2)
+    check_dac_model(latency=5, dsp_latency=3)
+    check_dac_model(latency=4, dsp_latency=3, precomputed=True, guard_bits=4)
+    bench_dac_model()
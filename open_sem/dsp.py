@@ -0,0 +1,233 @@
+import os
+from amaranth import *
+from simulation import Simulator
+from fixed_point import *
+
+# Pipelined multipliers written in the shape Vivado maps onto a DSP48E1:
+#
+#   a ──[AREG]──┐
+#               (x)──[MREG]──(+)──[PREG]── p
+#   b ──[BREG]──┘             │
+#   c ──────────[delay]───────┘  (or p itself when accumulating)
+#
+# The latency (cycles from a/b to p) picks which registers exist, in the order
+# Vivado most relies on them for timing: P, then M, then A/B, then a second
+# A/B stage (AREG=BREG=2). With all three of A/B, M and P the multiply closes
+# well above 200 MHz. A single DSP48E1 multiplies 25 x 18 bits signed; wider
+# operands are split over several DSPs by Vivado (with lower fmax).
+DSP_MAX_LATENCY = 4
+
+# (number of A/B registers, M register, P register) for a latency
+def dsp_registers(latency : int):
+    assert 0 <= latency <= DSP_MAX_LATENCY, "latency must be in [0, {}]".format(DSP_MAX_LATENCY)
+    regs = ["p", "m", "ab", "ab"][:latency]
+    return regs.count("ab"), "m" in regs, "p" in regs
+
+# Pipeline register for a value or fixed point value. DSP48 registers have no
+# need of a reset, and leaving it out helps Vivado pack them into the DSP.
+def register(m : Module, x, name : str):
+    if isinstance(x, SignalFixedPoint):
+        r = SignalFixedPoint(value=Signal(x.s.shape(), name=name, reset_less=True), frac_bits=x.qf)
+        m.d.sync += r.s.eq(x.s)
+    else:
+        r = Signal(x.shape(), name=name, reset_less=True)
+        m.d.sync += r.eq(x)
+    return r
+
+def delay(m : Module, x, cycles : int, name : str):
+    for i in range(cycles):
+        x = register(m, x, "{}_d{}".format(name, i))
+    return x
+
+# Fixed point signal with the shape and fractional bits of template
+def fixed_point_like(template : SignalFixedPoint, name : str, **kwargs):
+    return SignalFixedPoint(value=Signal(template.s.shape(), name=name, **kwargs), frac_bits=template.qf)
+
+# p = a * b + c, pipelined over latency cycles.
+#
+# a, b and c are templates giving the shape and fractional bits of the inputs,
+# which are the new signals self.a, self.b and self.c (c=None for no post-adder
+# input).
+#   cascade=False : c is presented in the same cycle as a and b (it is delayed
+#                   internally to meet the product, like the C register).
+#   cascade=True  : c goes straight to the post-adder, like PCIN, and must be
+#                   presented c_offset cycles after a and b. This is how the
+#                   p of one MAC chains into the next (see dot_product).
+#   accumulator   : p = a * b + (accumulate ? p : c), where accumulate is
+#                   presented alongside a and b. p wraps at p_bits (48 by
+#                   default, as DSP48E1's P). Needs the P register.
+class PipelinedMAC(Elaboratable):
+    def __init__(self,
+            a : SignalFixedPoint,
+            b : SignalFixedPoint,
+            c : SignalFixedPoint = None,
+            latency : int = 3,
+            cascade : bool = False,
+            accumulator : bool = False,
+            p_bits : int = None,
+            ):
+        self.latency = latency
+        self.ab_regs, self.m_reg, self.p_reg = dsp_registers(latency)
+        self.cascade = cascade
+        self.accumulator = accumulator
+        assert not accumulator or self.p_reg, "accumulating needs the P register (latency >= 1)"
+        self.c_offset = self.ab_regs + self.m_reg if cascade else 0
+
+        # In
+        self.a = fixed_point_like(a, "a")
+        self.b = fixed_point_like(b, "b")
+        self.c = None if c is None else fixed_point_like(c, "c")
+        self.accumulate = Signal()
+
+        # Out
+        full = self.a * self.b
+        if c is not None:
+            full = full + self.c
+        if accumulator and p_bits is None:
+            p_bits = 48
+        shape = full.s.shape() if p_bits is None else signed(p_bits)
+        self.p = SignalFixedPoint(value=Signal(shape, name="p", attrs={"use_dsp": "yes"}), frac_bits=full.qf)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        a = delay(m, self.a, self.ab_regs, "areg")
+        b = delay(m, self.b, self.ab_regs, "breg")
+        product = a * b
+        if self.m_reg:
+            product = register(m, product, "mreg")
+
+        total = product
+        if self.c is not None:
+            c = self.c if self.cascade else delay(m, self.c, self.ab_regs + self.m_reg, "creg")
+            total = total + c
+
+        if self.accumulator:
+            accumulate = delay(m, self.accumulate, self.ab_regs + self.m_reg, "accumulate")
+            p = fixed_point_like(self.p, "preg", reset_less=True)
+            with m.If(accumulate):
+                m.d.sync += p.eq(product + p)
+            with m.Else():
+                m.d.sync += p.eq(total)
+            m.d.comb += self.p.eq(p)
+        elif self.p_reg:
+            p = fixed_point_like(self.p, "preg", reset_less=True)
+            m.d.sync += p.eq(total)
+            m.d.comb += self.p.eq(p)
+        else:
+            m.d.comb += self.p.eq(total)
+
+        return m
+
+# p = a * b, pipelined over latency cycles
+class PipelinedMultiply(PipelinedMAC):
+    def __init__(self, a : SignalFixedPoint, b : SignalFixedPoint, latency : int = 3):
+        super().__init__(a, b, None, latency)
+
+# Sum of a_i * b_i as a chain of MACs, each adding its product to the previous
+# one's p through the post-adder (a DSP48 PCOUT -> PCIN cascade, so no fabric
+# adders). All pairs are presented in the same cycle: later pairs are delayed
+# here to meet the cascade. Returns the sum and its latency.
+def dot_product(m : Module, pairs : list, latency : int = 3, name : str = "dot"):
+    p = None
+    input_delay = 0
+    for i, (a, b) in enumerate(pairs):
+        mac = PipelinedMAC(a, b, p, latency, cascade=True)
+        m.submodules["{}_mac{}".format(name, i)] = mac
+        m.d.comb += [
+            mac.a.eq(delay(m, a, input_delay, "{}_a{}".format(name, i))),
+            mac.b.eq(delay(m, b, input_delay, "{}_b{}".format(name, i))),
+        ]
+        if p is not None:
+            m.d.comb += mac.c.eq(p)
+        p = mac.p
+        input_delay += mac.p_reg
+    return p, input_delay - mac.p_reg + latency
+
+def sim_dsp_1(vectors=64):
+    import numpy as np
+    rng = np.random.default_rng(2)
+
+    a_t = SignalFixedPoint(4, 12, signed=True)
+    b_t = SignalFixedPoint(2, 16, signed=True)
+    c_t = SignalFixedPoint(6, 10, signed=True)
+
+    class TopTest(Elaboratable):
+        def __init__(self):
+            self.a = [ fixed_point_like(a_t, "in_a{}".format(i)) for i in range(3) ]
+            self.b = [ fixed_point_like(b_t, "in_b{}".format(i)) for i in range(3) ]
+            self.c = fixed_point_like(c_t, "in_c")
+            self.accumulate = Signal()
+            self.multiplies = [ PipelinedMultiply(a_t, b_t, latency) for latency in range(DSP_MAX_LATENCY + 1) ]
+            self.mac = PipelinedMAC(a_t, b_t, c_t, latency=3)
+            self.acc = PipelinedMAC(a_t, b_t, c_t, latency=3, accumulator=True)
+
+        def elaborate(self, platform):
+            m = Module()
+            for i, mul in enumerate(self.multiplies):
+                m.submodules["mul{}".format(i)] = mul
+                m.d.comb += [ mul.a.eq(self.a[0]), mul.b.eq(self.b[0]) ]
+            for name, mac in [("mac", self.mac), ("acc", self.acc)]:
+                m.submodules[name] = mac
+                m.d.comb += [ mac.a.eq(self.a[0]), mac.b.eq(self.b[0]), mac.c.eq(self.c) ]
+            m.d.comb += self.acc.accumulate.eq(self.accumulate)
+            self.dot, self.dot_latency = dot_product(m, list(zip(self.a, self.b)), latency=3)
+            return m
+
+    dut = TopTest()
+    fragment = Fragment.get(dut, None)
+
+    a = rng.integers(-2**15, 2**15, (3, vectors))
+    b = rng.integers(-2**17, 2**17, (3, vectors))
+    c = rng.integers(-2**15, 2**15, vectors)
+    accumulate = rng.integers(0, 2, vectors)
+
+    # Expected outputs for each input cycle (products at 28 fractional bits, c at 10)
+    product = a[0] * b[0]
+    mac = product + (c << 18)
+    acc = []
+    for t in range(vectors):
+        acc.append(product[t] + (acc[-1] if accumulate[t] and acc else (c[t] << 18)))
+    dot = (a * b).sum(axis=0)
+
+    sim = Simulator(fragment)
+    sim.add_clock(1.0 / 100e6, domain="sync")
+    outputs = { "mul{}".format(i): [] for i in range(DSP_MAX_LATENCY + 1) }
+    outputs.update(mac=[], acc=[], dot=[])
+
+    def process():
+        for t in range(vectors + 8):
+            if t < vectors:
+                for i in range(3):
+                    yield dut.a[i].s.eq(int(a[i, t]))
+                    yield dut.b[i].s.eq(int(b[i, t]))
+                yield dut.c.s.eq(int(c[t]))
+                yield dut.accumulate.eq(int(accumulate[t]) and t > 0)
+            yield
+            yield Settle()
+            for i, mul in enumerate(dut.multiplies):
+                outputs["mul{}".format(i)].append((yield mul.p.s))
+            outputs["mac"].append((yield dut.mac.p.s))
+            outputs["acc"].append((yield dut.acc.p.s))
+            outputs["dot"].append((yield dut.dot.s))
+
+    sim.add_sync_process(process, domain="sync")
+    os.makedirs("sim", exist_ok=True)
+    with sim.write_vcd("sim/dsp_1.vcd"):
+        sim.run()
+
+    # Outputs are read (settled) after the edge which takes the inputs, so latency
+    # L shows at index L - 1, and combinational outputs at index 0
+    def check(name, expected, latency):
+        got = outputs[name][max(latency - 1, 0):][:vectors]
+        assert list(got) == list(expected), "{} differs".format(name)
+
+    for i in range(DSP_MAX_LATENCY + 1):
+        check("mul{}".format(i), product, i)
+    check("mac", mac, dut.mac.latency)
+    check("acc", acc, dut.acc.latency)
+    check("dot", dot, dut.dot_latency)
+    print("dsp: multiplies, MAC, accumulator and dot product (latency {}) ok".format(dut.dot_latency))
+
+if __name__ == "__main__":
+    sim_dsp_1()
@@ -1,6 +1,9 @@
+import time
+import numpy as np
 from argparse import ArgumentError
 from amaranth import *
 from amaranth.sim import *
+from simulation import Simulator
 from black import target_version_option_callback
 
 # Example of multiplication with truncation of fractional LSB's
@@ -12,6 +15,22 @@ from black import target_version_option_callback
 #    c.eq(a.mul(b))
 # ]
 
+ROUNDING = ("truncate", "nearest")
+OVERFLOW = ("wrap", "saturate")
+
+# Smallest and largest representations in shape
+def shape_range(shape : Shape):
+    if shape.signed:
+        return -(1 << (shape.width - 1)), (1 << (shape.width - 1)) - 1
+    return 0, (1 << shape.width) - 1
+
+# Narrowest shape of the given signedness holding the representation v
+def min_shape(v : int, signed : bool):
+    if signed:
+        return Shape(max(v.bit_length(), (-v - 1).bit_length()) + 1, True)
+    assert v >= 0
+    return Shape(v.bit_length(), False)
+
 class SignalFixedPoint:
     # int_bits / frac_bits can also be negative to shift decimal outside of represented digits
     def __init__(
@@ -103,9 +122,39 @@ class SignalFixedPoint:
     def __neg__(self):
         return SignalFixedPoint( value = -self.s, frac_bits=self.qf)
     
-    def eq(self, rhs : "SignalFixedPoint" ):
-        self_extra_qf = self.qf - rhs.qf
-        return self.s.eq( rhs.s.shift_left(self_extra_qf) )
+    def eq(self, rhs : "SignalFixedPoint", rounding="truncate", overflow="wrap"):
+        if rounding == "truncate" and overflow == "wrap":
+            self_extra_qf = self.qf - rhs.qf
+            return self.s.eq( rhs.s.shift_left(self_extra_qf) )
+        return self.s.eq( rhs.resize(self.int_bits(), self.qf, rounding, overflow).s )
+
+    # Change precision to int_bits + frac_bits, keeping signedness.
+    #   rounding : "truncate" (towards -inf) or "nearest" (half up) for dropped fractional bits
+    #   overflow : "wrap" (drop high bits) or "saturate" (clamp to the representable range)
+    # The result is at most int_bits + frac_bits wide (narrower if the value already fits)
+    def resize(self, int_bits : int, frac_bits : int, rounding="truncate", overflow="wrap"):
+        assert rounding in ROUNDING and overflow in OVERFLOW
+        shape = Shape(int_bits + frac_bits, self.s.shape().signed)
+        drop = self.qf - frac_bits
+        s = self.s
+        if drop > 0 and rounding == "nearest":
+            s = s + (1 << (drop - 1))
+        s = s.shift_left(-drop)
+        if overflow == "saturate":
+            lo, hi = shape_range(shape)
+            s = Mux(s > hi, hi, Mux(s < lo, lo, s))
+        if s.shape().width > shape.width:
+            s = s[:shape.width].as_signed() if shape.signed else s[:shape.width]
+        return SignalFixedPoint(value=s, frac_bits=frac_bits)
+
+    # Constant with the narrowest shape holding its value, so that expressions
+    # using it (and their widths) shrink accordingly
+    def trim(self):
+        assert isinstance(self.s, Const)
+        return SignalFixedPoint(value=Const(self.s.value, min_shape(self.s.value, self.s.shape().signed)), frac_bits=self.qf)
+
+    def int_bits(self):
+        return self.s.shape().width - self.qf
 
     def lsb_value(self):
         return 1.0 / 2**self.qf
@@ -121,6 +170,166 @@ class SignalFixedPoint:
     def value_rep(self):
         return self.s.value
     
+# Wrap an integer representation (Python int or int64 array) into shape, as
+# Amaranth truncates on assignment and on constant creation
+def wrap_rep(x, shape : Shape):
+    if shape.width == 0:
+        return x * 0
+    if isinstance(x, np.ndarray) and shape.width >= 64:
+        # int64 arithmetic is already modulo 2^64
+        return x
+    mask = (1 << shape.width) - 1
+    if shape.signed:
+        half = 1 << (shape.width - 1)
+        return ((x + half) & mask) - half
+    return x & mask
+
+# Software evaluation of SignalFixedPoint expressions, bit exact with the
+# hardware. The representation s is a Python int or a NumPy int64 array (for
+# evaluating a whole vector of inputs at once), and shape tracks the Amaranth
+# shape the same expression would have: operators follow Amaranth's width rules
+# exactly (so never overflow), and eq() truncates to the target like an Assign.
+class SoftFixedPoint:
+    def __init__(
+        self,
+        int_bits : int = None,
+        frac_bits : int = 0,
+        constant=None,
+        signed=None,
+        *, value=None, shape : Shape = None,
+    ):
+        assert(frac_bits is not None)
+        self.qf = frac_bits
+
+        if value is None:
+            assert(int_bits is not None)
+
+            if constant is None:
+                if signed is None:
+                    signed = False
+                self.shape = Shape(int_bits + frac_bits, signed)
+                self.s = 0
+            elif isinstance(constant, float):
+                if signed is None:
+                    signed = constant < 0
+                elif signed == False and constant < 0:
+                    raise ArgumentError(None, "Specified unsigned type for signed constant")
+                self.shape = Shape(int_bits + frac_bits, signed)
+                self.s = wrap_rep(self.to_binary(constant), self.shape)
+            else:
+                assert(False)
+        else:
+            assert(constant is None)
+            if shape is None:
+                assert(int_bits is not None)
+                shape = Shape(int_bits + frac_bits, bool(signed))
+            self.shape = shape
+            self.s = value.astype(np.int64) if isinstance(value, np.ndarray) else value
+            if isinstance(self.s, np.ndarray):
+                assert shape.width <= (64 if shape.signed else 63), "shape too wide to evaluate with int64"
+
+    # Software twin of a SignalFixedPoint, holding representation value
+    @staticmethod
+    def like(fp : SignalFixedPoint, value=0):
+        shape = fp.s.shape()
+        return SoftFixedPoint(value=wrap_rep(value, shape), frac_bits=fp.qf, shape=shape)
+
+    def to_binary(self, v : float):
+        return round(v / self.lsb_value())
+
+    # (representation, shape, frac bits) of an operand. Plain ints act as Amaranth Const's
+    @staticmethod
+    def _operand(x):
+        if isinstance(x, SoftFixedPoint):
+            return x.s, x.shape, x.qf
+        elif isinstance(x, (int, np.integer)):
+            x = int(x)
+            return x, Const(x).shape(), 0
+        else:
+            raise ArgumentError(None, "rhs not valid type")
+
+    @staticmethod
+    def _shift_left(s, shape, amount):
+        shape = Const(0, shape).shift_left(amount).shape()
+        return (s << amount if amount >= 0 else s >> -amount), shape
+
+    # Bring both operands to the larger number of fractional bits, as SignalFixedPoint does
+    def _align(self, rhs):
+        a, a_shape, a_qf = self._operand(self)
+        b, b_shape, b_qf = self._operand(rhs)
+        if a_qf >= b_qf:
+            b, b_shape = self._shift_left(b, b_shape, a_qf - b_qf)
+        else:
+            a, a_shape = self._shift_left(a, a_shape, b_qf - a_qf)
+        return a, a_shape, b, b_shape, max(a_qf, b_qf)
+
+    def __mul__(self, rhs):
+        b, b_shape, b_qf = self._operand(rhs)
+        shape = (Const(0, self.shape) * Const(0, b_shape)).shape()
+        return SoftFixedPoint(value=self.s * b, frac_bits=self.qf + b_qf, shape=shape)
+
+    def __rmul__(self, rhs):
+        # Commutative
+        return self.__mul__(rhs)
+
+    def __add__(self, rhs):
+        a, a_shape, b, b_shape, qf = self._align(rhs)
+        return SoftFixedPoint(value=a + b, frac_bits=qf, shape=(Const(0, a_shape) + Const(0, b_shape)).shape())
+
+    def __radd__(self, rhs):
+        # Commutative
+        return self.__add__(rhs)
+
+    def __sub__(self, rhs):
+        a, a_shape, b, b_shape, qf = self._align(rhs)
+        return SoftFixedPoint(value=a - b, frac_bits=qf, shape=(Const(0, a_shape) - Const(0, b_shape)).shape())
+
+    def __neg__(self):
+        return SoftFixedPoint(value=-self.s, frac_bits=self.qf, shape=(-Const(0, self.shape)).shape())
+
+    # Assign (in place), truncating to this value's shape. Returns self for chaining
+    def eq(self, rhs : "SoftFixedPoint", rounding="truncate", overflow="wrap"):
+        if rounding != "truncate" or overflow != "wrap":
+            rhs = rhs.resize(self.int_bits(), self.qf, rounding, overflow)
+        s, _ = self._shift_left(rhs.s, rhs.shape, self.qf - rhs.qf)
+        self.s = wrap_rep(s, self.shape)
+        return self
+
+    # As SignalFixedPoint.resize
+    def resize(self, int_bits : int, frac_bits : int, rounding="truncate", overflow="wrap"):
+        # The resulting shape is whatever the hardware would build
+        shape = SignalFixedPoint(value=Const(0, self.shape), frac_bits=self.qf).resize(int_bits, frac_bits, rounding, overflow).s.shape()
+        target = Shape(int_bits + frac_bits, self.shape.signed)
+        drop = self.qf - frac_bits
+        s = self.s
+        if drop > 0 and rounding == "nearest":
+            s = s + (1 << (drop - 1))
+        s = s >> drop if drop >= 0 else s << -drop
+        if overflow == "saturate":
+            lo, hi = shape_range(target)
+            s = np.clip(s, lo, hi) if isinstance(s, np.ndarray) else min(max(s, lo), hi)
+        return SoftFixedPoint(value=wrap_rep(s, shape), frac_bits=frac_bits, shape=shape)
+
+    def trim(self):
+        assert not isinstance(self.s, np.ndarray)
+        return SoftFixedPoint(value=self.s, frac_bits=self.qf, shape=min_shape(self.s, self.shape.signed))
+
+    def int_bits(self):
+        return self.shape.width - self.qf
+
+    def lsb_value(self):
+        return 1.0 / 2**self.qf
+
+    def value(self):
+        return self.value_rep() * self.lsb_value()
+
+    def compute_value(self, s):
+        return s * self.lsb_value()
+
+    # Internal integer representation
+    def value_rep(self):
+        return self.s
+
 def do_sim():
     class TopTest(Elaboratable):
         def __init__(self):
@@ -175,6 +384,75 @@ def do_sim():
     with sim.write_vcd("sim/fixed_point.vcd"):
         sim.run()
 
+# Check SoftFixedPoint against the simulator on random inputs, for a mix of
+# signed / unsigned operands and fractional bits
+def sim_soft_fixed_point_1(vectors=200):
+    class TopTest(Elaboratable):
+        def __init__(self):
+            self.a = SignalFixedPoint(4,12, signed=True)
+            self.b = SignalFixedPoint(3,16)
+            self.c = SignalFixedPoint(8,8, signed=True)
+            self.k = SignalFixedPoint(0,20, constant = 0.3)
+            self.d = C(9)
+            self.outputs = [ SignalFixedPoint(16,16, signed=True) for _ in range(7) ] + [ SignalFixedPoint(6,4) ] \
+                         + [ SignalFixedPoint(16,16, signed=True) for _ in range(4) ] + [ SignalFixedPoint(2,6, signed=True) ]
+            # (rounding, overflow) for eq of each output
+            self.eq_options = [ ("truncate", "wrap") ] * 12 + [ ("nearest", "saturate") ]
+
+        def expressions(self, a, b, c, k, d):
+            return [
+                a * b,
+                a + b,
+                k * c,
+                a - c,
+                b * d,
+                k + b * d - c,
+                -b,
+                a * c + k,
+                (a * b).resize(4, 10, "nearest", "saturate"),
+                (a - c).resize(2, 6, "truncate", "saturate"),
+                (k * c).resize(3, 12, "nearest", "wrap"),
+                k.trim() * b.resize(1, 20),
+                a * c,
+            ]
+
+        def elaborate(self, platform):
+            m = Module()
+            for o, e, opts in zip(self.outputs, self.expressions(self.a, self.b, self.c, self.k, self.d), self.eq_options):
+                m.d.comb += o.eq(e, *opts)
+            return m
+
+    dut = TopTest()
+    rng = np.random.default_rng(1)
+    reps = [ rng.integers(-2**15, 2**15, vectors), rng.integers(0, 2**19, vectors), rng.integers(-2**15, 2**15, vectors) ]
+
+    start = time.perf_counter()
+    a, b, c = [ SoftFixedPoint.like(fp, r) for fp, r in zip([dut.a, dut.b, dut.c], reps) ]
+    k = SoftFixedPoint(0,20, constant = 0.3)
+    expected = [ SoftFixedPoint.like(o).eq(e, *opts).s for o, e, opts in zip(dut.outputs, dut.expressions(a, b, c, k, 9), dut.eq_options) ]
+    elapsed = time.perf_counter() - start
+
+    sim = Simulator(dut)
+    got = []
+    def process():
+        for i in range(vectors):
+            yield dut.a.s.eq(int(reps[0][i]))
+            yield dut.b.s.eq(int(reps[1][i]))
+            yield dut.c.s.eq(int(reps[2][i]))
+            yield Settle()
+            row = []
+            for o in dut.outputs:
+                row.append((yield o.s))
+            got.append(row)
+    sim.add_process(process)
+    sim.run()
+
+    got = np.array(got).T
+    for i, (g, e) in enumerate(zip(got, expected)):
+        assert np.array_equal(g, e), "output {} differs".format(i)
+    print("fixed_point: SoftFixedPoint matches simulator on {} vectors ({:.0f}us to evaluate)".format(vectors, elapsed * 1e6))
+
 if __name__ == "__main__":
+    sim_soft_fixed_point_1()
     do_sim()
     
\ No newline at end of file
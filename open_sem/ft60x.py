@@ -1,6 +1,7 @@
 import os
 from amaranth import *
-from amaranth.sim import Simulator, Delay, Settle
+from amaranth.sim import Delay, Settle
+from simulation import Simulator
 from amaranth.lib.fifo import *
 
 # Interface with FTDI FT600 and FT601 USB 3.0 Controller devices in Synchronous 245 mode
@@ -26,6 +27,12 @@ class FT60X_Sync245(Elaboratable):
         self.fifo_from_f60x = AsyncFIFOBuffered(width=self.fifo_width, depth=self.fifo_depth_from_ft60x, r_domain=clk, w_domain="ftdi")    
         self.fifo_to_f60x   = AsyncFIFOBuffered(width=self.fifo_width, depth=self.fifo_depth_to_ft60x, r_domain="ftdi", w_domain=clk)
 
+        # Out (ftdi domain): a word pushed to / pulled from the ft60x, and a
+        # cycle spent waiting on txe with uplink data to push (see telemetry.py)
+        self.pushed    = Signal()
+        self.pulled    = Signal()
+        self.txe_stall = Signal()
+
     def elaborate(self, platform):
         m = Module()
         
@@ -45,72 +52,58 @@ class FT60X_Sync245(Elaboratable):
             m.submodules.fifo_from_f60x.w_data.eq( Cat(self.ftdi.data.i, self.ftdi.be.i) ),
             Cat(self.ftdi.data.o, self.ftdi.be.o).eq(m.submodules.fifo_to_f60x.r_data),
             
-            # Tristate set to output only when ft_wr is high
-            self.ftdi.data.oe.eq(self.ftdi.wr),
-            self.ftdi.be.oe.eq(self.ftdi.wr),
-            self.ftdi.oe.eq(~self.ftdi.wr),
-            
             # can push / pull when data is available and we have somewhere to put it
             can_pull.eq(self.ftdi.rxf & self.fifo_from_f60x.w_rdy),
             can_push.eq(self.ftdi.txe & self.fifo_to_f60x.r_rdy),
+
+            self.pushed.eq(self.fifo_to_f60x.r_en),
+            self.pulled.eq(self.fifo_from_f60x.w_en),
+            self.txe_stall.eq(self.ftdi.wr & ~self.ftdi.txe),
         ]
         
+        # The FT60x presents a word to us (PULL) or accepts a word from us (PUSH)
+        # on every ftdi clock edge where its strobe (rd / wr) and flag (rxf / txe)
+        # are both asserted. To sustain one word per cycle, the fifo strobes are
+        # driven combinationally from the FT60x flags: AsyncFIFOBuffered already
+        # presents the head of the queue on r_data whilst r_rdy is high, so we can
+        # look ahead at it and pop in the same cycle that the FT60x takes it.
+        # Bus turnaround costs one cycle in each direction so that the FPGA and
+        # the FT60x never drive the data bus together.
         with m.FSM(domain="ftdi") as fsm:
-            with m.State("IDLE"):
-                # no fifo reads or writes should be triggered next cycle in ftdi domain
-                m.d.ftdi += [
-                    m.submodules.fifo_from_f60x.w_en.eq(0),
-                    m.submodules.fifo_to_f60x.r_en.eq(0)
-                ]
-                
-                # # Prioritize reading if ft60x has data and our read fifo isn't full
-                # with m.If(can_pull):                    
-                #     m.d.ftdi += [
-                #         # Let ft60x control bus, request read from ft60x
-                #         self.ftdi.rd.eq(1),
-                #         self.ftdi.wr.eq(0)
-                #     ]
-                #     m.next = "PULL"
-                    
-                # Otherwise we start writing if the ft60x isn't full and the fpga has data
-                # with m.Elif(can_push):
-                with m.If(can_push):
-                    m.d.ftdi += [
-                        # Let fpga control bus, request write from ft60x
-                        self.ftdi.rd.eq(0),
-                        self.ftdi.wr.eq(1),
-                    ]
-                    m.next = "PUSH"
-
-            # with m.State("PULL"):
-            #     # on the current rising edge, ft_rd=1 and ft60x has presented data
-                
-            #     m.d.ftdi += [
-            #         # trigger fifo.push next cycle
-            #         m.submodules.fifo_from_f60x.w_en.eq(1)
-            #     ]
-
-            #     # TODO: optimize to avoid IDLE if PUSH is possible
-            #     with m.If(~can_pull):                    
-            #         m.next = "IDLE"
-            #         m.d.ftdi += [ self.ftdi.rd.eq(0)]
-            
             with m.State("PUSH"):
-                # on the current rising edge, ft_wr=1 and ft60x latched data from fifo
+                # FPGA owns the bus. Keep ft_wr asserted for as long as we have
+                # data so that bursts run back to back, bounded only by txe.
+                m.d.comb += [
+                    self.ftdi.data.oe.eq(1),
+                    self.ftdi.be.oe.eq(1),
+                    self.ftdi.wr.eq(self.fifo_to_f60x.r_rdy),
+                    self.fifo_to_f60x.r_en.eq(can_push),
+                ]
+
+                # Prioritize reading if ft60x has data and our read fifo isn't full
+                with m.If(can_pull):
+                    m.next = "PULL_TURNAROUND"
 
-                m.d.ftdi += [
-                    # trigger fifo.pop next cycle
-                    m.submodules.fifo_to_f60x.r_en.eq(1)
+            with m.State("PULL_TURNAROUND"):
+                # Release the bus and let the ft60x start driving it
+                m.d.comb += self.ftdi.oe.eq(1)
+                m.next = "PULL"
+
+            with m.State("PULL"):
+                # ft60x owns the bus and presents a new word each cycle rd & rxf
+                m.d.comb += [
+                    self.ftdi.oe.eq(1),
+                    self.ftdi.rd.eq(self.fifo_from_f60x.w_rdy),
+                    self.fifo_from_f60x.w_en.eq(can_pull),
                 ]
-                
-                # Prioritize pulls if possible
-                # TODO: optimize to avoid IDLE if PULL is possible
-                # with m.If(~can_push | can_pull):                    
-                with m.If(~can_push):                    
-                    m.next = "IDLE"
-                    m.d.ftdi += [ self.ftdi.wr.eq(0)]
-                pass            
-                          
+
+                with m.If(~can_pull):
+                    m.next = "PUSH_TURNAROUND"
+
+            with m.State("PUSH_TURNAROUND"):
+                # ft60x releases the bus one cycle after oe is deasserted
+                m.next = "PUSH"
+
         return m
 
 def do_sim():
@@ -158,6 +151,107 @@ def do_sim():
     with sim.write_vcd("sim/ft60x.vcd"):
         sim.run()
 
+# Stand-in for platform.request("ft600") so the bus can be simulated without a board
+def sim_ftdi_resource(chip="ft600"):
+    from amaranth.hdl.rec import Record
+    data_bytes = 2 if chip == "ft600" else 4
+    return Record([
+        ("clk", 1),
+        ("data", [("i", 8*data_bytes), ("o", 8*data_bytes), ("oe", 1)]),
+        ("be",   [("i", data_bytes),   ("o", data_bytes),   ("oe", 1)]),
+        ("wr", 1), ("rd", 1), ("oe", 1),
+        ("txe", 1), ("rxf", 1),
+    ], name="ft600")
+
+# Measure sustained words per ftdi cycle against a model of the FT600 handshake.
+# The model has a transmit buffer which is drained towards USB in bursts
+# (txe drops whilst it is full) and a receive buffer preloaded with host words
+# (rxf is high whilst it holds data). Returns (words_per_cycle, words_pushed, words_pulled)
+def sim_ft60x_throughput(cycles=4000, tx_buffer_words=2048, usb_burst_words=512, usb_burst_period=600, host_words=64, vcd=False):
+    ftdi_resource = sim_ftdi_resource("ft600")
+    dut = FT60X_Sync245(chip="ft600", clk="sync", ftdi_resource = ftdi_resource)
+    sim = Simulator(dut)
+    sim.add_clock(1.0 / 100e6, domain="sync")
+
+    results = { "pushed" : [], "pulled" : [], "stall_cycles" : 0 }
+
+    def ftdi_clock():
+        # ft60x drives the ftdi clock domain through its clk pin
+        while True:
+            yield ftdi_resource.clk.eq(1)
+            yield Delay(5e-9)
+            yield ftdi_resource.clk.eq(0)
+            yield Delay(5e-9)
+
+    def sync_source():
+        # Keep the uplink fifo topped up with an incrementing count
+        count = 0
+        while True:
+            yield dut.fifo_to_f60x.w_data.eq( Cat(C(count & 0xffff, 16), C(0b11, 2)) )
+            yield dut.fifo_to_f60x.w_en.eq(1)
+            yield
+            if (yield dut.fifo_to_f60x.w_rdy):
+                count += 1
+
+    def sync_sink():
+        yield dut.fifo_from_f60x.r_en.eq(1)
+        while True:
+            yield
+            if (yield dut.fifo_from_f60x.r_rdy):
+                results["pulled"].append((yield dut.fifo_from_f60x.r_data) & 0xffff)
+
+    def ft600_model():
+        tx_level = 0
+        rx_next = 0
+        for cycle in range(cycles):
+            # USB drains the transmit buffer in periodic bursts
+            if cycle % usb_burst_period == 0:
+                tx_level = max(0, tx_level - usb_burst_words)
+            rx_level = host_words - rx_next if cycle > cycles // 4 else 0
+            yield ftdi_resource.txe.eq(tx_level < tx_buffer_words)
+            yield ftdi_resource.rxf.eq(rx_level > 0)
+            yield ftdi_resource.data.i.eq(0xa000 + rx_next)
+            yield ftdi_resource.be.i.eq(0b11)
+            yield Settle()
+
+            wr = yield ftdi_resource.wr
+            rd = yield ftdi_resource.rd
+            txe = yield ftdi_resource.txe
+            rxf = yield ftdi_resource.rxf
+            assert not ((yield ftdi_resource.data.oe) and (yield ftdi_resource.oe)), "bus contention"
+            if wr and txe:
+                results["pushed"].append((yield ftdi_resource.data.o))
+                tx_level += 1
+            elif not txe:
+                results["stall_cycles"] += 1
+            if rd and rxf:
+                rx_next += 1
+            yield
+
+    sim.add_process(ftdi_clock)
+    sim.add_sync_process(sync_source, domain="sync")
+    sim.add_sync_process(sync_sink, domain="sync")
+    sim.add_sync_process(ft600_model, domain="ftdi")
+
+    if vcd:
+        os.makedirs("sim", exist_ok=True)
+        with sim.write_vcd("sim/ft60x_throughput.vcd"):
+            sim.run_until(cycles * 10e-9, run_passive=True)
+    else:
+        sim.run_until(cycles * 10e-9, run_passive=True)
+
+    pushed = results["pushed"]
+    assert pushed == list(range(pushed[0], pushed[0] + len(pushed))), "uplink words dropped or reordered"
+    assert results["pulled"] == [0xa000 + i for i in range(len(results["pulled"]))], "downlink words dropped or reordered"
+
+    # Only cycles where the ft60x could accept data count against us
+    available_cycles = cycles - results["stall_cycles"]
+    words_per_cycle = len(pushed) / available_cycles
+    print("ft60x: {} words pushed, {} pulled, {:.3f} words per available ftdi cycle".format(
+        len(pushed), len(results["pulled"]), words_per_cycle))
+    return words_per_cycle, len(pushed), len(results["pulled"])
+
 if __name__ == "__main__":
     do_sim()
+    sim_ft60x_throughput(vcd=True)
     
\ No newline at end of file
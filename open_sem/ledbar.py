@@ -1,7 +1,8 @@
 import os
 import math
 from amaranth import *
-from amaranth.sim import Simulator, Delay, Settle
+from amaranth.sim import Delay, Settle
+from simulation import Simulator
 
 
 # Drive the x,y deflection beams for raster scanning.
@@ -53,17 +54,24 @@ def sim_LedBar_1():
     sim = Simulator(dut)
     sim.add_clock(1.0 / 100e6)
 
+    # Over a PWM period, the LEDs are lit for value clocks in total
     def loopback_proc():
-        for i in range(0,2**12,2^4):
+        for i in range(0,2**12,1 << 4):
             yield dut.value.eq(i)
-            for k in range(512):
+            yield
+            lit = 0
+            for k in range(2**dut.kn):
+                yield Settle()
+                lit += bin((yield dut.bar)).count("1")
                 yield
+            assert lit == i, (i, lit)
         
     sim.add_sync_process(loopback_proc)
     
     os.makedirs("sim", exist_ok=True)
     with sim.write_vcd("sim/ledbar_1.vcd"):
         sim.run()
+    print("ledbar: bar and PWM fill ok")
         
 if __name__ == "__main__":
     sim_LedBar_1()
\ No newline at end of file
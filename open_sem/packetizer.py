@@ -0,0 +1,338 @@
+import os
+from amaranth import *
+from amaranth.sim import Settle
+from simulation import Simulator
+from amaranth.lib.fifo import SyncFIFOBuffered
+
+# Packet layout on the uplink, one field per FT60x word (16 bit for FT600).
+# Packets for a stream are always the same size so that the host can slice
+# a buffer straight into packets once it has found the first SYNC word.
+#
+#   word 0          : SYNC (0xA55A)
+#   word 1          : stream_id[15:12], format[11:9], payload_words[8:0]
+#   word 2          : sequence counter (per stream, wraps)
+#   word 3          : frame number of first payload word
+#   word 4          : line number of first payload word
+#   word 5          : column of first payload word
+#   word 6          : count of valid payload words (remainder is zero padding),
+#                     or for streams which count items, of the items packed
+#                     into them (e.g. samples, see SamplePacker)
+#   word 7..7+N-1   : payload
+#   word 7+N        : CRC-16/CCITT (poly 0x1021, init 0xffff) of words 0..7+N-1
+#
+# The format tells how the payload is packed (for samples, the stream mode),
+# so that a change of format mid-stream is decoded packet by packet.
+PACKET_SYNC = 0xA55A
+PACKET_HEADER_WORDS = 7
+PACKET_TRAILER_WORDS = 1
+CRC_POLY = 0x1021
+CRC_INIT = 0xffff
+PACKET_FORMAT_BITS = 3
+PACKET_PAYLOAD_MAX = 511
+
+# Stream ID's used by Top. Host decoder must agree.
+STREAM_SAMPLES = 0
+STREAM_REGISTERS = 1
+STREAM_TELEMETRY = 2
+
+def packet_words(payload_words):
+    return PACKET_HEADER_WORDS + payload_words + PACKET_TRAILER_WORDS
+
+def stream_word(stream_id, payload_words, format=0):
+    return (stream_id << 12) | (format << 9) | payload_words
+
+# Reference implementation, MSB first, one data word at a time
+def crc16_word(crc, word, word_bits=16):
+    for i in reversed(range(word_bits)):
+        bit = ((word >> i) & 1) ^ ((crc >> 15) & 1)
+        crc = ((crc << 1) & 0xffff) ^ (CRC_POLY if bit else 0)
+    return crc
+
+def crc16(words, word_bits=16):
+    crc = CRC_INIT
+    for w in words:
+        crc = crc16_word(crc, w, word_bits)
+    return crc
+
+# The CRC update is linear over GF(2), so each bit of the next CRC is the XOR
+# of a fixed subset of current CRC and data bits. Find those subsets in Python
+# so that the hardware is a single level of XOR trees per word.
+def crc16_word_expr(crc : Value, word : Value):
+    word_bits = word.shape().width
+    out = []
+    for j in range(16):
+        terms = [ crc[i] for i in range(16) if (crc16_word(1 << i, 0, word_bits) >> j) & 1 ]
+        terms += [ word[i] for i in range(word_bits) if (crc16_word(0, 1 << i, word_bits) >> j) & 1 ]
+        out.append( Cat(terms).xor() )
+    return Cat(out)
+
+# Splits a stream of samples into fixed size packets with a header and CRC trailer.
+# Payload is buffered until a packet is complete (or flushed) so that each packet
+# is emitted as one contiguous burst and the header can carry the valid word count.
+# With count_items, the header carries the count of items instead, from items
+# as each packet closes.
+class Packetizer(Elaboratable):
+    def __init__(self, stream_id, payload_words=256, word_bits=16, count_items=False):
+        assert 0 <= stream_id < 16
+        assert 0 < payload_words <= PACKET_PAYLOAD_MAX
+        self.stream_id = stream_id
+        self.payload_words = payload_words
+        self.word_bits = word_bits
+        self.count_items = count_items
+
+        # In: sample stream
+        self.i_data  = Signal(word_bits)
+        self.i_valid = Signal()
+        self.i_ready = Signal()
+
+        # In: position of current sample, latched with the first word of each packet
+        self.frame  = Signal(16)
+        self.line   = Signal(16)
+        self.column = Signal(16)
+        # In: payload format, latched with the first word of each packet
+        self.format = Signal(PACKET_FORMAT_BITS)
+
+        # In: items in the packet closing (with count_items)
+        self.items = Signal(16)
+
+        # In: close the current packet early (includes any word accepted this cycle)
+        self.flush = Signal()
+
+        # Out: packet stream. o_last marks the CRC word
+        self.o_data  = Signal(word_bits)
+        self.o_valid = Signal()
+        self.o_ready = Signal()
+        self.o_last  = Signal()
+
+        # Double buffer so that the next packet can fill whilst one is emitted
+        self.data_fifo = SyncFIFOBuffered(width=word_bits, depth=2*payload_words)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.data_fifo = data_fifo = self.data_fifo
+        count_bits = range(self.payload_words + 1)
+
+        # Packet descriptors: frame, line, column, format, items, count
+        count_width = Shape.cast(count_bits).width
+        desc_layout = [16, 16, 16, PACKET_FORMAT_BITS, 16, count_width]
+        m.submodules.desc_fifo = desc_fifo = SyncFIFOBuffered(width=sum(desc_layout), depth=4)
+
+        ############################################################
+        # Input side: count words into packets and queue a descriptor for each
+
+        in_count = Signal(count_bits)
+        tags = Signal(48 + PACKET_FORMAT_BITS)
+        accept = Signal()
+        count_next = Signal(count_bits)
+        tags_now = Signal.like(tags)
+        items_now = Signal(16)
+
+        m.d.comb += [
+            self.i_ready.eq(data_fifo.w_rdy & desc_fifo.w_rdy),
+            accept.eq(self.i_valid & self.i_ready),
+            data_fifo.w_data.eq(self.i_data),
+            data_fifo.w_en.eq(accept),
+            count_next.eq(in_count + accept),
+            tags_now.eq(Mux(in_count == 0, Cat(self.frame, self.line, self.column, self.format), tags)),
+
+            items_now.eq(self.items if self.count_items else count_next),
+
+            desc_fifo.w_data.eq(Cat(tags_now, items_now, count_next)),
+            desc_fifo.w_en.eq((count_next == self.payload_words) | (self.flush & (count_next != 0))),
+        ]
+
+        with m.If(desc_fifo.w_en):
+            m.d.sync += in_count.eq(0)
+        with m.Else():
+            m.d.sync += in_count.eq(count_next)
+
+        with m.If(accept & (in_count == 0)):
+            m.d.sync += tags.eq(tags_now)
+
+        ############################################################
+        # Output side: header, payload (padded), crc
+
+        seq   = Signal(16)
+        crc   = Signal(16)
+        idx   = Signal(range(max(PACKET_HEADER_WORDS, self.payload_words)))
+        desc  = Signal(desc_fifo.width)
+        format = desc[48:48 + PACKET_FORMAT_BITS]
+        items = desc[48 + PACKET_FORMAT_BITS:-count_width]
+        count = desc[-count_width:]
+        transfer = Signal()
+
+        header = Array([
+            C(PACKET_SYNC, 16),
+            Cat(C(self.payload_words, 9), format, C(self.stream_id, 4)),
+            seq,
+            desc[0:16],
+            desc[16:32],
+            desc[32:48],
+            items,
+        ])
+
+        m.d.comb += transfer.eq(self.o_valid & self.o_ready)
+
+        with m.If(transfer):
+            m.d.sync += crc.eq(crc16_word_expr(crc, self.o_data))
+
+        def load_descriptor(next_state_if_none):
+            with m.If(desc_fifo.r_rdy):
+                m.d.comb += desc_fifo.r_en.eq(1)
+                m.d.sync += [
+                    desc.eq(desc_fifo.r_data),
+                    idx.eq(0),
+                    crc.eq(CRC_INIT),
+                ]
+                m.next = "HEADER"
+            with m.Else():
+                m.next = next_state_if_none
+
+        with m.FSM():
+            with m.State("IDLE"):
+                load_descriptor("IDLE")
+
+            with m.State("HEADER"):
+                m.d.comb += [
+                    self.o_data.eq(header[idx]),
+                    self.o_valid.eq(1),
+                ]
+                with m.If(transfer):
+                    m.d.sync += idx.eq(idx + 1)
+                    with m.If(idx == PACKET_HEADER_WORDS - 1):
+                        m.d.sync += idx.eq(0)
+                        m.next = "PAYLOAD"
+
+            with m.State("PAYLOAD"):
+                with m.If(idx < count):
+                    m.d.comb += [
+                        self.o_data.eq(data_fifo.r_data),
+                        self.o_valid.eq(data_fifo.r_rdy),
+                        data_fifo.r_en.eq(self.o_ready),
+                    ]
+                with m.Else():
+                    # Zero padding for flushed packets
+                    m.d.comb += self.o_valid.eq(1)
+                with m.If(transfer):
+                    m.d.sync += idx.eq(idx + 1)
+                    with m.If(idx == self.payload_words - 1):
+                        m.next = "CRC"
+
+            with m.State("CRC"):
+                m.d.comb += [
+                    self.o_data.eq(crc),
+                    self.o_valid.eq(1),
+                    self.o_last.eq(1),
+                ]
+                with m.If(transfer):
+                    m.d.sync += seq.eq(seq + 1)
+                    # Carry straight on with the next packet if it's ready
+                    load_descriptor("IDLE")
+
+        return m
+
+# Merges the packet streams of several Packetizers onto one output, one whole
+# packet at a time. Inputs are granted round robin so no stream can starve another.
+class PacketArbiter(Elaboratable):
+    def __init__(self, packetizers : list[Packetizer]):
+        self.inputs = packetizers
+        word_bits = packetizers[0].word_bits
+        assert all(p.word_bits == word_bits for p in packetizers)
+
+        # Out: merged packet stream
+        self.o_data  = Signal(word_bits)
+        self.o_valid = Signal()
+        self.o_ready = Signal()
+        self.o_last  = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n = len(self.inputs)
+        grant = Signal(range(n))
+        busy = Signal()
+
+        for i, p in enumerate(self.inputs):
+            with m.If(grant == i):
+                m.d.comb += [
+                    self.o_data.eq(p.o_data),
+                    self.o_valid.eq(busy & p.o_valid),
+                    self.o_last.eq(p.o_last),
+                    p.o_ready.eq(busy & self.o_ready),
+                ]
+
+        with m.If(~busy):
+            # Pick the next waiting input after the one last granted
+            with m.Switch(grant):
+                for g in range(n):
+                    with m.Case(g):
+                        order = [ (g + 1 + k) % n for k in range(n) ]
+                        for k, i in enumerate(order):
+                            cond = self.inputs[i].o_valid
+                            with (m.If(cond) if k == 0 else m.Elif(cond)):
+                                m.d.sync += [ grant.eq(i), busy.eq(1) ]
+        with m.Elif(self.o_valid & self.o_ready & self.o_last):
+            m.d.sync += busy.eq(0)
+
+        return m
+
+def sim_packetizer_1():
+    payload_words = 8
+    dut = Packetizer(stream_id=3, payload_words=payload_words)
+    sim = Simulator(dut)
+    sim.add_clock(1.0 / 100e6, domain="sync")
+
+    samples = list(range(0x100, 0x100 + 2*payload_words + 3))
+    received = []
+
+    def source_proc():
+        for i, s in enumerate(samples):
+            yield dut.i_data.eq(s)
+            yield dut.i_valid.eq(1)
+            yield dut.line.eq(i // 4)
+            yield dut.column.eq(i % 4)
+            yield dut.format.eq(i // payload_words)
+            yield dut.flush.eq(i == len(samples) - 1)
+            yield Settle()
+            while not (yield dut.i_ready):
+                yield
+                yield Settle()
+            yield
+        yield dut.i_valid.eq(0)
+        yield dut.flush.eq(0)
+
+    def sink_proc():
+        # Apply some backpressure to exercise o_ready
+        for cycle in range(200):
+            yield dut.o_ready.eq(cycle % 3 != 0)
+            yield Settle()
+            if (yield dut.o_valid) and (yield dut.o_ready):
+                received.append((yield dut.o_data))
+            yield
+
+    sim.add_sync_process(source_proc, domain="sync")
+    sim.add_sync_process(sink_proc, domain="sync")
+
+    os.makedirs("sim", exist_ok=True)
+    with sim.write_vcd("sim/packetizer_1.vcd"):
+        sim.run()
+
+    n = packet_words(payload_words)
+    assert len(received) == 3 * n, "expected three packets, got {} words".format(len(received))
+    payload = []
+    for p in range(3):
+        packet = received[p*n:(p+1)*n]
+        assert packet[0] == PACKET_SYNC
+        assert packet[1] == stream_word(3, payload_words, format=p)
+        assert packet[2] == p
+        assert packet[-1] == crc16(packet[:-1]), "bad crc"
+        first = p * payload_words
+        assert packet[4:6] == [first // 4, first % 4]
+        count = packet[6]
+        payload += packet[PACKET_HEADER_WORDS:PACKET_HEADER_WORDS+count]
+    assert payload == samples
+    print("packetizer: {} packets ok".format(3))
+
+if __name__ == "__main__":
+    sim_packetizer_1()
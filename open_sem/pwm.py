@@ -1,7 +1,8 @@
 import os
 import math
 from amaranth import *
-from amaranth.sim import Simulator, Delay, Settle
+from amaranth.sim import Delay, Settle
+from simulation import Simulator
 
 
 # Drive the x,y deflection beams for raster scanning.
@@ -38,14 +39,19 @@ class PWM(Elaboratable):
 def sim_PWM_1():
     #  2**16 * 10ns = 655.36us period
     pwm_period_clocks = 2**16
+    periods = 4
     
     dut = PWM(pwm_period_clocks)
     sim = Simulator(dut)
     sim.add_clock(1.0 / 100e6)
+    high = [ 0 ]
 
     def loopback_proc():
         yield dut.input.eq( C(round(pwm_period_clocks / 10)) )
-        for i in range(0,2**18):
+        yield
+        for i in range(0,periods * pwm_period_clocks):
+            yield Settle()
+            high[0] += (yield dut.pwm)
             yield
         
     sim.add_sync_process(loopback_proc)
@@ -53,6 +59,10 @@ def sim_PWM_1():
     os.makedirs("sim", exist_ok=True)
     with sim.write_vcd("sim/pwm.vcd"):
         sim.run()
+
+    # High for input clocks of each period
+    assert high[0] == periods * round(pwm_period_clocks / 10), high[0]
+    print("pwm: duty cycle ok over {} periods".format(periods))
         
 if __name__ == "__main__":
     sim_PWM_1()
\ No newline at end of file
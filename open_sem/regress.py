@@ -0,0 +1,251 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import traceback
+import contextlib
+import concurrent.futures
+from fnmatch import fnmatchcase
+
+from amaranth import *
+
+import simulation
+
+# The host package, open_sem_host, sits beside this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Regression and benchmark runner: runs the module testbenches in a process
+# pool, each asserting its results, and gathers performance metrics:
+#
+#   <test>_sim_cycles_per_s : simulated cycles per second of the test's runs
+#   ft60x_words_per_cycle   : sustained uplink words per available ftdi cycle
+#   dac_settling_cycles     : DAC step response settling time
+#   dac_settling_error      : DAC mean error once settled
+#   elaborate_<module>_s    : elaboration time of each module
+#
+# Metrics are written as JSON and compared against a baseline, a regression
+# being a metric worse than the baseline by more than its tolerance. Timing
+# metrics (simulation speed, elaboration time) depend on the machine and its
+# load, so they are only reported, unless --timing makes them count too:
+#
+#   python3 regress.py                    # run everything, compare
+#   python3 regress.py "dac*" -j 2        # tests matching patterns
+#   python3 regress.py --timing -j 1      # timing regressions fail too
+#   python3 regress.py --update-baseline  # store metrics as the baseline
+#
+# The exit code is non-zero on a failure or a regression.
+
+# (test, function), the function being "module.name"
+TESTS = [
+    ("accumulator",      "accumulator.sim_accumulator_1"),
+    ("backends",         "simulation.sim_backends_1"),
+    ("backscatter",      "backscatter.sim_backscatter_1"),
+    ("bitpacker",        "samplemux.sim_bitpacker_1"),
+    ("build_cache",      "build_cache.check_build_cache"),
+    ("clocking",         "clocking.sim_clocking_1"),
+    ("commands",         "commands.sim_commands_1"),
+    ("dac_engines",      "dac.sim_dac_engines"),
+    ("dac_model",        "dac_model.check_dac_model"),
+    ("dac_settling",     "regress.dac_settling"),
+    ("decoder",          "open_sem_host.decoder.check_decoder"),
+    ("dsp",              "dsp.sim_dsp_1"),
+    ("elaboration",      "regress.elaboration"),
+    ("fixed_point",      "fixed_point.sim_soft_fixed_point_1"),
+    ("ft60x_throughput", "regress.ft60x_throughput"),
+    ("ledbar",           "ledbar.sim_LedBar_1"),
+    ("packetizer",       "packetizer.sim_packetizer_1"),
+    ("pathscan",         "scanning.sim_pathscan_1"),
+    ("pixelscan",        "scanning.sim_pixelscan_2"),
+    ("pixelscan_reset",  "scanning.sim_pixelscan_3"),
+    ("pwm",              "pwm.sim_PWM_1"),
+    ("report_parsing",   "sweep_build.check_report_parsing"),
+    ("samplemux",        "samplemux.sim_samplemux_1"),
+    ("samplepacker",     "samplemux.sim_samplepacker_1"),
+    ("stream_decode",    "regress.stream_decode"),
+    ("telemetry",        "telemetry.sim_telemetry_1"),
+    ("tracing",          "tracing.sim_tracing_1"),
+    ("xadc",             "xadc.sim_xadc_1"),
+]
+
+# (metric pattern, better, relative tolerance, timing)
+METRICS = [
+    ("*_sim_cycles_per_s",    "higher", 0.3,  True),
+    ("elaborate_*",           "lower",  0.5,  True),
+    ("ft60x_words_per_cycle", "higher", 0.01, False),
+    ("dac_settling_cycles",   "lower",  0.05, False),
+    ("dac_settling_error",    "lower",  0.1,  False),
+]
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regress_baseline.json")
+
+############################################################
+# Tests measuring metrics return them as a dict
+
+def dac_settling():
+    from dac import sim_dac_settling
+    cycles, error = sim_dac_settling()
+    return { "dac_settling_cycles": cycles, "dac_settling_error": error }
+
+# Sample packets from sim_samplepacker_1, switching stream mode midway, must
+# decode on the host into the frames sent, with the counts of those sent with
+# counts (and zero counts elsewhere)
+def stream_decode():
+    import numpy as np
+    from samplemux import sim_samplepacker_1
+    from open_sem_host import StreamDecoder, WORD_DTYPE
+    words, sent, (width, height, payload_words, modes) = sim_samplepacker_1()
+    frames = {}
+    counts = {}
+    decoder = StreamDecoder(width, height, payload_words, stream_modes=modes,
+        on_frame=lambda number, frame: frames.setdefault(number, frame.copy()),
+        on_counts=lambda number, frame: counts.setdefault(number, frame.copy()))
+    decoder.feed(np.array(words, dtype=WORD_DTYPE).tobytes())
+    decoder.flush()
+    expected = np.array([ beat[0] for beat in sent ]).reshape(-1, height, width)
+    expected_counts = np.array([ beat[1] if len(beat) > 1 else 0 for beat in sent ]).reshape(-1, height, width)
+    assert sorted(frames) == list(range(len(expected))), sorted(frames)
+    assert counts, "no frames sent with counts"
+    for number, frame in frames.items():
+        assert np.array_equal(frame, expected[number]), number
+    for number, frame in counts.items():
+        assert np.array_equal(frame, expected_counts[number]), number
+    assert decoder.stats()["crc_errors"] == 0 and decoder.stats()["dropped_packets"] == 0, decoder.stats()
+    print("stream_decode: {} frames decoded across modes {} ok".format(len(frames), modes))
+
+def ft60x_throughput():
+    from ft60x import sim_ft60x_throughput
+    words_per_cycle, pushed, pulled = sim_ft60x_throughput()
+    return { "ft60x_words_per_cycle": words_per_cycle }
+
+def elaboration():
+    from scanning import PixelScan, PathScan
+    from accumulator import Accumulator
+    from backscatter import Backscatter
+    from dac import DAC
+    from ft60x import FT60X_Sync245, sim_ftdi_resource
+    from packetizer import Packetizer, STREAM_SAMPLES
+    from pwm import PWM
+
+    modules = {
+        "pixel_scan":  lambda: PixelScan(),
+        "path_scan":   lambda: PathScan(),
+        "accumulator": lambda: Accumulator(16, 16),
+        "backscatter": lambda: Backscatter(12, contrast=True),
+        "dac":         lambda: DAC(delta_time=1.0/100e6, capacitor=1e-7, resistors=[1e2, 1e3, 1e5], output_pwm=Signal(3)),
+        "ft60x":       lambda: FT60X_Sync245(chip="ft600", clk="sync", ftdi_resource=sim_ftdi_resource("ft600")),
+        "packetizer":  lambda: Packetizer(STREAM_SAMPLES),
+        "pwm":         lambda: PWM(),
+    }
+    metrics = {}
+    for name, constructor in modules.items():
+        start = time.perf_counter()
+        Fragment.get(constructor(), None)
+        metrics["elaborate_{}_s".format(name)] = time.perf_counter() - start
+    return metrics
+
+############################################################
+# Runner
+
+def run_test(test, function):
+    module_name, function_name = function.rsplit(".", 1)
+    output = io.StringIO()
+    simulation.run_stats.clear()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            metrics = getattr(importlib.import_module(module_name), function_name)()
+        error = None
+    except Exception:
+        metrics = None
+        error = traceback.format_exc()
+    seconds = time.perf_counter() - start
+
+    metrics = dict(metrics) if isinstance(metrics, dict) else {}
+    elapsed = sum(stats.elapsed for stats in simulation.run_stats)
+    cycles = sum(max(stats.cycles.values(), default=0) for stats in simulation.run_stats)
+    if cycles > 0 and elapsed > 0:
+        metrics["{}_sim_cycles_per_s".format(test)] = cycles / elapsed
+    return { "ok": error is None, "seconds": seconds, "error": error, "output": output.getvalue(), "metrics": metrics }
+
+def metric_rule(name):
+    return next(((better, tolerance, timing) for pattern, better, tolerance, timing in METRICS if fnmatchcase(name, pattern)), None)
+
+# Metrics worse than the baseline: (name, value, baseline, timing)
+def compare(metrics, baseline):
+    regressions = []
+    for name, value in metrics.items():
+        rule = metric_rule(name)
+        if rule is None or name not in baseline:
+            continue
+        better, tolerance, timing = rule
+        reference = baseline[name]
+        if better == "higher" and value < reference * (1 - tolerance) or \
+           better == "lower" and value > reference * (1 + tolerance):
+            regressions.append((name, value, reference, timing))
+    return regressions
+
+def run(patterns=(), jobs=None, backend=None):
+    tests = [ (t, f) for t, f in TESTS if not patterns or any(fnmatchcase(t, p) for p in patterns) ]
+    if backend:
+        os.environ["OPEN_SEM_SIM"] = backend
+    os.makedirs("sim", exist_ok=True)
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = { pool.submit(run_test, t, f): t for t, f in tests }
+        for future in concurrent.futures.as_completed(futures):
+            test = futures[future]
+            results[test] = future.result()
+            print("{:20s} {:4s} {:7.1f}s".format(test, "ok" if results[test]["ok"] else "FAIL", results[test]["seconds"]))
+            if not results[test]["ok"]:
+                print(results[test]["output"] + results[test]["error"])
+    return { t: results[t] for t, _ in tests }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the module testbenches and benchmarks")
+    parser.add_argument("patterns", nargs="*", metavar="TEST",
+        help="run tests matching TEST patterns (default: all)")
+    parser.add_argument("-j", "--jobs", type=int,
+        help="worker processes (default: one per CPU)")
+    parser.add_argument("-b", "--backend", choices=simulation.SIM_BACKENDS,
+        help="simulation backend")
+    parser.add_argument("-o", "--output", default="sim/regress.json",
+        help="write results and metrics to OUTPUT (default: %(default)s)")
+    parser.add_argument("--baseline", default=BASELINE,
+        help="compare metrics against BASELINE (default: %(default)s)")
+    parser.add_argument("--timing", action="store_true",
+        help="fail on timing regressions too (best run with -j 1 on an idle machine)")
+    parser.add_argument("--update-baseline", action="store_true",
+        help="store the metrics measured as the baseline")
+    args = parser.parse_args()
+
+    results = run(args.patterns, args.jobs, args.backend)
+    metrics = { name: value for result in results.values() for name, value in result["metrics"].items() }
+    with open(args.output, "w") as f:
+        json.dump({ "tests": { t: { k: r[k] for k in [ "ok", "seconds", "error" ] } for t, r in results.items() },
+                    "metrics": metrics }, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    for name in sorted(metrics):
+        print("{:40s} {:12.5g} {}".format(name, metrics[name], "(baseline {:.5g})".format(baseline[name]) if name in baseline else ""))
+
+    regressions = []
+    for name, value, reference, timing in compare(metrics, baseline):
+        counts = args.timing or not timing
+        print("{} {}: {:.5g}, baseline {:.5g}".format("REGRESSION" if counts else "slower (timing, not counted)", name, value, reference))
+        if counts:
+            regressions.append(name)
+    failures = [ t for t, r in results.items() if not r["ok"] ]
+    print("{} of {} tests passed, {} regressions".format(len(results) - len(failures), len(results), len(regressions)))
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({ **baseline, **metrics }, f, indent=1, sort_keys=True)
+            f.write("\n")
+    sys.exit(1 if failures or regressions else 0)
@@ -1,66 +1,542 @@
 import os
+import math
 import functools
 
 from amaranth import *
-from amaranth.sim import Simulator
+from amaranth.lib.cdc import FFSynchronizer
+from amaranth.sim import Settle, Passive
+from simulation import Simulator
+
+from commands import RegisterPort
 
 # Module allows us to specify which samples and with what bitdepths
-# we will be streaming to the host. We do this by applying user defined
-# masks and shifts into a (possibly larger) output Signal
+# we will be streaming to the host. We do this by applying masks and
+# shifts into a (possibly larger) output Signal.
+#
+# The masks and shifts are fixed at build time as a table of routes, each a
+# list of (input, mask, shift) slots ORed together (a negative shift moves
+# right), and the host picks a route at runtime. Each route is then only
+# constant wiring, and the output a mux between routes, rather than a
+# variable shifter per input.
+#
+# The route is written through port (sync domain), and crosses to `domain`,
+# where the output is used. Each input may come with a strobe, pulsed as a new
+# sample arrives; output_strobe pulses with those of the route's inputs.
+SAMPLE_MUX_ADDR_ROUTE  = 0
+SAMPLE_MUX_ADDR_ROUTES = 1 # read only: number of routes
+
 class SampleMux(Elaboratable):
-    def __init__(self, output_bits, input_bits_arr) -> None:
+    def __init__(self, output_bits, input_bits_arr, routes, domain="sync") -> None:
         self.output_bits = output_bits
         self.N = len(input_bits_arr)
+        self.routes = routes
+        self.domain = domain
+        for route in routes:
+            for i, mask, shift in route:
+                assert 0 <= i < self.N
+                assert (mask << shift if shift >= 0 else mask >> -shift) < 2**output_bits, "slot outside output"
 
         # In
         self.input_samples = []
-        self.input_mask = []
-        self.input_shft = []
         
         for i in range(0, self.N):
             input_bits = input_bits_arr[i]
             self.input_samples.append(Signal(input_bits, name="input{}".format(i) ))
-            self.input_mask.append(Signal(input_bits, name="mask{}".format(i) ))
-            self.input_shft.append(Signal(8, name="shift{}".format(i) ))
+        self.input_strobes = [ Signal(name="strobe{}".format(i)) for i in range(self.N) ]
+
+        # In: route selection (sync domain)
+        self.port = RegisterPort("sample_mux")
 
         # Out
+        self.route = Signal(range(len(routes)))
         self.output_sample = Signal(output_bits)
+        self.output_strobe = Signal()
+
+    def route_value(self, route):
+        slots = [ C(0, self.output_bits) ]
+        for i, mask, shift in route:
+            masked = self.input_samples[i] & mask
+            slots.append(masked << shift if shift >= 0 else masked >> -shift)
+        return functools.reduce(lambda a,b: a | b, slots)
 
     def elaborate(self, platform):
         m = Module()
-        
-        result = functools.reduce(lambda a,b: a | b, [ (self.input_samples[i] & self.input_mask[i]) << self.input_shft[i] for i in range(self.N)])
-        
-        m.d.comb += self.output_sample.eq(result)
+        port = self.port
+
+        route = Signal.like(self.route)
+        m.d.sync += port.ack.eq(port.stb & ~port.ack)
+        m.d.comb += port.rdata.eq(Mux(port.addr == SAMPLE_MUX_ADDR_ROUTES, len(self.routes), route))
+        with m.If(port.stb & ~port.ack & port.we & (port.addr == SAMPLE_MUX_ADDR_ROUTE) & (port.wdata < len(self.routes))):
+            m.d.sync += route.eq(port.wdata)
+
+        if self.domain == "sync":
+            m.d.comb += self.route.eq(route)
+        else:
+            m.submodules.route_cdc = FFSynchronizer(route, self.route, o_domain=self.domain)
+
+        with m.Switch(self.route):
+            for r, slots in enumerate(self.routes):
+                with m.Case(r):
+                    m.d.comb += [
+                        self.output_sample.eq(self.route_value(slots)),
+                        self.output_strobe.eq(Cat(self.input_strobes[i] for i in sorted(set(i for i, _, _ in slots))).any()),
+                    ]
 
         return m
     
 def sim_samplemux_1():
-    dut = SampleMux(16, [12,12,12,12]) 
+    routes = [
+        [ (0, 0xfff, 0) ],
+        [ (i, 0x00f, 4*i) for i in range(4) ],
+        [ (1, 0xff0, -4), (2, 0xff0, 4) ],
+    ]
+    dut = SampleMux(16, [12,12,12,12], routes)
+    samples = [ 0x123, 0x456, 0x789, 0xabc ]
+    strobes = [ 0, 0, 1, 0 ]
+    expected = [ 0x123, 0xc963, 0x7845 ]
+    expected_strobes = [ 0, 1, 1 ]
+    outputs = []
+    output_strobes = []
 
     sim = Simulator(dut)
+    sim.add_clock(1.0 / 100e6, domain="sync")
 
     def loopback_proc():
-        yield dut.input_samples[0].eq(0x123)
-        yield dut.input_samples[1].eq(0x456)
-        yield dut.input_samples[2].eq(0x789)
-        yield dut.input_samples[3].eq(0x000)
+        port = dut.port
+        for signal, value in zip(dut.input_samples + dut.input_strobes, samples + strobes):
+            yield signal.eq(value)
+        for route in [ 0, 1, 2, 3 ]:
+            yield port.addr.eq(SAMPLE_MUX_ADDR_ROUTE)
+            yield port.wdata.eq(route)
+            yield port.we.eq(1)
+            yield port.stb.eq(1)
+            yield
+            while not (yield port.ack):
+                yield
+            yield port.stb.eq(0)
+            yield
+            yield Settle()
+            outputs.append((yield dut.output_sample))
+            output_strobes.append((yield dut.output_strobe))
         
-        yield dut.input_mask[0].eq(0x000f)
-        yield dut.input_mask[1].eq(0x000f)
-        yield dut.input_mask[2].eq(0x000f)
-        yield dut.input_mask[3].eq(0x000f)
-        
-        yield dut.input_shft[0].eq(0)
-        yield dut.input_shft[1].eq(4)
-        yield dut.input_shft[2].eq(8)
-        yield dut.input_shft[3].eq(12)        
-        
-    sim.add_process(loopback_proc)
+    sim.add_sync_process(loopback_proc, domain="sync")
     
     os.makedirs("sim", exist_ok=True)
     with sim.write_vcd("sim/samplemux_1.vcd"):
         sim.run()
-        
+
+    # Route 3 does not exist, so route 2 is kept
+    assert outputs == expected + expected[-1:], [ hex(o) for o in outputs ]
+    assert output_strobes == expected_strobes + expected_strobes[-1:], output_strobes
+    print("samplemux: route tables ok")
+
+# Packs beats of N channels of arbitrary bit depths contiguously into a stream
+# of word_bits words (LSB first, channel 0 lowest), so that no bits are spent
+# on padding: e.g. four 12-bit channels take three 16-bit words.
+#
+# Bits not yet sent are held in a buffer. Whilst it holds a full word, that is
+# offered on o_data; a beat is accepted once less than a word would remain,
+# which may be in the same cycle as the last full word leaves. The bits held
+# when a beat is accepted can only be (i * beat_bits) mod word_bits for some i,
+# so the beat is placed by a mux over those constant shifts rather than a
+# barrel shifter.
+#
+# Holding i_flush sends any remaining bits as a last word, zero padded, so
+# that the next beat starts on a word boundary (e.g. at the end of a frame).
+# empty is high once no bits are held.
+class BitPacker(Elaboratable):
+    def __init__(self, channel_bits, word_bits=16):
+        self.channel_bits = list(channel_bits)
+        self.word_bits = word_bits
+        self.beat_bits = sum(self.channel_bits)
+
+        # In: one beat of all channels
+        self.i_channels = [ Signal(bits, name="channel{}".format(i)) for i, bits in enumerate(self.channel_bits) ]
+        self.i_valid = Signal()
+        self.i_ready = Signal()
+        self.i_flush = Signal()
+
+        # Out: packed words
+        self.o_data = Signal(word_bits)
+        self.o_valid = Signal()
+        self.o_ready = Signal()
+        self.empty = Signal()
+
+    # Bits held when a beat is accepted
+    def offsets(self):
+        period = self.word_bits // math.gcd(self.beat_bits, self.word_bits)
+        return sorted(set((i * self.beat_bits) % self.word_bits for i in range(period)))
+
+    def elaborate(self, platform):
+        m = Module()
+        W = self.word_bits
+
+        buffer = Signal(W - 1 + self.beat_bits)
+        count = Signal(range(len(buffer) + 1))
+
+        # A partial word is sent when flushing
+        partial = self.i_flush & (count != 0) & (count < W)
+        fire = self.o_valid & self.o_ready
+
+        kept = Signal.like(buffer)
+        kept_count = Signal.like(count)
+        with m.If(fire & partial):
+            m.d.comb += [ kept.eq(0), kept_count.eq(0) ]
+        with m.Elif(fire):
+            m.d.comb += [ kept.eq(buffer >> W), kept_count.eq(count - W) ]
+        with m.Else():
+            m.d.comb += [ kept.eq(buffer), kept_count.eq(count) ]
+
+        m.d.comb += [
+            self.o_data.eq(buffer[:W]),
+            self.o_valid.eq((count >= W) | partial),
+            self.i_ready.eq(kept_count < W),
+            self.empty.eq(count == 0),
+        ]
+
+        beat = Cat(self.i_channels)
+        m.d.sync += [ buffer.eq(kept), count.eq(kept_count) ]
+        with m.If(self.i_valid & self.i_ready):
+            m.d.sync += count.eq(kept_count + self.beat_bits)
+            with m.Switch(kept_count):
+                for offset in self.offsets():
+                    with m.Case(offset):
+                        m.d.sync += buffer.eq(kept | (beat << offset))
+
+        return m
+
+# Reference packing of beats (lists of channel values), with a flush after each
+# of segments (lists of beats)
+def pack_bits(segments, channel_bits, word_bits=16):
+    words = []
+    for beats in segments:
+        bits = []
+        for beat in beats:
+            for value, n in zip(beat, channel_bits):
+                bits += [ (value >> i) & 1 for i in range(n) ]
+        bits += [ 0 ] * (-len(bits) % word_bits)
+        words += [ sum(b << i for i, b in enumerate(bits[w:w + word_bits])) for w in range(0, len(bits), word_bits) ]
+    return words
+
+def sim_bitpacker_1():
+    import random
+    random.seed(4)
+    for channel_bits, word_bits in [ ([12, 12, 12, 12], 16), ([12], 16), ([10, 7, 3], 32), ([5, 30], 16) ]:
+        dut = BitPacker(channel_bits, word_bits)
+        segments = [ [ [ random.getrandbits(n) for n in channel_bits ] for _ in range(random.randint(5, 12)) ] for _ in range(3) ]
+        words = []
+
+        sim = Simulator(dut)
+        sim.add_clock(1.0 / 100e6, domain="sync")
+
+        # Random valid and ready; between segments, wait for the full words
+        # to drain then flush
+        def proc():
+            for beats in segments:
+                pending = list(beats)
+                while pending:
+                    yield dut.i_valid.eq(random.random() < 0.7)
+                    for signal, value in zip(dut.i_channels, pending[0]):
+                        yield signal.eq(value)
+                    yield dut.o_ready.eq(random.random() < 0.8)
+                    yield Settle()
+                    if (yield dut.o_valid) and (yield dut.o_ready):
+                        words.append((yield dut.o_data))
+                    if (yield dut.i_valid) and (yield dut.i_ready):
+                        pending.pop(0)
+                    yield
+                yield dut.i_valid.eq(0)
+                yield dut.o_ready.eq(1)
+                yield dut.i_flush.eq(1)
+                for _ in range(len(channel_bits) * 3 + 2):
+                    yield Settle()
+                    if (yield dut.o_valid):
+                        words.append((yield dut.o_data))
+                    yield
+                yield dut.i_flush.eq(0)
+
+        sim.add_sync_process(proc, domain="sync")
+        os.makedirs("sim", exist_ok=True)
+        with sim.write_vcd("sim/bitpacker_1.vcd"):
+            sim.run()
+
+        expected = pack_bits(segments, channel_bits, word_bits)
+        assert words == expected, (channel_bits, word_bits, words, expected)
+    print("bitpacker: packing with backpressure and flush ok")
+
+# Words per packet holding whole packing periods (lcm(sample_bits, word_bits)
+# bits) of every mode, at most max_words
+def stream_payload_words(modes, word_bits=16, max_words=256):
+    unit = functools.reduce(math.lcm, [ math.lcm(sum(stream_channels(mode)), word_bits) // word_bits for mode in modes ])
+    assert unit <= max_words
+    return max_words // unit * unit
+
+# Channel widths of a stream mode: a sample width, or (sample width, count
+# width) to send each sample with its count (see Accumulator)
+def stream_channels(mode):
+    return list(mode) if isinstance(mode, (list, tuple)) else [ mode ]
+
+# Streams samples for a Packetizer of payload_words (see stream_payload_words)
+# in one of several modes, each a sample width: samples are saturated to it
+# and packed with a BitPacker, e.g. four 12 bit samples in three 16 bit words.
+# Modes with a count width send i_count (saturated alike) after each sample.
+#
+# Each packet holds a whole number of samples, so o_frame, o_line and
+# o_column (for the Packetizer's position inputs) give the first sample of the
+# packet being filled. A new mode, written through port (sync domain), is
+# taken up between packets: the words of the last packet in the old mode have
+# all left first. mode goes to the Packetizer's format, so each packet's
+# header tells its mode.
+#
+# A pulse on i_flush (e.g. at the end of a frame) closes the packet being
+# filled after the samples accepted so far: once its last, padded word has
+# left, o_flush closes it at the Packetizer (whilst o_ready), and o_items
+# gives the samples it holds, for a Packetizer counting items. A flushed
+# packet ends between packets, so a new mode is taken up there too.
+STREAM_ADDR_MODE = 0
+
+class SamplePacker(Elaboratable):
+    def __init__(self, sample_bits, modes, payload_words, word_bits=16):
+        self.sample_bits = sample_bits
+        self.modes = list(modes)
+        self.payload_words = payload_words
+        self.word_bits = word_bits
+        for mode in self.modes:
+            assert payload_words * word_bits % sum(stream_channels(mode)) == 0, "packets must hold whole samples"
+
+        # In: mode (sync domain)
+        self.port = RegisterPort("sample_packer")
+
+        # In: samples, tagged with their position, and the count of each
+        self.i_sample = Signal(sample_bits)
+        self.i_count = Signal(16)
+        self.i_valid = Signal()
+        self.i_ready = Signal()
+        self.i_frame = Signal(16)
+        self.i_line = Signal(16)
+        self.i_column = Signal(16)
+        self.i_flush = Signal()
+
+        # Out: packed words, and the position of the packet's first sample
+        self.o_data = Signal(word_bits)
+        self.o_valid = Signal()
+        self.o_ready = Signal()
+        self.o_frame = Signal(16)
+        self.o_line = Signal(16)
+        self.o_column = Signal(16)
+
+        # Out: close the packet early, and the samples in the packet closing
+        self.o_flush = Signal()
+        self.o_items = Signal(16)
+
+        # Out: mode in use
+        self.mode = Signal(range(len(self.modes)))
+
+    def elaborate(self, platform):
+        m = Module()
+        port = self.port
+
+        request = Signal.like(self.mode)
+        m.d.sync += port.ack.eq(port.stb & ~port.ack)
+        m.d.comb += port.rdata.eq(request)
+        with m.If(port.stb & ~port.ack & port.we & (port.addr == STREAM_ADDR_MODE) & (port.wdata < len(self.modes))):
+            m.d.sync += request.eq(port.wdata)
+
+        # Samples into the current packet
+        samples_per_packet = [ self.payload_words * self.word_bits // sum(stream_channels(mode)) for mode in self.modes ]
+        count = Signal(range(max(samples_per_packet)))
+        packet_samples = Array(C(n, len(count) + 1) for n in samples_per_packet)
+
+        accept = Signal()
+        pending = Signal()
+        switch = Signal()
+        flushing = Signal()
+        packers = []
+
+        def saturate(value, bits):
+            if bits < len(value):
+                return Mux(value[bits:].any(), (1 << bits) - 1, value[:bits])
+            return value
+
+        for i, mode in enumerate(self.modes):
+            channels = stream_channels(mode)
+            packer = m.submodules["packer{}".format(i)] = BitPacker(channels, self.word_bits)
+            packers.append(packer)
+            for channel, value, bits in zip(packer.i_channels, [ self.i_sample, self.i_count ], channels):
+                m.d.comb += channel.eq(saturate(value, bits))
+            m.d.comb += [
+                packer.i_valid.eq(self.i_valid & ~pending & ~flushing & (self.mode == i)),
+                packer.i_flush.eq(flushing & (self.mode == i)),
+                packer.o_ready.eq(self.o_ready & (self.mode == i)),
+            ]
+
+        with m.Switch(self.mode):
+            for i, packer in enumerate(packers):
+                with m.Case(i):
+                    m.d.comb += [
+                        self.i_ready.eq(packer.i_ready & ~pending & ~flushing),
+                        self.o_data.eq(packer.o_data),
+                        self.o_valid.eq(packer.o_valid),
+                        self.o_flush.eq(flushing & packer.empty & self.o_ready),
+                    ]
+
+        # Between packets, samples wait for the last words to leave (a packet
+        # is whole packing periods, so then no bits are held)
+        m.d.comb += [
+            pending.eq((request != self.mode) & (count == 0)),
+            switch.eq(pending & ~self.o_valid),
+            accept.eq(self.i_valid & self.i_ready),
+        ]
+        with m.If(switch):
+            m.d.sync += self.mode.eq(request)
+
+        count_next = Mux(accept, Mux(count == packet_samples[self.mode] - 1, 0, count + 1), count)
+        m.d.sync += count.eq(count_next)
+        with m.If(accept & (count == 0)):
+            m.d.sync += [
+                self.o_frame.eq(self.i_frame),
+                self.o_line.eq(self.i_line),
+                self.o_column.eq(self.i_column),
+            ]
+
+        # Samples wait whilst a flushed packet's last word leaves
+        m.d.comb += self.o_items.eq(Mux(self.o_flush, count, packet_samples[self.mode]))
+        with m.If(self.o_flush):
+            m.d.sync += [
+                count.eq(0),
+                flushing.eq(0),
+            ]
+        with m.Elif(self.i_flush & (count_next != 0)):
+            m.d.sync += flushing.eq(1)
+
+        return m
+
+# Samples with positions through SamplePacker and a Packetizer, switching mode
+# midway and flushing at the end of each frame: each packet must hold the
+# samples from its tagged position, as many as its header counts, packed at
+# the width of the mode its header gives (saturating)
+def sim_samplepacker_1():
+    import random
+    from packetizer import Packetizer, STREAM_SAMPLES, PACKET_HEADER_WORDS, packet_words, stream_word, crc16
+    random.seed(5)
+    modes = [ 16, 12, (24, 12) ]
+    payload_words = stream_payload_words(modes, max_words=30)
+    width, height = 20, 7
+
+    class Bench(Elaboratable):
+        def __init__(self):
+            self.packer = SamplePacker(24, modes, payload_words)
+            self.packetizer = Packetizer(STREAM_SAMPLES, payload_words=payload_words, count_items=True)
+
+        def elaborate(self, platform):
+            m = Module()
+            m.submodules.packer = packer = self.packer
+            m.submodules.packetizer = packetizer = self.packetizer
+            m.d.comb += [
+                packetizer.i_data.eq(packer.o_data),
+                packetizer.i_valid.eq(packer.o_valid),
+                packer.o_ready.eq(packetizer.i_ready),
+                packetizer.frame.eq(packer.o_frame),
+                packetizer.line.eq(packer.o_line),
+                packetizer.column.eq(packer.o_column),
+                packetizer.format.eq(packer.mode),
+                packetizer.items.eq(packer.o_items),
+                packetizer.flush.eq(packer.o_flush),
+            ]
+            return m
+
+    bench = Bench()
+    dut = bench.packer
+    sim = Simulator(bench)
+    sim.add_clock(1.0 / 100e6, domain="sync")
+    samples = [ random.getrandbits(random.choice([ 10, 14, 24 ])) for _ in range(6 * width * height) ]
+    counts = [ random.getrandbits(random.choice([ 4, 13 ])) for _ in samples ]
+    received = []
+
+    # Flush with the last sample of each frame
+    def source_proc():
+        for i, (sample, sample_count) in enumerate(zip(samples, counts)):
+            yield dut.i_sample.eq(sample)
+            yield dut.i_count.eq(sample_count)
+            yield dut.i_frame.eq(i // (width * height))
+            yield dut.i_line.eq(i // width % height)
+            yield dut.i_column.eq(i % width)
+            yield dut.i_valid.eq(1)
+            yield Settle()
+            while not (yield dut.i_ready):
+                yield
+                yield Settle()
+            yield dut.i_flush.eq(i % (width * height) == width * height - 1)
+            yield
+            yield dut.i_flush.eq(0)
+        yield dut.i_valid.eq(0)
+        # Let the last packets drain
+        for _ in range(500):
+            yield
+
+    def host_proc():
+        port = dut.port
+        for mode, delay in [ (1, 150), (2, 250), (0, 250) ]:
+            for _ in range(delay):
+                yield
+            yield port.addr.eq(STREAM_ADDR_MODE)
+            yield port.wdata.eq(mode)
+            yield port.we.eq(1)
+            yield port.stb.eq(1)
+            yield
+            while not (yield port.ack):
+                yield
+            yield port.stb.eq(0)
+
+    def sink_proc():
+        yield Passive()
+        while True:
+            yield bench.packetizer.o_ready.eq(random.random() < 0.7)
+            yield
+            if (yield bench.packetizer.o_valid) and (yield bench.packetizer.o_ready):
+                received.append((yield bench.packetizer.o_data))
+
+    sim.add_sync_process(source_proc, domain="sync")
+    sim.add_sync_process(host_proc, domain="sync")
+    sim.add_sync_process(sink_proc, domain="sync")
+    os.makedirs("sim", exist_ok=True)
+    with sim.write_vcd("sim/samplepacker_1.vcd"):
+        sim.run()
+
+    # Packets follow on from one another; the modes follow in order, each
+    # starting on a packet boundary, and every frame ends a packet
+    n = packet_words(payload_words)
+    packets = [ received[i:i+n] for i in range(0, len(received) - n + 1, n) ]
+    formats = []
+    position = 0
+    sent = []
+    for packet in packets:
+        assert packet[-1] == crc16(packet[:-1]), "bad crc"
+        format = packet[1] >> 9 & 7
+        assert packet[1] == stream_word(STREAM_SAMPLES, payload_words, format), hex(packet[1])
+        frame, line, column, count = packet[3:7]
+        index = (frame * height + line) * width + column
+        assert index == position, (index, position)
+        channels = stream_channels(modes[format])
+        full = payload_words * 16 // sum(channels)
+        assert 0 < count <= full
+        expected = [ [ min(v, (1 << bits) - 1) for v, bits in zip(beat, channels) ]
+                     for beat in zip(samples[index:index + count], counts[index:index + count]) ]
+        packed = pack_bits([ expected ], channels)
+        assert packet[PACKET_HEADER_WORDS:-1] == packed + [ 0 ] * (payload_words - len(packed)), (index, channels)
+        assert (index + count) % (width * height) == 0 or count == full, (index, count)
+        if not formats or formats[-1] != format:
+            formats.append(format)
+        position += count
+        sent += expected
+    assert formats == [ 0, 1, 2, 0 ] and position == len(samples), (formats, position)
+    print("samplepacker: {} packets in modes {} ok, {} samples".format(len(packets), modes, position))
+
+    # For decoding on the host: the uplink words, and the samples (with
+    # counts, for modes which send them) as sent
+    return received, sent, (width, height, payload_words, modes)
+
 if __name__ == "__main__":
-    sim_samplemux_1()
\ No newline at end of file
+    sim_samplemux_1()
+    sim_bitpacker_1()
+    sim_samplepacker_1()
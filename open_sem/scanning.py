@@ -1,12 +1,27 @@
 import os
 from amaranth import *
-from amaranth.sim import Simulator
+from amaranth.lib.cdc import FFSynchronizer
+from amaranth.sim import Settle
+from simulation import Simulator
+
+from commands import RegisterPort, CommitHandshake
 
 
 # Drive the x,y deflection beams for raster scanning.
 # The DAC for the y-deflection is driven directly.
 # The x-beam is driven through the parameters of an
 # external analog linear ramp generator.
+#
+# The beam dwells on each pixel for `dwell` pixel clocks, so pixel rates can
+# go below the pixel clock's range (which starts at several MHz), down to the
+# XADC's sample rate and below.
+#
+# Frames may cover a region of interest (ROI) within the full x_steps, y_steps
+# area, and be subsampled: with stride s the beam moves 2^s steps between
+# pixels and between rows, so an ROI of w x h steps takes ceil(w / 2^s) x
+# ceil(h / 2^s) pixels. Along each row, pixels are grouped in bins of 2^bin,
+# and one sample is emitted per bin (at its last pixel), which downstream
+# averaging can combine over the bin.
 class PixelScan(Elaboratable):
     def __init__(self):
         ############ IN: Scan Config
@@ -24,13 +39,29 @@ class PixelScan(Elaboratable):
         self.x_steps = Signal(12)
         self.y_steps = Signal(12)
 
+        # Region of interest: steps from top-left, and size in steps (0 for
+        # the rest of the area). Clamped to the area when latched.
+        self.roi_x = Signal(12)
+        self.roi_y = Signal(12)
+        self.roi_width = Signal(13)
+        self.roi_height = Signal(13)
+
+        # Subsampling: log2 of the beam steps between pixels / rows
+        self.stride = Signal(3)
+
+        # Binning: log2 of the pixels per emitted sample along a row
+        self.bin = Signal(3)
+
+        # Pixel clocks spent on each pixel (0 is taken as 1)
+        self.dwell = Signal(16)
+
         ############ IN: State Control
         # Pull high to hold raster. Will start scanning on first clock low.
         # Whilst on hold, scan config will be latched in
         self.hold = Signal(reset=1)
 
         ############ OUT: Running Status
-        # Discrete x, y position relative to width, height
+        # Discrete x, y position, counting down from l_x_steps, l_y_steps
         self.pos_x = Signal(16)
         self.pos_y = Signal(16)
 
@@ -43,17 +74,61 @@ class PixelScan(Elaboratable):
         # OUT: blank pulse (one cycle) for end of image
         self.blank_y = Signal()
 
+        # OUT: high whilst a pixel is being scanned (one pixel per dwell cycles)
+        self.scanning = Signal()
+
+        # OUT: high for the first pixel of each bin, and pulse at the end of
+        # the last pixel of each bin, where a sample is emitted
+        self.bin_start = Signal()
+        self.sample = Signal()
+
+        # OUT: position of the sample within the frame (bins, rows)
+        self.column = Signal(12)
+        self.line = Signal(12)
+
         ############ OUT: Latched (running) version of config
+        # Beam parameters are those of the ROI with its stride: l_x_begin and
+        # l_y_begin at the ROI's top-left, l_x_grad and l_y_grad per pixel.
+        # l_x_steps, l_y_steps are the ROI's pixels (less one) per row / column
         self.l_x_begin = Signal(16)
         self.l_y_begin = Signal(16)
         self.l_x_grad = Signal(16)
         self.l_y_grad = Signal(16)
         self.l_x_steps = Signal(12)
         self.l_y_steps = Signal(12)
+        self.l_bin = Signal(3)
+        self.l_dwell = Signal(16)
 
     def elaborate(self, platform):
         m = Module()
 
+        # The ROI is clamped to the area: an offset past its end is taken as
+        # its last step, and a size of 0 or past its end runs to the end
+        def roi_offset(steps, offset):
+            return Mux(offset > steps, steps, offset)[:12]
+
+        # ROI size to pixels at the stride, less one
+        def roi_steps(steps, offset, size):
+            available = steps + 1 - offset
+            size = Mux((size == 0) | (size > available), available, size)
+            return (((size + (C(1, 8) << self.stride) - 1) >> self.stride) - 1)[:12]
+
+        # Beam offset of the ROI's top-left, saturating at the DAC's full scale
+        def roi_begin(begin, offset, grad):
+            begin = begin + offset * grad
+            return Mux(begin > 0xffff, 0xffff, begin)[:16]
+
+        roi_x = roi_offset(self.x_steps, self.roi_x)
+        roi_y = roi_offset(self.y_steps, self.roi_y)
+        x_begin = roi_begin(self.x_begin, roi_x, self.x_grad)
+        y_begin = roi_begin(self.y_begin, roi_y, self.y_grad)
+        x_steps = roi_steps(self.x_steps, roi_x, self.roi_width)
+        y_steps = roi_steps(self.y_steps, roi_y, self.roi_height)
+        dwell = Mux(self.dwell == 0, 1, self.dwell)
+
+        # Pixel clocks left on the current pixel, less one
+        dwell_count = Signal(16)
+
         # Finite state machine (FSM): Starts in first state, "HOLD".
         # FSM accepts changes to parameters in HOLD state whilst hold
         # signal is applied. Scanning begins when this goes low.
@@ -63,19 +138,22 @@ class PixelScan(Elaboratable):
             with m.State("HOLD"):
                 m.d.pixel += [
                     # Sync user config
-                    self.l_x_begin.eq(self.x_begin),
-                    self.l_y_begin.eq(self.y_begin),
-                    self.l_x_grad.eq(self.x_grad),
-                    self.l_y_grad.eq(self.y_grad),
-                    self.l_x_steps.eq(self.x_steps),
-                    self.l_y_steps.eq(self.y_steps),
+                    self.l_x_begin.eq(x_begin),
+                    self.l_y_begin.eq(y_begin),
+                    self.l_x_grad.eq(self.x_grad << self.stride),
+                    self.l_y_grad.eq(self.y_grad << self.stride),
+                    self.l_x_steps.eq(x_steps),
+                    self.l_y_steps.eq(y_steps),
+                    self.l_bin.eq(self.bin),
+                    self.l_dwell.eq(dwell),
 
                     # Set starting values
+                    dwell_count.eq(dwell - 1),
                     self.blank_x.eq(0),
                     self.blank_y.eq(0),
-                    self.pos_x.eq(self.x_steps),
-                    self.pos_y.eq(self.y_steps),
-                    self.dac_y.eq(self.y_begin)
+                    self.pos_x.eq(x_steps),
+                    self.pos_y.eq(y_steps),
+                    self.dac_y.eq(y_begin)
                 ]
 
                 with m.If(self.hold):
@@ -84,26 +162,32 @@ class PixelScan(Elaboratable):
                     m.next = "SCAN"
 
             with m.State("SCAN"):
-                with m.If(self.pos_x > 0):
-                    m.d.pixel += self.pos_x.eq(self.pos_x - 1)
+                with m.If(dwell_count != 0):
+                    m.d.pixel += dwell_count.eq(dwell_count - 1)
+                with m.Elif(self.pos_x > 0):
+                    m.d.pixel += [
+                        self.pos_x.eq(self.pos_x - 1),
+                        dwell_count.eq(self.l_dwell - 1),
+                    ]
                     m.next = "SCAN"
                 with m.Else():
                     m.d.pixel += [
                         self.pos_x.eq(self.l_x_steps),
-                        self.blank_x.eq(1)
+                        self.blank_x.eq(1),
+                        dwell_count.eq(self.l_dwell - 1),
                     ]
                     with m.If(self.pos_y > 0):
                         m.d.pixel += [
                             # Move y deflector beam
                             self.pos_y.eq(self.pos_y - 1),
-                            self.dac_y.eq(self.dac_y + self.y_grad)
+                            self.dac_y.eq(self.dac_y + self.l_y_grad)
                         ]
                         m.next = "ROW_BLANK"
                     with m.Else():
                         m.d.pixel += [
-                            self.pos_y.eq(self.y_steps),
+                            self.pos_y.eq(self.l_y_steps),
                             self.blank_y.eq(1),
-                            self.dac_y.eq(self.dac_y + self.y_grad),
+                            self.dac_y.eq(self.dac_y + self.l_y_grad),
                         ]
                         m.next = "HOLD"
 
@@ -112,8 +196,605 @@ class PixelScan(Elaboratable):
                 m.d.pixel += self.blank_x.eq(0)
                 m.next = "SCAN"
 
+        # Pixel within the row, and within its bin. The last bin of a row may
+        # be partial.
+        pixel = (self.l_x_steps - self.pos_x)[:12]
+        bin_mask = ((C(1, 8) << self.l_bin) - 1)[:8]
+        m.d.comb += [
+            self.scanning.eq(fsm.ongoing("SCAN")),
+            self.bin_start.eq(self.scanning & ((pixel & bin_mask) == 0)),
+            self.sample.eq(self.scanning & (dwell_count == 0) & (((pixel & bin_mask) == bin_mask) | (self.pos_x == 0))),
+            self.column.eq(pixel >> self.l_bin),
+            self.line.eq(self.l_y_steps - self.pos_y),
+        ]
+
+        return m
+
+# Raster scan configuration registers, reachable from host commands. Registers
+# are written in the sync domain, then committed: the pixel domain takes them
+# all at once, and PixelScan latches them at the start of its next frame.
+# Accesses are acked at once, so never hold up the command decoder. Whilst a
+# commit is pending (status bit 0), writes are dropped, setting overrun
+# (status bit 1, cleared by reading the status): the host waits for pending
+# to clear before writing again.
+SCAN_ADDR_X_BEGIN    = 0
+SCAN_ADDR_Y_BEGIN    = 1
+SCAN_ADDR_X_GRAD     = 2
+SCAN_ADDR_Y_GRAD     = 3
+SCAN_ADDR_X_STEPS    = 4
+SCAN_ADDR_Y_STEPS    = 5
+SCAN_ADDR_ROI_X      = 6
+SCAN_ADDR_ROI_Y      = 7
+SCAN_ADDR_ROI_WIDTH  = 8
+SCAN_ADDR_ROI_HEIGHT = 9
+SCAN_ADDR_SUBSAMPLE  = 10 # stride[2:0], bin[6:4]
+SCAN_ADDR_HOLD       = 11
+SCAN_ADDR_COMMIT     = 12
+SCAN_ADDR_DWELL      = 13 # pixel clocks per pixel (>= 1)
+
+def scan_subsample(stride=0, bin=0):
+    assert 0 <= stride < 8 and 0 <= bin < 8
+    return stride | (bin << 4)
+
+class ScanRegisters(Elaboratable):
+    def __init__(self, scan : PixelScan):
+        self.scan = scan
+        self.port = RegisterPort("pixel_scan")
+
+        # Reset values: full 4096 x 4096 frames, free running
+        self.reset = { SCAN_ADDR_X_STEPS: 4095, SCAN_ADDR_Y_STEPS: 4095 }
+
+        # OUT (pixel domain): hold requested by the host
+        self.hold = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        port = self.port
+        scan = self.scan
+
+        m.submodules.commit_cdc = commit_cdc = CommitHandshake(o_domain="pixel")
+
+        # The pixel domain's copy is reset-less, so it is kept whilst the pixel
+        # domain is held in reset for a change of pixel clock
+        # (the slot at SCAN_ADDR_COMMIT is unused)
+        count = SCAN_ADDR_DWELL + 1
+        cfg = Array([ Signal(16, name="scan_cfg{}".format(i), reset=self.reset.get(i, 0)) for i in range(count) ])
+        pixel_cfg = [ Signal(16, name="scan_pixel_cfg{}".format(i), reset=self.reset.get(i, 0), reset_less=True) for i in range(count) ]
+        pending = commit_cdc.pending
+        overrun = Signal()
+        status_read = Signal()
+
+        m.d.sync += port.ack.eq(port.stb & ~port.ack)
+        m.d.comb += port.rdata.eq(Mux(port.addr == SCAN_ADDR_COMMIT, Cat(pending, overrun), cfg[port.addr[:4]]))
+        # The status is read as it is acked, then overrun clears
+        m.d.sync += status_read.eq(port.stb & ~port.ack & ~port.we & (port.addr == SCAN_ADDR_COMMIT))
+        with m.If(status_read):
+            m.d.sync += overrun.eq(0)
+        with m.If(port.stb & ~port.ack & port.we):
+            with m.If(pending):
+                m.d.sync += overrun.eq(1)
+            with m.Elif(port.addr == SCAN_ADDR_COMMIT):
+                m.d.comb += commit_cdc.commit.eq(1)
+            with m.Elif(port.addr < count):
+                m.d.sync += cfg[port.addr[:4]].eq(port.wdata)
+
+        # cfg is held steady whilst pending, so is safe to take across
+        m.d.comb += commit_cdc.o_take.eq(commit_cdc.o_pending)
+        with m.If(commit_cdc.o_pending):
+            m.d.pixel += [ p.eq(c) for p, c in zip(pixel_cfg, cfg) ]
+
+        subsample = pixel_cfg[SCAN_ADDR_SUBSAMPLE]
+        m.d.comb += [
+            scan.x_begin.eq(pixel_cfg[SCAN_ADDR_X_BEGIN]),
+            scan.y_begin.eq(pixel_cfg[SCAN_ADDR_Y_BEGIN]),
+            scan.x_grad.eq(pixel_cfg[SCAN_ADDR_X_GRAD]),
+            scan.y_grad.eq(pixel_cfg[SCAN_ADDR_Y_GRAD]),
+            scan.x_steps.eq(pixel_cfg[SCAN_ADDR_X_STEPS]),
+            scan.y_steps.eq(pixel_cfg[SCAN_ADDR_Y_STEPS]),
+            scan.roi_x.eq(pixel_cfg[SCAN_ADDR_ROI_X]),
+            scan.roi_y.eq(pixel_cfg[SCAN_ADDR_ROI_Y]),
+            scan.roi_width.eq(pixel_cfg[SCAN_ADDR_ROI_WIDTH]),
+            scan.roi_height.eq(pixel_cfg[SCAN_ADDR_ROI_HEIGHT]),
+            scan.stride.eq(subsample[0:3]),
+            scan.bin.eq(subsample[4:7]),
+            scan.dwell.eq(pixel_cfg[SCAN_ADDR_DWELL]),
+            self.hold.eq(pixel_cfg[SCAN_ADDR_HOLD][0]),
+        ]
+
         return m
-   
+
+############################################################
+# Arbitrary scan paths
+#
+# PathScan plays back a path of points in the pixel domain, dwelling on each
+# for a configurable number of pixel clocks and strobing `sample` as it leaves
+# each point. Points are visited on a width x height grid, in one of the
+# orders below, and come either from
+#   PATH_SOURCE_RASTER : the grid itself, at x_begin + col * x_step (and y alike)
+#   PATH_SOURCE_LIST   : a host uploaded list of (x, y) points in block RAM
+#                        (width = number of points, height = 1)
+# Optionally each point is jittered by a random offset of up to +-2^(jitter_bits-1).
+#
+# Configuration is written through a RegisterPort (sync domain, so reachable
+# from host commands), then committed. Lists are double buffered: whilst one
+# bank plays, the next path is loaded into the other, and a commit swaps them
+# over at the end of the current path. As for ScanRegisters, accesses are
+# acked at once, and writes whilst a commit is pending (status bit 0) are
+# dropped, setting overrun (status bit 3, cleared by reading the status).
+
+PATH_SOURCE_RASTER = 0
+PATH_SOURCE_LIST   = 1
+
+PATH_ORDER_LINEAR     = 0 # row by row, left to right
+PATH_ORDER_SERPENTINE = 1 # alternate rows run right to left
+PATH_ORDER_INTERLACED = 2 # even rows then odd rows
+PATH_ORDER_RANDOM     = 3 # every point once per path, in pseudo random order
+
+# Register port addresses
+PATH_ADDR_CONTROL = 0 # enable[0], source[1], order[3:2], jitter_bits[7:4]
+PATH_ADDR_DWELL   = 1 # pixel clocks per point (>= 1)
+PATH_ADDR_WIDTH   = 2 # points per row (list: number of points)
+PATH_ADDR_HEIGHT  = 3 # rows
+PATH_ADDR_X_BEGIN = 4
+PATH_ADDR_Y_BEGIN = 5
+PATH_ADDR_X_STEP  = 6
+PATH_ADDR_Y_STEP  = 7
+PATH_ADDR_POINTS  = 8 # list points, x then y, appended to the load bank
+PATH_ADDR_COMMIT  = 9 # write to commit; read for status: pending[0], running[1], load_bank[2], overrun[3]
+PATH_ADDR_RESTART = 10 # write to restart loading points from the start of the load bank
+
+def path_control(enable=True, source=PATH_SOURCE_RASTER, order=PATH_ORDER_LINEAR, jitter_bits=0):
+    return int(enable) | (source << 1) | (order << 2) | (jitter_bits << 4)
+
+# Fibonacci LFSR taps (XAPP052) for n bits. Used as de Bruijn counters (the
+# all zero state is spliced in) so that all 2^n states are visited.
+LFSR_TAPS = {
+    1: (1,), 2: (2,1), 3: (3,2), 4: (4,3), 5: (5,3), 6: (6,5), 7: (7,6), 8: (8,6,5,4),
+    9: (9,5), 10: (10,7), 11: (11,9), 12: (12,6,4,1), 13: (13,4,3,1), 14: (14,5,3,1),
+    15: (15,14), 16: (16,15,13,4), 17: (17,14), 18: (18,11), 19: (19,6,2,1), 20: (20,17),
+    21: (21,19), 22: (22,21), 23: (23,18), 24: (24,23,22,17),
+}
+
+def lfsr_tap_mask(n):
+    return sum(1 << (t-1) for t in LFSR_TAPS[n]) if n > 0 else 0
+
+def de_bruijn_step(s, n):
+    if n == 0:
+        return 0
+    fb = (bin(s & lfsr_tap_mask(n)).count("1") & 1) ^ ((s & ((1 << (n-1)) - 1)) == 0)
+    return ((s << 1) | fb) & ((1 << n) - 1)
+
+# Reference for the order points are visited in: list of (col, row)
+def path_order(order, width, height):
+    if order == PATH_ORDER_LINEAR:
+        return [ (c, r) for r in range(height) for c in range(width) ]
+    elif order == PATH_ORDER_SERPENTINE:
+        return [ (c if r % 2 == 0 else width - 1 - c, r) for r in range(height) for c in range(width) ]
+    elif order == PATH_ORDER_INTERLACED:
+        rows = list(range(0, height, 2)) + list(range(1, height, 2))
+        return [ (c, r) for r in rows for c in range(width) ]
+    elif order == PATH_ORDER_RANDOM:
+        col_bits, row_bits = (width - 1).bit_length(), (height - 1).bit_length()
+        n = col_bits + row_bits
+        points = []
+        s = 0
+        for _ in range(1 << n):
+            c, r = s & ((1 << col_bits) - 1), s >> col_bits
+            if c < width and r < height:
+                points.append((c, r))
+            s = de_bruijn_step(s, n)
+        return points
+    assert False
+
+class PathScan(Elaboratable):
+    def __init__(self, max_points=1024, grid_bits=12):
+        self.max_points = max_points
+        self.grid_bits = grid_bits
+
+        ############ IN: configuration and lists (sync domain)
+        self.port = RegisterPort("path_scan")
+
+        ############ OUT: Running Status (pixel domain)
+        # High whilst a path is playing
+        self.running = Signal()
+
+        # Beam position for the current point
+        self.x = Signal(16)
+        self.y = Signal(16)
+
+        # Grid position of the current point
+        self.col = Signal(grid_bits)
+        self.row = Signal(grid_bits)
+
+        # Pulse (one cycle) as the current point is left, having dwelt on it
+        self.sample = Signal()
+
+        # Pulse (one cycle) at the end of each path, and count of paths completed
+        self.path_done = Signal()
+        self.frame = Signal(16, reset_less=True)
+
+    def elaborate(self, platform):
+        m = Module()
+        port = self.port
+        index_bits = Shape.cast(range(self.max_points)).width
+        max_lfsr_bits = 2 * self.grid_bits
+        assert max_lfsr_bits <= max(LFSR_TAPS)
+
+        mem = Memory(width=32, depth=2 * self.max_points)
+        m.submodules.mem_w = mem_w = mem.write_port(domain="sync")
+        m.submodules.mem_r = mem_r = mem.read_port(domain="pixel", transparent=False)
+
+        m.submodules.commit_cdc = commit_cdc = CommitHandshake(o_domain="pixel")
+
+        ############################################################
+        # Sync domain: registers, list loading, commits
+
+        cfg = Array([ Signal(16, name="path_cfg{}".format(i)) for i in range(PATH_ADDR_Y_STEP + 1) ])
+        pending = commit_cdc.pending
+        load_bank = Signal()
+        load_ptr = Signal(range(self.max_points + 1))
+        point_x = Signal(16)
+        point_half = Signal()
+        running_sync = Signal()
+        overrun = Signal()
+        status_read = Signal()
+
+        write = Signal()
+        m.d.sync += port.ack.eq(port.stb & ~port.ack)
+        m.d.comb += [
+            write.eq(port.stb & ~port.ack & port.we & ~pending),
+            port.rdata.eq(Mux(port.addr == PATH_ADDR_COMMIT, Cat(pending, running_sync, load_bank, overrun),
+                              Mux(port.addr <= PATH_ADDR_Y_STEP, cfg[port.addr[:3]], load_ptr))),
+            mem_w.addr.eq(Cat(load_ptr[:index_bits], load_bank)),
+            mem_w.data.eq(Cat(point_x, port.wdata)),
+        ]
+
+        # The status is read as it is acked, then overrun clears
+        m.d.sync += status_read.eq(port.stb & ~port.ack & ~port.we & (port.addr == PATH_ADDR_COMMIT))
+        with m.If(port.stb & ~port.ack & port.we & pending):
+            m.d.sync += overrun.eq(1)
+        with m.Elif(status_read):
+            m.d.sync += overrun.eq(0)
+
+        with m.If(write):
+            with m.If(port.addr <= PATH_ADDR_Y_STEP):
+                m.d.sync += cfg[port.addr[:3]].eq(port.wdata)
+            with m.Elif(port.addr == PATH_ADDR_POINTS):
+                m.d.sync += point_half.eq(~point_half)
+                with m.If(~point_half):
+                    m.d.sync += point_x.eq(port.wdata)
+                with m.Elif(load_ptr < self.max_points):
+                    m.d.comb += mem_w.en.eq(1)
+                    m.d.sync += load_ptr.eq(load_ptr + 1)
+            with m.Elif(port.addr == PATH_ADDR_COMMIT):
+                m.d.comb += commit_cdc.commit.eq(1)
+                m.d.sync += [
+                    load_bank.eq(~load_bank),
+                    load_ptr.eq(0),
+                    point_half.eq(0),
+                ]
+            with m.Elif(port.addr == PATH_ADDR_RESTART):
+                m.d.sync += [
+                    load_ptr.eq(0),
+                    point_half.eq(0),
+                ]
+
+        # Status only, so a two flop synchronizer will do
+        m.submodules.running_cdc = FFSynchronizer(self.running, running_sync, o_domain="sync")
+
+        ############################################################
+        # Pixel domain: latch configuration, step through the path
+
+        # Latched configuration. The sync side holds cfg and the committed bank
+        # (~load_bank) steady until the latch is taken. It is reset-less, so
+        # that after the pixel domain is reset for a change of pixel clock, an
+        # enabled path starts over.
+        enable      = Signal(reset_less=True)
+        source      = Signal(reset_less=True)
+        order       = Signal(2, reset_less=True)
+        jitter_bits = Signal(4, reset_less=True)
+        dwell       = Signal(16, reset_less=True)
+        width       = Signal(self.grid_bits + 1, reset_less=True)
+        height      = Signal(self.grid_bits + 1, reset_less=True)
+        x_begin     = Signal(16, reset_less=True)
+        y_begin     = Signal(16, reset_less=True)
+        x_step      = Signal(16, reset_less=True)
+        y_step      = Signal(16, reset_less=True)
+        bank        = Signal(reset_less=True)
+        col_bits    = Signal(range(self.grid_bits + 1))
+        row_bits    = Signal(range(self.grid_bits + 1))
+        total       = Signal(2 * self.grid_bits + 1)
+
+        commit_pending = commit_cdc.o_pending
+
+        def latch():
+            control = cfg[PATH_ADDR_CONTROL]
+            w = Mux(control[1], Mux(cfg[PATH_ADDR_WIDTH] > self.max_points, self.max_points, cfg[PATH_ADDR_WIDTH]), cfg[PATH_ADDR_WIDTH])
+            h = Mux(control[1], 1, cfg[PATH_ADDR_HEIGHT])
+            m.d.pixel += [
+                enable.eq(control[0] & (w != 0) & (h != 0)),
+                source.eq(control[1]),
+                order.eq(control[2:4]),
+                jitter_bits.eq(control[4:8]),
+                dwell.eq(Mux(cfg[PATH_ADDR_DWELL] == 0, 1, cfg[PATH_ADDR_DWELL])),
+                width.eq(w),
+                height.eq(h),
+                x_begin.eq(cfg[PATH_ADDR_X_BEGIN]),
+                y_begin.eq(cfg[PATH_ADDR_Y_BEGIN]),
+                x_step.eq(cfg[PATH_ADDR_X_STEP]),
+                y_step.eq(cfg[PATH_ADDR_Y_STEP]),
+                bank.eq(~load_bank),
+            ]
+            m.d.comb += commit_cdc.o_take.eq(1)
+
+        # Bits needed for the largest column / row
+        def bit_length(v):
+            n = C(0, range(self.grid_bits + 1))
+            for i in range(self.grid_bits + 1):
+                n = Mux(v >= (1 << i), i + 1, n)
+            return n
+
+        # Position of the next point to visit, and whether it is on the grid
+        # (random order steps through states which are not). Random order
+        # takes col / row from the bits of a de Bruijn counter.
+        col  = Signal(self.grid_bits + 1)
+        row  = Signal(self.grid_bits + 1)
+        scan_col = Signal(self.grid_bits + 1)
+        scan_row = Signal(self.grid_bits + 1)
+        lfsr = Signal(max_lfsr_bits)
+        lfsr_n = Signal(range(max_lfsr_bits + 1))
+        on_grid = Signal()
+        step = Signal()
+        restart = Signal()
+
+        lfsr_taps = Array([ C(lfsr_tap_mask(n), max_lfsr_bits) for n in range(max_lfsr_bits + 1) ])
+        lfsr_low  = Array([ C((1 << (n-1)) - 1 if n > 0 else 0, max_lfsr_bits) for n in range(max_lfsr_bits + 1) ])
+        lfsr_full = Array([ C((1 << n) - 1, max_lfsr_bits) for n in range(max_lfsr_bits + 1) ])
+        lfsr_fb = (lfsr & lfsr_taps[lfsr_n]).xor() ^ ((lfsr & lfsr_low[lfsr_n]) == 0)
+        lfsr_next = (Cat(lfsr_fb, lfsr) & lfsr_full[lfsr_n])[:max_lfsr_bits]
+
+        with m.If(order == PATH_ORDER_RANDOM):
+            m.d.comb += [
+                col.eq(lfsr & ((1 << col_bits) - 1)),
+                row.eq(lfsr >> col_bits),
+                on_grid.eq((col < width) & (row < height)),
+            ]
+        with m.Else():
+            m.d.comb += [
+                col.eq(scan_col),
+                row.eq(scan_row),
+                on_grid.eq(1),
+            ]
+
+        last_col = scan_col == width - 1
+        with m.If(restart):
+            m.d.pixel += [
+                scan_col.eq(0),
+                scan_row.eq(0),
+                lfsr.eq(0),
+            ]
+        with m.Elif(step):
+            with m.Switch(order):
+                with m.Case(PATH_ORDER_LINEAR, PATH_ORDER_INTERLACED):
+                    with m.If(last_col):
+                        m.d.pixel += scan_col.eq(0)
+                        with m.If(order == PATH_ORDER_INTERLACED):
+                            with m.If(scan_row + 2 < height):
+                                m.d.pixel += scan_row.eq(scan_row + 2)
+                            with m.Else():
+                                m.d.pixel += scan_row.eq(Mux(scan_row[0], 0, 1))
+                        with m.Else():
+                            m.d.pixel += scan_row.eq(scan_row + 1)
+                    with m.Else():
+                        m.d.pixel += scan_col.eq(scan_col + 1)
+                with m.Case(PATH_ORDER_SERPENTINE):
+                    with m.If(Mux(scan_row[0], scan_col == 0, last_col)):
+                        m.d.pixel += scan_row.eq(scan_row + 1)
+                    with m.Elif(scan_row[0]):
+                        m.d.pixel += scan_col.eq(scan_col - 1)
+                    with m.Else():
+                        m.d.pixel += scan_col.eq(scan_col + 1)
+                with m.Case(PATH_ORDER_RANDOM):
+                    m.d.pixel += lfsr.eq(lfsr_next)
+
+        # List points are read a cycle ahead, so address the point being moved to
+        m.d.comb += mem_r.addr.eq(Cat(Mux(step, Mux(last_col, 0, scan_col + 1), scan_col)[:index_bits], bank))
+        with m.If(order == PATH_ORDER_RANDOM):
+            m.d.comb += mem_r.addr.eq(Cat(Mux(step, lfsr_next, lfsr)[:index_bits], bank))
+
+        # Jitter from a free running LFSR (Galois, 32 bit)
+        noise = Signal(32, reset=1)
+        m.d.pixel += noise.eq(Mux(noise[0], (noise >> 1) ^ 0x80200003, noise >> 1))
+        jitter_mask = Signal(2**len(jitter_bits) - 1)
+        m.d.comb += jitter_mask.eq((1 << jitter_bits) - 1)
+        def jitter(v):
+            return Mux(jitter_bits == 0, 0, ((v & jitter_mask) - (jitter_mask >> 1)).as_signed())
+
+        # Jittered positions saturate at the DAC's full scale, rather than wrap
+        def jittered(point, v):
+            p = point + jitter(v)
+            return Mux(p < 0, 0, Mux(p > 0xffff, 0xffff, p[:16]))
+
+        point_x = Mux(source, mem_r.data[:16], x_begin + col * x_step)
+        point_y = Mux(source, mem_r.data[16:], y_begin + row * y_step)
+
+        remaining = Signal(2 * self.grid_bits + 1)
+        dwell_count = Signal(16)
+        have_point = Signal()
+
+        with m.FSM(domain="pixel") as fsm:
+            with m.State("HOLD"):
+                with m.If(commit_pending):
+                    latch()
+                    m.next = "START"
+                with m.Elif(enable):
+                    m.next = "START"
+
+            with m.State("START"):
+                m.d.comb += restart.eq(1)
+                m.d.pixel += [
+                    col_bits.eq(bit_length(width - 1)),
+                    row_bits.eq(bit_length(height - 1)),
+                    total.eq(width * height),
+                    have_point.eq(0),
+                    dwell_count.eq(0),
+                ]
+                m.next = "PRIME"
+
+            with m.State("PRIME"):
+                # Generator restarted, list memory addressed
+                m.d.pixel += [
+                    lfsr_n.eq(col_bits + row_bits),
+                    remaining.eq(total),
+                ]
+                with m.If(enable):
+                    m.next = "RUN"
+                with m.Else():
+                    m.next = "HOLD"
+
+            with m.State("RUN"):
+                m.d.comb += self.running.eq(1)
+                with m.If(dwell_count != 0):
+                    m.d.pixel += dwell_count.eq(dwell_count - 1)
+                with m.Elif(remaining == 0):
+                    # Leave the last point, and start the next path
+                    m.d.comb += [
+                        self.sample.eq(have_point),
+                        self.path_done.eq(1),
+                    ]
+                    m.d.pixel += self.frame.eq(self.frame + 1)
+                    with m.If(commit_pending):
+                        latch()
+                    m.next = "START"
+                with m.Elif(~on_grid):
+                    m.d.comb += step.eq(1)
+                with m.Else():
+                    m.d.comb += [
+                        self.sample.eq(have_point),
+                        step.eq(1),
+                    ]
+                    m.d.pixel += [
+                        self.col.eq(col),
+                        self.row.eq(row),
+                        self.x.eq(jittered(point_x, noise[:16])),
+                        self.y.eq(jittered(point_y, noise[16:])),
+                        have_point.eq(1),
+                        dwell_count.eq(dwell - 1),
+                        remaining.eq(remaining - 1),
+                    ]
+
+        return m
+
+# Plays paths configured through the register port. Each entry of programs is
+# (registers, points) for one commit, where registers is a dict of address to
+# value and points a list of (x, y) for list paths. Returns the samples
+# (col, row, x, y) of each path played, until `paths` are complete, and
+# whether the status reported an overrun once all programs were sent. poll is
+# whether to wait for a pending commit before sending each program (a list,
+# one per program, or one for all).
+def run_pathscan(programs, paths, vcd=None, poll=True):
+    dut = PathScan(max_points=64, grid_bits=6)
+    sim = Simulator(dut)
+    sim.add_clock(1.0 / 100e6, domain="sync")
+    sim.add_clock(1.0 / 37e6, domain="pixel")
+    port = dut.port
+    played = [ [] ]
+    status = []
+    if not isinstance(poll, list):
+        poll = [ poll ] * len(programs)
+
+    def access(addr, data=0, we=1):
+        yield port.addr.eq(addr)
+        yield port.wdata.eq(data)
+        yield port.we.eq(we)
+        yield port.stb.eq(1)
+        yield
+        yield Settle()
+        while not (yield port.ack):
+            yield
+            yield Settle()
+        yield port.stb.eq(0)
+        return (yield port.rdata)
+
+    def host_proc():
+        for (registers, points), wait in zip(programs, poll):
+            # Wait for the previous commit to be latched
+            while wait and (yield from access(PATH_ADDR_COMMIT, we=0)) & 1:
+                yield
+            for addr, value in registers.items():
+                yield from access(addr, value)
+            for x, y in points:
+                yield from access(PATH_ADDR_POINTS, x)
+                yield from access(PATH_ADDR_POINTS, y)
+            yield from access(PATH_ADDR_COMMIT)
+        status.append((yield from access(PATH_ADDR_COMMIT, we=0)))
+        while len(played) <= paths:
+            yield
+
+    def pixel_proc():
+        while len(played) <= paths:
+            yield Settle()
+            if (yield dut.sample):
+                played[-1].append(((yield dut.col), (yield dut.row), (yield dut.x), (yield dut.y)))
+            if (yield dut.path_done):
+                played.append([])
+            yield
+
+    sim.add_sync_process(host_proc, domain="sync")
+    sim.add_sync_process(pixel_proc, domain="pixel")
+    if vcd:
+        os.makedirs("sim", exist_ok=True)
+        with sim.write_vcd(vcd):
+            sim.run()
+    else:
+        sim.run()
+    return played[:paths], bool(status[0] & 8)
+
+def sim_pathscan_1():
+    width, height = 5, 3
+    raster = {
+        PATH_ADDR_DWELL: 2, PATH_ADDR_WIDTH: width, PATH_ADDR_HEIGHT: height,
+        PATH_ADDR_X_BEGIN: 100, PATH_ADDR_Y_BEGIN: 50, PATH_ADDR_X_STEP: 10, PATH_ADDR_Y_STEP: 7,
+    }
+    for order in [PATH_ORDER_LINEAR, PATH_ORDER_SERPENTINE, PATH_ORDER_INTERLACED, PATH_ORDER_RANDOM]:
+        registers = dict(raster)
+        registers[PATH_ADDR_CONTROL] = path_control(order=order)
+        played, _ = run_pathscan([ (registers, []) ], 2, vcd="sim/pathscan_1.vcd" if order == PATH_ORDER_RANDOM else None)
+        expected = [ (c, r, 100 + 10*c, 50 + 7*r) for c, r in path_order(order, width, height) ]
+        assert played == [ expected, expected ], (order, played)
+
+    # Jitter stays within +-2^(bits-1) of each point, and saturates at the
+    # ends of the DAC's range
+    registers = dict(raster)
+    registers[PATH_ADDR_CONTROL] = path_control(jitter_bits=3)
+    for c, r, x, y in run_pathscan([ (registers, []) ], 1)[0][0]:
+        assert abs(x - (100 + 10*c)) <= 4 and abs(y - (50 + 7*r)) <= 4
+    registers.update({ PATH_ADDR_CONTROL: path_control(jitter_bits=12), PATH_ADDR_X_BEGIN: 0, PATH_ADDR_X_STEP: 0,
+                       PATH_ADDR_Y_BEGIN: 0xffff, PATH_ADDR_Y_STEP: 0 })
+    points = run_pathscan([ (registers, []) ], 1)[0][0]
+    assert all(x <= 2048 and y >= 0xffff - 2048 for _, _, x, y in points), points
+    assert any(x == 0 for _, _, x, _ in points) and any(y == 0xffff for _, _, _, y in points), points
+
+    # Lists, double buffered: the second list takes over at the end of a path
+    list_a = [ (1000 + i, 2000 + 3*i) for i in range(6) ]
+    list_b = [ (5, 6), (7, 8), (9, 10) ]
+    program_a = { PATH_ADDR_CONTROL: path_control(source=PATH_SOURCE_LIST), PATH_ADDR_DWELL: 3, PATH_ADDR_WIDTH: len(list_a) }
+    program_b = { PATH_ADDR_CONTROL: path_control(source=PATH_SOURCE_LIST, order=PATH_ORDER_RANDOM), PATH_ADDR_WIDTH: len(list_b) }
+    path_a = [ (i, 0, x, y) for i, (x, y) in enumerate(list_a) ]
+    path_b = [ (i, 0, list_b[i][0], list_b[i][1]) for i, _ in path_order(PATH_ORDER_RANDOM, len(list_b), 1) ]
+    played, overrun = run_pathscan([ (program_a, list_a), (program_b, list_b) ], 4)
+    assert played[0] == path_a and played[-1] == path_b and all(p in (path_a, path_b) for p in played), played
+    assert not overrun
+
+    # Writes sent whilst a commit is pending are dropped, and reported: c is
+    # sent without waiting whilst b waits for the end of a's (long) path
+    program_a[PATH_ADDR_DWELL] = 50
+    program_c = { PATH_ADDR_CONTROL: path_control(source=PATH_SOURCE_LIST), PATH_ADDR_WIDTH: 2 }
+    played, overrun = run_pathscan([ (program_a, list_a), (program_b, list_b), (program_c, [ (1, 2), (3, 4) ]) ], 3,
+                                   poll=[ True, True, False ])
+    assert played == [ path_a, path_b, path_b ] and overrun, played
+    print("pathscan: orders, jitter, double buffered lists and overruns ok")
+
 def sim_pixelscan_1():
     dut = PixelScan()
     sim = Simulator(dut)
@@ -134,5 +815,241 @@ def sim_pixelscan_1():
     with sim.write_vcd("sim/pixelscan_1.vcd"):
         sim.run_until(1e-3) # 1ms
         
+# Reference for the samples of a PixelScan frame: (column, line, dac_y) of each
+def pixelscan_samples(x_steps, y_steps, y_begin=0, y_grad=0, roi_x=0, roi_y=0, roi_width=0, roi_height=0, stride=0, bin=0):
+    def pixels(steps, offset, size):
+        size = size if 0 < size <= steps + 1 - offset else steps + 1 - offset
+        return -(-size // (1 << stride))
+    roi_x, roi_y = min(roi_x, x_steps), min(roi_y, y_steps)
+    width = pixels(x_steps, roi_x, roi_width)
+    height = pixels(y_steps, roi_y, roi_height)
+    y_begin = min(y_begin + roi_y * y_grad, 0xffff)
+    mask = (1 << bin) - 1
+    return [ (c >> bin, r, (y_begin + ((r << stride) * y_grad)) & 0xffff)
+             for r in range(height) for c in range(width) if (c & mask) == mask or c == width - 1 ]
+
+# Frames scanned through ScanRegisters: configures with registers (a dict of
+# address to value), then collects the samples of the frames which follow
+def sim_pixelscan_2():
+    class TopTest(Elaboratable):
+        def __init__(self):
+            self.scan = PixelScan()
+            self.registers = ScanRegisters(self.scan)
+            # Small frames from reset, rather than 4096 x 4096
+            self.registers.reset = dict(base)
+
+        def elaborate(self, platform):
+            m = Module()
+            m.submodules.scan = self.scan
+            m.submodules.registers = self.registers
+            m.d.comb += self.scan.hold.eq(self.registers.hold)
+            return m
+
+    base = { SCAN_ADDR_X_STEPS: 19, SCAN_ADDR_Y_STEPS: 9, SCAN_ADDR_X_BEGIN: 1000, SCAN_ADDR_X_GRAD: 30,
+             SCAN_ADDR_Y_BEGIN: 200, SCAN_ADDR_Y_GRAD: 130 }
+    configs = [
+        {},
+        { SCAN_ADDR_ROI_X: 4, SCAN_ADDR_ROI_Y: 2, SCAN_ADDR_ROI_WIDTH: 7, SCAN_ADDR_ROI_HEIGHT: 5 },
+        { SCAN_ADDR_ROI_X: 3, SCAN_ADDR_SUBSAMPLE: scan_subsample(stride=2) },
+        { SCAN_ADDR_ROI_Y: 1, SCAN_ADDR_ROI_WIDTH: 11, SCAN_ADDR_SUBSAMPLE: scan_subsample(stride=1, bin=2) },
+        # Clamped to the area: offsets and sizes past its end, and a beam
+        # offset past full scale
+        { SCAN_ADDR_ROI_X: 30, SCAN_ADDR_ROI_Y: 6, SCAN_ADDR_ROI_HEIGHT: 9 },
+        { SCAN_ADDR_ROI_X: 15, SCAN_ADDR_ROI_WIDTH: 4000, SCAN_ADDR_X_GRAD: 5000 },
+        # Several pixel clocks per pixel
+        { SCAN_ADDR_DWELL: 3, SCAN_ADDR_SUBSAMPLE: scan_subsample(bin=1) },
+    ]
+
+    for config in configs:
+        registers = { **base, **config }
+        dut = TopTest()
+        sim = Simulator(dut)
+        sim.add_clock(1.0 / 100e6, domain="sync")
+        sim.add_clock(1.0 / 37e6, domain="pixel")
+        port = dut.registers.port
+        frames = [ [] ]
+        latched = []
+        frame_ends = []
+
+        def access(addr, data=0, we=1):
+            yield port.addr.eq(addr)
+            yield port.wdata.eq(data)
+            yield port.we.eq(we)
+            yield port.stb.eq(1)
+            yield
+            yield Settle()
+            while not (yield port.ack):
+                yield
+                yield Settle()
+            yield port.stb.eq(0)
+            return (yield port.rdata)
+
+        # A commit of a stray x_grad first, immediately followed by a write
+        # which is dropped whilst the commit is pending, and reported as an
+        # overrun. The registers follow once the commit has been taken.
+        def host_proc():
+            yield from access(SCAN_ADDR_X_GRAD, 7)
+            yield from access(SCAN_ADDR_COMMIT)
+            yield from access(SCAN_ADDR_X_GRAD, 9)
+            overrun = False
+            while True:
+                status = yield from access(SCAN_ADDR_COMMIT, we=0)
+                overrun |= bool(status & 2)
+                if not status & 1:
+                    break
+            assert overrun and not (yield from access(SCAN_ADDR_COMMIT, we=0)) & 2
+            for addr, value in list(registers.items()) + [ (SCAN_ADDR_HOLD, 0), (SCAN_ADDR_COMMIT, 0) ]:
+                yield from access(addr, value)
+
+        def pixel_proc():
+            scan = dut.scan
+            cycle = 0
+            while len(frames) <= 4:
+                yield Settle()
+                if (yield scan.sample):
+                    frames[-1].append(((yield scan.column), (yield scan.line), (yield scan.dac_y)))
+                if (yield scan.blank_y):
+                    frames.append([])
+                    latched.append(((yield scan.l_x_begin), (yield scan.l_x_grad)))
+                    frame_ends.append(cycle)
+                cycle += 1
+                yield
+
+        sim.add_sync_process(host_proc, domain="sync")
+        sim.add_sync_process(pixel_proc, domain="pixel")
+        os.makedirs("sim", exist_ok=True)
+        with sim.write_vcd("sim/pixelscan_2.vcd"):
+            sim.run()
+
+        get = lambda a: registers.get(a, 0)
+        stride = get(SCAN_ADDR_SUBSAMPLE) & 7
+        expected = pixelscan_samples(get(SCAN_ADDR_X_STEPS), get(SCAN_ADDR_Y_STEPS), get(SCAN_ADDR_Y_BEGIN), get(SCAN_ADDR_Y_GRAD),
+            get(SCAN_ADDR_ROI_X), get(SCAN_ADDR_ROI_Y), get(SCAN_ADDR_ROI_WIDTH), get(SCAN_ADDR_ROI_HEIGHT),
+            stride, get(SCAN_ADDR_SUBSAMPLE) >> 4)
+        # The first frame may have started before the commit
+        assert frames[2:4] == [ expected, expected ], (config, frames)
+        x_begin = min(get(SCAN_ADDR_X_BEGIN) + min(get(SCAN_ADDR_ROI_X), get(SCAN_ADDR_X_STEPS)) * get(SCAN_ADDR_X_GRAD), 0xffff)
+        assert latched[-1] == (x_begin, get(SCAN_ADDR_X_GRAD) << stride), (config, latched)
+        # Each row takes dwell cycles per pixel, then one to blank
+        if SCAN_ADDR_DWELL in config:
+            rows, pixels = get(SCAN_ADDR_Y_STEPS) + 1, get(SCAN_ADDR_X_STEPS) + 1
+            assert frame_ends[-1] - frame_ends[-2] == rows * (pixels * get(SCAN_ADDR_DWELL) + 1), frame_ends
+    print("pixelscan: region of interest, stride, binning and dwell ok")
+
+# The pixel domain is held in reset whilst the pixel clock relocks (see
+# clocking.py). Committed configuration must outlive that, as must a commit
+# in flight, and an enabled path starts over.
+def sim_pixelscan_3():
+    class TopTest(Elaboratable):
+        def __init__(self):
+            self.scan = PixelScan()
+            self.registers = ScanRegisters(self.scan)
+            self.registers.reset = { SCAN_ADDR_X_STEPS: 19, SCAN_ADDR_Y_STEPS: 9 }
+            self.path = PathScan(max_points=64, grid_bits=6)
+            self.pixel = ClockDomain("pixel")
+
+        def elaborate(self, platform):
+            m = Module()
+            m.domains.pixel = self.pixel
+            m.submodules.scan = self.scan
+            m.submodules.registers = self.registers
+            m.submodules.path = self.path
+            m.d.comb += self.scan.hold.eq(self.registers.hold | self.path.running)
+            return m
+
+    config = { SCAN_ADDR_Y_BEGIN: 200, SCAN_ADDR_Y_GRAD: 130, SCAN_ADDR_SUBSAMPLE: scan_subsample(bin=1) }
+    width, height = 4, 3
+    raster = {
+        PATH_ADDR_CONTROL: path_control(), PATH_ADDR_DWELL: 2, PATH_ADDR_WIDTH: width, PATH_ADDR_HEIGHT: height,
+        PATH_ADDR_X_BEGIN: 100, PATH_ADDR_Y_BEGIN: 50, PATH_ADDR_X_STEP: 10, PATH_ADDR_Y_STEP: 7,
+    }
+    dut = TopTest()
+    sim = Simulator(dut)
+    sim.add_clock(1.0 / 100e6, domain="sync")
+    sim.add_clock(1.0 / 37e6, domain="pixel")
+    frames = [ [] ]
+    paths = [ [] ]
+    marks = []
+
+    def access(port, addr, data=0, we=1):
+        yield port.addr.eq(addr)
+        yield port.wdata.eq(data)
+        yield port.we.eq(we)
+        yield port.stb.eq(1)
+        yield
+        yield Settle()
+        while not (yield port.ack):
+            yield
+            yield Settle()
+        yield port.stb.eq(0)
+        return (yield port.rdata)
+
+    def reset_pixel():
+        yield dut.pixel.rst.eq(1)
+        for _ in range(50):
+            yield
+        yield dut.pixel.rst.eq(0)
+
+    def wait_for(events, n):
+        mark = len(events)
+        while len(events) < mark + n:
+            yield
+        return mark
+
+    def host_proc():
+        scan, path = dut.registers.port, dut.path.port
+        # A commit in flight as the pixel domain is reset
+        for addr, value in config.items():
+            yield from access(scan, addr, value)
+        yield from access(scan, SCAN_ADDR_COMMIT)
+        yield from reset_pixel()
+        while (yield from access(scan, SCAN_ADDR_COMMIT, we=0)) & 1:
+            yield
+        marks.append((yield from wait_for(frames, 3)))
+
+        # Reset mid frame, then mid path
+        yield from reset_pixel()
+        marks.append((yield from wait_for(frames, 3)))
+        for addr, value in raster.items():
+            yield from access(path, addr, value)
+        yield from access(path, PATH_ADDR_COMMIT)
+        yield from wait_for(paths, 2)
+        for _ in range(30):
+            yield
+        yield from reset_pixel()
+        marks.append((yield from wait_for(paths, 3)))
+
+    def pixel_proc():
+        while len(marks) < 3:
+            yield Settle()
+            if (yield dut.scan.sample):
+                frames[-1].append(((yield dut.scan.column), (yield dut.scan.line), (yield dut.scan.dac_y)))
+            if (yield dut.scan.blank_y):
+                frames.append([])
+            if (yield dut.path.sample):
+                paths[-1].append(((yield dut.path.col), (yield dut.path.row), (yield dut.path.x), (yield dut.path.y)))
+            if (yield dut.path.path_done):
+                paths.append([])
+            yield
+        # Paths are counted on across resets
+        yield Settle()
+        assert (yield dut.path.frame) == len(paths) - 1, ((yield dut.path.frame), len(paths))
+
+    sim.add_sync_process(host_proc, domain="sync")
+    sim.add_sync_process(pixel_proc, domain="pixel")
+    os.makedirs("sim", exist_ok=True)
+    with sim.write_vcd("sim/pixelscan_3.vcd"):
+        sim.run()
+
+    # The frame or path under way at each reset is cut short
+    expected = pixelscan_samples(19, 9, y_begin=200, y_grad=130, bin=1)
+    assert frames[marks[0] + 1] == expected and frames[marks[1] + 1] == expected, (marks, frames)
+    expected = [ (c, r, 100 + 10*c, 50 + 7*r) for c, r in path_order(PATH_ORDER_LINEAR, width, height) ]
+    assert paths[marks[2] + 1] == expected, (marks, paths)
+    print("pixelscan: configuration and commits survive pixel domain resets ok")
+
 if __name__ == "__main__":
-    sim_pixelscan_1()
\ No newline at end of file
+    sim_pixelscan_1()
+    sim_pixelscan_2()
+    sim_pixelscan_3()
+    sim_pathscan_1()
\ No newline at end of file
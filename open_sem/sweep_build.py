@@ -0,0 +1,513 @@
+import os
+import re
+import sys
+import json
+import glob
+import stat
+import argparse
+import itertools
+import concurrent.futures
+
+from build_cache import cached_build, BuildCache, verilog_modules
+
+# Builds a matrix of Top variants in parallel, and extracts resource use and
+# timing from each one's Vivado reports:
+#
+#   python3 sweep_build.py -p counter_bits=20,26 -p dac_frac_bits=16,20 -p dac_resistors=1e3,1e2/1e5 -j 4
+#   python3 sweep_build.py -p dac_guard_bits=None,0,4
+#
+# Each -p gives a Top parameter (see Top) and its values, lists of floats
+# being separated by "/", and "None" giving None. Variants build in
+# build/sweep/<variant>, through a shared build cache, so variants reuse each
+# other's unchanged modules. Results go to build/sweep/results.json, with a
+# table of:
+#
+#   LUTs, FFs, BRAM (36Kb tiles), DSPs : totals, and by top level module
+#   WNS, Fmax                          : worst slack, and Fmax by clock and
+#                                        by module (from the worst paths)
+#   fits                               : within the device, and timing met
+#
+# --mock runs a stand-in for Vivado, writing reports estimated from the
+# generated Verilog, to try the flow without Vivado.
+
+SWEEP_DIR = "build/sweep"
+
+def parse_value(text):
+    if text == "None":
+        return None
+    if "/" in text:
+        return [ parse_value(t) for t in text.split("/") ]
+    for kind in [ int, float ]:
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+# Variants, the product of each parameter's values: a list of dicts
+def variants(parameters):
+    names = list(parameters)
+    return [ dict(zip(names, values)) for values in itertools.product(*(parameters[n] for n in names)) ]
+
+def variant_name(params):
+    text = lambda v: "-".join(map(text, v)) if isinstance(v, list) else "{:g}".format(v) if isinstance(v, float) else str(v)
+    name = "_".join("{}{}".format(k, text(v)) for k, v in params.items())
+    return re.sub(r"[^\w.-]", "", name) or "default"
+
+############################################################
+# Vivado report parsing
+
+def _table_rows(lines, start):
+    rows = []
+    for line in lines[start:]:
+        if not line.startswith("|"):
+            if rows and not line.startswith("+"):
+                break
+            continue
+        rows.append([ cell for cell in line.strip().strip("|").split("|") ])
+    return rows
+
+def _number(text):
+    try:
+        return float(text.strip())
+    except ValueError:
+        return 0.0
+
+# Hierarchical utilization (report_utilization -hierarchical): totals of top and
+# of each top level module
+def parse_hierarchical_utilization(text):
+    lines = text.splitlines()
+    start = next(i for i, line in enumerate(lines) if "Instance" in line and "Total LUTs" in line)
+    rows = _table_rows(lines, start)
+    header = [ h.strip() for h in rows[0] ]
+    column = lambda *names: next((header.index(n) for n in names if n in header), None)
+    columns = { "luts": column("Total LUTs"), "ffs": column("FFs"), "ramb36": column("RAMB36"),
+                "ramb18": column("RAMB18"), "dsps": column("DSP48 Blocks", "DSP Blocks") }
+    modules = {}
+    for row in rows[1:]:
+        instance = row[0]
+        depth = (len(instance) - len(instance.lstrip())) // 2
+        if depth > 1:
+            continue
+        values = { k: _number(row[c]) if c is not None else 0.0 for k, c in columns.items() }
+        modules[instance.strip()] = {
+            "luts": int(values["luts"]), "ffs": int(values["ffs"]), "dsps": int(values["dsps"]),
+            "bram": values["ramb36"] + values["ramb18"] / 2,
+        }
+    return modules
+
+# Utilization summary (report_utilization): (used, available) of each resource
+def parse_utilization(text):
+    resources = { "luts": "Slice LUTs", "ffs": "Slice Registers", "bram": "Block RAM Tile", "dsps": "DSPs" }
+    result = {}
+    for line in text.splitlines():
+        cells = [ c.strip() for c in line.strip().strip("|").split("|") ]
+        for key, name in resources.items():
+            if key not in result and cells[0].rstrip("*").strip() == name and len(cells) >= 4:
+                result[key] = (_number(cells[1]), _number(cells[-2]))
+    return result
+
+# Cells of a row of a table whose columns are underlined by runs of "-":
+# numbers are right aligned to the end of the run, and empty cells are "". The
+# first cell, a name, can run past its underline.
+def _columns(row, underline):
+    runs = [ m.span() for m in re.finditer(r"-+", underline) ]
+    name = row.split()[0]
+    end = row.index(name) + len(name)
+    cells = [ name ]
+    for (_, previous), (_, stop) in zip(runs, runs[1:]):
+        cells.append(row[max(previous, end):stop].strip())
+    return cells
+
+# Timing summary (report_timing_summary): worst slack, each clock's period,
+# slack and Fmax, and each top level module's worst setup path of those
+# reported ("(top)" for the top's own logic and ports)
+def parse_timing(text):
+    lines = text.splitlines()
+    timing = { "wns": None, "clocks": {}, "modules": {} }
+
+    def table_after(title):
+        for i, line in enumerate(lines):
+            if line.strip().startswith(title):
+                for j in range(i + 1, len(lines)):
+                    if lines[j].strip().startswith("-"):
+                        rows = []
+                        for row in lines[j + 1:]:
+                            if not row.strip():
+                                break
+                            rows.append(row.split())
+                        return rows
+        return []
+
+    summary = table_after("WNS(ns)")
+    if summary:
+        timing["wns"] = float(summary[0][0])
+    periods = { row[0]: float(row[-2]) for row in table_after("Clock  ") if len(row) >= 3 }
+    # Clocks without setup paths (e.g. MMCM feedback) have no WNS
+    intra = next((i for i, line in enumerate(lines) if "Intra Clock Table" in line), None)
+    if intra is not None:
+        for i in range(intra, len(lines)):
+            if lines[i].strip().startswith("Clock") and "WNS(ns)" in lines[i]:
+                for row in lines[i + 2:]:
+                    if not row.strip():
+                        break
+                    cells = _columns(row, lines[i + 1])
+                    clock, wns = cells[0], float(cells[1]) if cells[1] else None
+                    period = periods.get(clock)
+                    timing["clocks"][clock] = { "period": period, "wns": wns,
+                        "fmax": 1e3 / (period - wns) if period and wns is not None and period > wns else None }
+                break
+
+    # Worst setup paths (Max Delay Paths): Slack, Destination and Requirement
+    # lines of each. A destination pin within a module is "module/.../cell/pin".
+    path = {}
+    setup = True
+    for line in lines:
+        line = line.strip()
+        if line.startswith("Max Delay Paths") or line.startswith("Min Delay Paths"):
+            setup = line.startswith("Max")
+            path = {}
+            continue
+        if not setup:
+            continue
+        match = re.match(r"Slack(?: \(\w+\))?\s*:\s*(-?[\d.]+)ns", line)
+        if match:
+            path = { "slack": float(match.group(1)) }
+        elif line.startswith("Destination:") and "slack" in path:
+            parts = line.split(":", 1)[1].split()[0].split("/")
+            path["module"] = parts[0] if len(parts) > 2 else "(top)"
+        elif line.startswith("Requirement:") and "module" in path:
+            requirement = _number(line.split(":", 1)[1].split("ns")[0])
+            module = timing["modules"].setdefault(path["module"], { "slack": path["slack"], "fmax": None })
+            if path["slack"] <= module["slack"]:
+                module["slack"] = path["slack"]
+                module["fmax"] = 1e3 / (requirement - path["slack"]) if requirement > path["slack"] else None
+            path = {}
+    return timing
+
+def parse_reports(build_dir, name="top"):
+    def read(suffix):
+        with open(os.path.join(build_dir, "{}_{}.rpt".format(name, suffix))) as f:
+            return f.read()
+    utilization = parse_utilization(read("utilization_place"))
+    timing = parse_timing(read("timing"))
+    fits = all(used <= available for used, available in utilization.values()) and (timing["wns"] or 0) >= 0
+    return {
+        "utilization": { k: used for k, (used, available) in utilization.items() },
+        "available": { k: available for k, (used, available) in utilization.items() },
+        "modules": parse_hierarchical_utilization(read("utilization_hierarchical_place")),
+        "timing": timing,
+        "fits": fits,
+    }
+
+############################################################
+# Stand-in for Vivado: reports estimated from the generated Verilog, laid out
+# as Vivado 2022.2 writes them, with the design's own instance and register
+# names. Sizes are rough (registers and assigns counted), and a module's worst
+# setup slack shrinks with its size.
+
+# Resources of the board's FPGA (Alchitry Au+, XC7A100T-1FTG256)
+MOCK_DEVICE = { "luts": 63400, "ffs": 126800, "bram": 135, "dsps": 240 }
+MOCK_PART = ("7a100t", "ftg256", "-1")
+
+def mock_estimate(verilog):
+    modules = verilog_modules(verilog)
+    own = {}
+    for module, text in modules.items():
+        widths = [ int(hi) - int(lo) + 1 for hi, lo in re.findall(r"^\s*reg\s*(?:signed\s*)?\[(\d+):(\d+)\]\s*\S+\s*(?:=|;)", text, re.M) ]
+        widths += [ 1 for _ in re.findall(r"^\s*reg\s+[^\[\s]\S*\s*(?:=|;)", text, re.M) ]
+        memories = re.findall(r"^\s*reg\s*\[(\d+):\d+\]\s*\S+\s*\[(\d+):(\d+)\]", text, re.M)
+        own[module] = {
+            "ffs": sum(widths),
+            "luts": len(re.findall(r"^\s*assign\b", text, re.M)) + sum(widths) // 2,
+            "dsps": len(re.findall(r" \* ", text)),
+            "bram": sum(max(0.5, (int(w) + 1) * (abs(int(a) - int(b)) + 1) / 36864) for w, a, b in memories if abs(int(a) - int(b)) >= 64),
+        }
+    instances = { module: re.findall(r"^\s*\\?({})\s+\\?(\S+)\s*\(".format("|".join(re.escape(m) for m in modules)), text, re.M)
+                  for module, text in modules.items() }
+    def total(module):
+        result = dict(own[module])
+        for child, _ in instances[module]:
+            for k, v in total(child).items():
+                result[k] += v
+        return result
+    return total, instances
+
+def mock_slack(usage, period):
+    return round(period - 3 - 0.1 * (usage["luts"] ** 0.5) - 0.5 * usage["dsps"] ** 0.5, 3)
+
+# Vivado's names for the flip-flops of a module's registers and those of its
+# submodules ("packetizer/crc_reg[15]"), widest first
+def mock_registers(modules, instances, module, prefix=""):
+    cells = []
+    for width, name in re.findall(r"^\s*reg\s*(?:signed\s*)?(?:\[(\d+):\d+\]\s*)?(\w+)\s*=", modules[module], re.M):
+        cells.append((int(width or 0) + 1, prefix + name + ("_reg[{}]".format(width) if width else "_reg")))
+    for child, instance in instances[module]:
+        cells += mock_registers(modules, instances, child, prefix + instance + "/")
+    return sorted(cells, key=lambda cell: -cell[0])
+
+def _report_header(command, name, device, state):
+    rule = "-" * 141
+    return "\n".join([
+        "Copyright 1986-2022 Xilinx, Inc. All Rights Reserved.",
+        rule,
+        "| Tool Version : stand-in for Vivado v.2022.2 (sweep_build.py mock_vivado)",
+        "| Command      : {}".format(command),
+        "| Design       : {}".format(name),
+        "| Device       : {}".format(device),
+        "| Design State : {}".format(state),
+        rule, "", "" ])
+
+# A table with "+---+" borders, its header centered, names left aligned and
+# numbers right aligned
+def _report_table(header, rows, align=None):
+    align = align or [ "<" ] + [ ">" ] * (len(header) - 1)
+    widths = [ max(len(str(cell)) for cell in column) for column in zip(header, *rows) ]
+    rule = "+" + "+".join("-" * (w + 2) for w in widths) + "+"
+    line = lambda cells, aligns: "| " + " | ".join("{:{}{}}".format(str(c), a, w) for c, a, w in zip(cells, aligns, widths)) + " |"
+    return "\n".join([ rule, line(header, [ "^" ] * len(header)), rule ] + [ line(row, align) for row in rows ] + [ rule, "" ])
+
+# Report texts ({ "timing": ..., "utilization_place": ... }) estimated from
+# the Verilog of design name. clocks are (name, period in ns) of its clocks:
+# module paths are timed against the first, and the others have no paths.
+def mock_reports(verilog, clocks, name="top"):
+    modules = verilog_modules(verilog)
+    total, instances = mock_estimate(verilog)
+    device, package, speed = MOCK_PART
+    top = total(name)
+    reports = {}
+
+    def rows(module, depth):
+        result = []
+        for child, instance in instances[module]:
+            t = total(child)
+            result.append([ "  " * depth + instance, child, t["luts"], t["luts"], 0, 0, t["ffs"],
+                            int(t["bram"]), int(round((t["bram"] % 1) * 2)), t["dsps"] ])
+            result += rows(child, depth + 1)
+        return result
+    header = [ "Instance", "Module", "Total LUTs", "Logic LUTs", "LUTRAMs", "SRLs", "FFs", "RAMB36", "RAMB18", "DSP48 Blocks" ]
+    table = [ [ name, "(top)", top["luts"], top["luts"], 0, 0, top["ffs"], int(top["bram"]), int(round((top["bram"] % 1) * 2)), top["dsps"] ] ]
+    reports["utilization_hierarchical_place"] = (
+        _report_header("report_utilization -hierarchical -file {}_utilization_hierarchical_place.rpt".format(name),
+                       name, device + package + speed, "Fully Placed") +
+        "Utilization Design Information\n\n1. Utilization by Hierarchy\n---------------------------\n\n" +
+        _report_table(header, table + rows(name, 1)))
+
+    sites = [ ("Slice LUTs", "luts"), ("Slice Registers", "ffs"), ("Block RAM Tile", "bram"), ("DSPs", "dsps") ]
+    reports["utilization_place"] = (
+        _report_header("report_utilization -file {}_utilization_place.rpt".format(name),
+                       name, device + package + speed, "Fully Placed") +
+        "Utilization Design Information\n\n1. Slice Logic\n--------------\n\n" +
+        _report_table([ "Site Type", "Used", "Fixed", "Prohibited", "Available", "Util%" ],
+                      [ [ site, "{:g}".format(top[key]), 0, 0, MOCK_DEVICE[key], "{:.2f}".format(100 * top[key] / MOCK_DEVICE[key]) ]
+                        for site, key in sites ]))
+
+    # Worst setup path of each top level module, into its widest register
+    # (and of the top's own logic, to an output port), from the first clock
+    clock, period = clocks[0]
+    paths = []
+    for child, instance in instances[name]:
+        registers = mock_registers(modules, instances, child, instance + "/")
+        if registers:
+            paths.append((mock_slack(total(child), period), registers[-1][1] + "/C", registers[0][1] + "/D"))
+    ports = re.findall(r"^\s*output\s*(?:\[(\d+):\d+\]\s*)?(\w+)\s*;", modules[name], re.M)
+    registers = mock_registers(modules, instances, name)
+    if ports and registers:
+        width, port = ports[0]
+        own = { k: top[k] - sum(total(child)[k] for child, _ in instances[name]) for k in top }
+        source = registers[-1][1] + "/C"
+        paths.append((mock_slack(own, period), source, "{}[{}]".format(port, width) if width else port))
+    paths.sort()
+    wns = paths[0][0] if paths else period
+    failing = [ slack for slack, _, _ in paths if slack < 0 ]
+    endpoints = top["ffs"]
+
+    def summary(wns, tns, failing, endpoints):
+        return "{:>11} {:>12} {:>22} {:>20}".format(
+            "{:.3f}".format(wns) if wns is not None else "", "{:.3f}".format(tns) if wns is not None else "",
+            failing if wns is not None else "", endpoints if wns is not None else "")
+    columns = "{:>11} {:>12} {:>22} {:>20}".format("WNS(ns)", "TNS(ns)", "TNS Failing Endpoints", "TNS Total Endpoints")
+    underline = "{:>11} {:>12} {:>22} {:>20}".format("-------", "-------", "-" * 21, "-" * 19)
+    clock_width = max(len(c) for c, _ in clocks) + 2
+    text = _report_header("report_timing_summary -datasheet -max_paths 10 -file {}_timing.rpt".format(name),
+                          name, "{}-{}".format(device, package), "Routed")
+    text += "Timing Summary Report\n\n"
+    text += "------------------------------------------------\n| Design Timing Summary\n| ---------------------\n------------------------------------------------\n\n"
+    text += columns + "\n" + underline + "\n" + summary(wns, sum(failing), len(failing), endpoints) + "\n\n\n"
+    text += "All user specified timing constraints are met.\n\n\n" if wns >= 0 else "Timing constraints are not met.\n\n\n"
+    text += "------------------------------------------------\n| Clock Summary\n| -------------\n------------------------------------------------\n\n"
+    text += "{:{w}}{:<21}{:<16}{}\n".format("Clock", "Waveform(ns)", "Period(ns)", "Frequency(MHz)", w=clock_width)
+    text += "{:{w}}{:<21}{:<16}{}\n".format("-----", "------------", "----------", "--------------", w=clock_width)
+    for c, p in clocks:
+        text += "{:{w}}{:<21}{:<16.3f}{:.3f}\n".format(c, "{{0.000 {:.3f}}}".format(p / 2), p, 1e3 / p, w=clock_width)
+    text += "\n\n------------------------------------------------\n| Intra Clock Table\n| -----------------\n------------------------------------------------\n\n"
+    text += "{:{w}}".format("Clock", w=clock_width) + columns + "\n"
+    text += "{:{w}}".format("-----", w=clock_width) + underline + "\n"
+    for i, (c, p) in enumerate(clocks):
+        text += "{:{w}}".format(c, w=clock_width) + (summary(wns, sum(failing), len(failing), endpoints) if i == 0 else summary(None, 0, 0, 0)).rstrip() + "\n"
+    text += "\n\n------------------------------------------------\n| Timing Details\n| --------------\n------------------------------------------------\n\n\n"
+    edge = "(rising edge-triggered cell FDRE clocked by {}  {{rise@0.000ns fall@{:.3f}ns period={:.3f}ns}})".format(clock, period / 2, period)
+    def path(slack, source, destination, setup):
+        status = "MET" if slack >= 0 else "VIOLATED"
+        destination_cell = edge if "/" in destination else "(output port clocked by {}  {{rise@0.000ns fall@{:.3f}ns period={:.3f}ns}})".format(clock, period / 2, period)
+        requirement = period if setup else 0.0
+        return "\n".join([
+            "Slack ({}) :{:>18}  (required time - arrival time)".format(status, "{:.3f}ns".format(slack)),
+            "  Source:                 {}".format(source),
+            "                            {}".format(edge),
+            "  Destination:            {}".format(destination),
+            "                            {}".format(destination_cell),
+            "  Path Group:             {}".format(clock),
+            "  Path Type:              {}".format("Setup (Max at Slow Process Corner)" if setup else "Hold (Min at Fast Process Corner)"),
+            "  Requirement:            {:.3f}ns  ({} rise@{:.3f}ns - {} rise@0.000ns)".format(requirement, clock, requirement, clock),
+            "", "" ])
+    text += "-" * 99 + "\nFrom Clock:  {}\n  To Clock:  {}\n\n".format(clock, clock)
+    text += "Setup :{:>13}  Failing Endpoints,  Worst Slack{:>16},  Total Violation{:>16}\n".format(
+        len(failing), "{:.3f}ns".format(wns), "{:.3f}ns".format(sum(failing)))
+    text += "-" * 99 + "\n\n\nMax Delay Paths\n" + "-" * 86 + "\n"
+    text += "".join(path(slack, source, destination, True) for slack, source, destination in paths)
+    # Hold paths within a register, which no module's setup slack may take
+    text += "\n\n\nMin Delay Paths\n" + "-" * 86 + "\n"
+    text += "".join(path(0.1, destination.replace("/D", "/C"), destination, False)
+                    for _, _, destination in paths if "/" in destination)
+    reports["timing"] = text
+    return reports
+
+def mock_vivado(args):
+    name = os.path.splitext(os.path.basename(args[args.index("-source") + 1]))[0]
+    with open("{}.v".format(name)) as f:
+        verilog = f.read()
+    clocks = []
+    for xdc in sorted(glob.glob("*.xdc")):
+        with open(xdc) as f:
+            for clock, period in re.findall(r"create_clock\s+-name\s+\{?([^\s}]+)\}?\s+-period\s+([\d.eE+-]+)", f.read()):
+                clocks.append((clock, float(period)))
+    for suffix, text in mock_reports(verilog, clocks or [ ("clk100_0__io", 10.0) ], name).items():
+        with open("{}_{}.rpt".format(name, suffix), "w") as f:
+            f.write(text)
+    for product in [ "{}.bit", "{}.bin", "{}_synth.dcp", "{}_route.dcp" ]:
+        with open(product.format(name), "w") as f:
+            f.write("mock\n")
+    with open("{}.log".format(name), "w") as f:
+        f.write("mock vivado {}\n".format(" ".join(args)))
+
+# Parses the stand-in's reports of a design of PixelScan, a Packetizer and a
+# PixelClock (whose reconfig and FIFOs are second level, so not modules), with
+# a second clock without paths, against its estimates
+def check_report_parsing():
+    from amaranth import Module
+    from amaranth.back import verilog
+    from scanning import PixelScan
+    from packetizer import Packetizer
+    from clocking import PixelClock
+
+    m = Module()
+    m.submodules.pixel_scan = PixelScan()
+    packetizer = m.submodules.packetizer = Packetizer(3, payload_words=8)
+    m.submodules.pixel_clock = PixelClock()
+    text = verilog.convert(m, name="top", ports=[ packetizer.o_data, packetizer.o_valid ], emit_src=False)
+    clocks = [ ("clk100_0__io", 10.0), ("ft600_0__clk__io", 8.0) ]
+    reports = mock_reports(text, clocks)
+    total, instances = mock_estimate(text)
+    close = lambda a, b: a is not None and b is not None and abs(a - b) < 1e-6
+
+    modules = parse_hierarchical_utilization(reports["utilization_hierarchical_place"])
+    assert sorted(modules) == sorted([ "top", "packetizer", "pixel_clock", "pixel_scan" ]), sorted(modules)
+    for instance, module in [ ("top", "top") ] + [ (i, c) for c, i in instances["top"] ]:
+        t = total(module)
+        assert modules[instance] == { "luts": t["luts"], "ffs": t["ffs"], "dsps": t["dsps"], "bram": round(t["bram"] * 2) / 2 }, \
+            (instance, modules[instance], t)
+    utilization = parse_utilization(reports["utilization_place"])
+    top = total("top")
+    assert utilization == { k: (top[k], MOCK_DEVICE[k]) for k in MOCK_DEVICE }, utilization
+
+    timing = parse_timing(reports["timing"])
+    paths = timing["modules"]
+    assert sorted(paths) == sorted([ "(top)", "packetizer", "pixel_clock", "pixel_scan" ]), sorted(paths)
+    for child, instance in instances["top"]:
+        slack = mock_slack(total(child), 10.0)
+        assert close(paths[instance]["slack"], slack), (instance, paths[instance], slack)
+        assert close(paths[instance]["fmax"], 1e3 / (10.0 - slack)), (instance, paths[instance])
+    wns = min(path["slack"] for path in paths.values())
+    assert close(timing["wns"], wns), (timing["wns"], wns)
+    assert sorted(timing["clocks"]) == [ "clk100_0__io", "ft600_0__clk__io" ], timing["clocks"]
+    assert timing["clocks"]["clk100_0__io"]["period"] == 10.0 and close(timing["clocks"]["clk100_0__io"]["wns"], wns)
+    assert close(timing["clocks"]["clk100_0__io"]["fmax"], 1e3 / (10.0 - wns)), timing["clocks"]
+    assert timing["clocks"]["ft600_0__clk__io"] == { "period": 8.0, "wns": None, "fmax": None }, timing["clocks"]
+    print("sweep_build: timing and utilization reports parsed ok")
+
+# Executable calling mock_vivado, for $VIVADO
+def mock_toolchain(directory):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.abspath(os.path.join(directory, "mock_vivado"))
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\nexec \"{}\" \"{}\" --mock-vivado \"$@\"\n".format(sys.executable, os.path.abspath(__file__)))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+############################################################
+# Sweep
+
+def build_variant(params, sweep_dir=SWEEP_DIR):
+    build_dir = os.path.join(sweep_dir, variant_name(params))
+    result = { "variant": variant_name(params), "params": params }
+    try:
+        from sem_board import OpenSemPlatform
+        from top import Top
+        cached_build(OpenSemPlatform(), Top(**params), build_dir=build_dir, cache=BuildCache(os.path.join(sweep_dir, "cache")))
+        result.update(parse_reports(build_dir))
+        result["ok"] = True
+    except Exception as error:
+        result["ok"] = False
+        result["error"] = repr(error)
+    return result
+
+def sweep(parameters, jobs=None, sweep_dir=SWEEP_DIR, mock=False):
+    if mock:
+        os.environ["VIVADO"] = mock_toolchain(sweep_dir)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(build_variant, variants(parameters), itertools.repeat(sweep_dir)))
+    with open(os.path.join(sweep_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=1)
+    return results
+
+def fmax(result):
+    return min((c["fmax"] for c in result["timing"]["clocks"].values() if c["fmax"]), default=None)
+
+def print_table(results):
+    print("{:44s} {:>7s} {:>7s} {:>6s} {:>5s} {:>8s} {:>8s} {:>5s}".format("variant", "LUTs", "FFs", "BRAM", "DSPs", "WNS", "Fmax", "fits"))
+    for r in results:
+        if not r["ok"]:
+            print("{:44s} failed: {}".format(r["variant"], r["error"]))
+            continue
+        u = r["utilization"]
+        print("{:44s} {:7.0f} {:7.0f} {:6.1f} {:5.0f} {:8.3f} {:8.1f} {:>5s}".format(
+            r["variant"], u.get("luts", 0), u.get("ffs", 0), u.get("bram", 0), u.get("dsps", 0),
+            r["timing"]["wns"] or 0, fmax(r) or 0, "yes" if r["fits"] else "no"))
+    fitting = [ r for r in results if r["ok"] and r["fits"] and fmax(r) ]
+    if fitting:
+        best = max(fitting, key=fmax)
+        print("fastest fitting: {} ({:.1f} MHz)".format(best["variant"], fmax(best)))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--mock-vivado":
+        mock_vivado(sys.argv[2:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Build variants of Top and compare them")
+    parser.add_argument("-p", "--param", action="append", default=[], metavar="NAME=V1,V2,...",
+        help="Top parameter and its values (lists of numbers separated by /)")
+    parser.add_argument("-j", "--jobs", type=int,
+        help="builds in parallel (default: one per CPU)")
+    parser.add_argument("-d", "--directory", default=SWEEP_DIR,
+        help="build variants under DIRECTORY (default: %(default)s)")
+    parser.add_argument("--mock", action="store_true",
+        help="use a stand-in for Vivado, estimating reports from the Verilog")
+    args = parser.parse_args()
+
+    parameters = {}
+    for param in args.param:
+        name, _, values = param.partition("=")
+        parameters[name] = [ parse_value(v) for v in values.split(",") ]
+    os.makedirs(args.directory, exist_ok=True)
+    print_table(sweep(parameters, args.jobs, args.directory, args.mock))
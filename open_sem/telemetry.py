@@ -0,0 +1,268 @@
+import os
+import random
+from amaranth import *
+from amaranth.lib.cdc import FFSynchronizer
+from simulation import Simulator
+from packetizer import Packetizer, STREAM_TELEMETRY, PACKET_SYNC, PACKET_HEADER_WORDS, packet_words, crc16
+
+# Status packet payload on STREAM_TELEMETRY, one 16 bit word each. Counters
+# run freely and wrap, so the host takes differences between status packets
+# (which also copes with losing one). 32 bit counters are sent low word first.
+#
+#   word 0-1   : sync cycles, when the status was taken
+#   word 2-3   : words pushed to the ft60x
+#   word 4-5   : words pulled from the ft60x
+#   word 6-7   : ftdi cycles waiting on txe with uplink data to push
+#   word 8-9   : sync cycles the uplink waited on a full fifo_to_f60x
+#   word 10-11 : XADC samples dropped, sample_cdc being full
+#   word 12-13 : pixel samples dropped, pixel_cdc being full
+#   word 14    : fifo_to_f60x high-water mark, since the last status
+#   word 15    : fifo_from_f60x high-water mark, since the last status
+TELEMETRY_COUNTERS = [ "cycles", "pushed", "pulled", "txe_stall", "uplink_stall", "sample_drops", "pixel_drops" ]
+TELEMETRY_LEVELS = [ "uplink_level_max", "downlink_level_max" ]
+TELEMETRY_PAYLOAD_WORDS = 2*len(TELEMETRY_COUNTERS) + len(TELEMETRY_LEVELS)
+
+def gray_encode(value : Value):
+    return value ^ (value >> 1)
+
+def gray_decode(gray : Value):
+    return Cat([ gray[i:].xor() for i in range(len(gray)) ])
+
+# Counts a strobe in one domain, read in another. The count crosses Gray coded,
+# so only one bit changes per cycle, and a sample taken mid change is still
+# either the old or new count.
+# With reset_less, the count runs on through resets of i_domain.
+class GrayCounter(Elaboratable):
+    def __init__(self, width=32, i_domain="sync", o_domain="sync", reset_less=False):
+        self.width = width
+        self.i_domain = i_domain
+        self.o_domain = o_domain
+        self.reset_less = reset_less
+
+        # In (i_domain): count this cycle
+        self.inc = Signal()
+        # Out (o_domain): count, a few cycles late when crossing domains
+        self.count = Signal(width)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        count = Signal(self.width, reset_less=self.reset_less)
+        count_next = Signal(self.width)
+        m.d.comb += count_next.eq(count + self.inc)
+        m.d[self.i_domain] += count.eq(count_next)
+
+        if self.i_domain == self.o_domain:
+            m.d.comb += self.count.eq(count)
+        else:
+            gray = Signal(self.width, reset_less=self.reset_less)
+            gray_synced = Signal(self.width)
+            m.d[self.i_domain] += gray.eq(gray_encode(count_next))
+            m.submodules.sync = FFSynchronizer(gray, gray_synced, o_domain=self.o_domain)
+            m.d[self.o_domain] += self.count.eq(gray_decode(gray_synced))
+
+        return m
+
+# Counts uplink and downlink traffic, stalls and dropped samples, and tracks
+# fifo high-water marks. Every interval sync cycles it takes a status, and
+# streams it out as one payload for a Packetizer on STREAM_TELEMETRY. If the
+# previous status is still going out, that interval's is skipped.
+class Telemetry(Elaboratable):
+    def __init__(self, interval=1 << 20, ftdi_domain="ftdi", pixel_domain="pixel"):
+        assert interval > TELEMETRY_PAYLOAD_WORDS
+        self.interval = interval
+        self.ftdi_domain = ftdi_domain
+        self.pixel_domain = pixel_domain
+
+        # In (sync): fifo levels, uplink held off, XADC sample dropped
+        self.uplink_level   = Signal(16)
+        self.downlink_level = Signal(16)
+        self.uplink_stall   = Signal()
+        self.sample_drop    = Signal()
+
+        # In (ftdi): see FT60X_Sync245
+        self.pushed    = Signal()
+        self.pulled    = Signal()
+        self.txe_stall = Signal()
+
+        # In (pixel): pixel sample dropped
+        self.pixel_drop = Signal()
+
+        # Out: status words
+        self.o_data  = Signal(16)
+        self.o_valid = Signal()
+        self.o_ready = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        strobes = {
+            "pushed":       (self.pushed,       self.ftdi_domain),
+            "pulled":       (self.pulled,       self.ftdi_domain),
+            "txe_stall":    (self.txe_stall,    self.ftdi_domain),
+            "uplink_stall": (self.uplink_stall, "sync"),
+            "sample_drops": (self.sample_drop,  "sync"),
+            "pixel_drops":  (self.pixel_drop,   self.pixel_domain),
+        }
+        counts = { "cycles": Signal(32, name="cycles") }
+        m.d.sync += counts["cycles"].eq(counts["cycles"] + 1)
+        # The pixel domain is reset while the pixel clock's divider changes
+        # (see PixelClock): its count runs on, so the host's deltas don't wrap
+        for name, (strobe, domain) in strobes.items():
+            counter = m.submodules[name] = GrayCounter(32, i_domain=domain, o_domain="sync",
+                                                       reset_less=domain == self.pixel_domain)
+            m.d.comb += counter.inc.eq(strobe)
+            counts[name] = counter.count
+
+        timer = Signal(range(self.interval))
+        remaining = Signal(range(TELEMETRY_PAYLOAD_WORDS + 1))
+        take = Signal()
+        status = Signal(16 * TELEMETRY_PAYLOAD_WORDS)
+
+        levels = [ self.uplink_level, self.downlink_level ]
+        maxima = [ Signal(16, name=name) for name in TELEMETRY_LEVELS ]
+
+        m.d.comb += [
+            take.eq((timer == self.interval - 1) & (remaining == 0)),
+            self.o_data.eq(status[:16]),
+            self.o_valid.eq(remaining != 0),
+        ]
+
+        m.d.sync += timer.eq(Mux(timer == self.interval - 1, 0, timer + 1))
+
+        # High-water marks restart from the current level with each status
+        for level, maximum in zip(levels, maxima):
+            with m.If(take | (level > maximum)):
+                m.d.sync += maximum.eq(level)
+
+        with m.If(take):
+            m.d.sync += [
+                status.eq(Cat([ counts[name] for name in TELEMETRY_COUNTERS ] + maxima)),
+                remaining.eq(TELEMETRY_PAYLOAD_WORDS),
+            ]
+        with m.Elif(self.o_valid & self.o_ready):
+            m.d.sync += [
+                status.eq(status >> 16),
+                remaining.eq(remaining - 1),
+            ]
+
+        return m
+
+# Unpacks a status payload as a dict, see above
+def telemetry_fields(payload):
+    fields = {}
+    for i, name in enumerate(TELEMETRY_COUNTERS):
+        fields[name] = payload[2*i] | (payload[2*i + 1] << 16)
+    for i, name in enumerate(TELEMETRY_LEVELS):
+        fields[name] = payload[2*len(TELEMETRY_COUNTERS) + i]
+    return fields
+
+# Strobes in three unrelated clock domains, and levels in sync, with the pixel
+# domain reset part way. Once they stop, the last status must hold every count
+# exactly, and the high-water
+# marks of all statuses the highest levels seen.
+def sim_telemetry_1(interval=64, cycles=600, seed=1):
+    class Bench(Elaboratable):
+        def __init__(self):
+            self.telemetry = Telemetry(interval=interval)
+            self.packetizer = Packetizer(STREAM_TELEMETRY, payload_words=TELEMETRY_PAYLOAD_WORDS)
+            self.pixel = ClockDomain("pixel")
+
+        def elaborate(self, platform):
+            m = Module()
+            m.domains.ftdi = ClockDomain("ftdi")
+            m.domains.pixel = self.pixel
+            m.submodules.telemetry = telemetry = self.telemetry
+            m.submodules.packetizer = packetizer = self.packetizer
+            m.d.comb += [
+                packetizer.i_data.eq(telemetry.o_data),
+                packetizer.i_valid.eq(telemetry.o_valid),
+                telemetry.o_ready.eq(packetizer.i_ready),
+            ]
+            return m
+
+    bench = Bench()
+    dut = bench.telemetry
+    sim = Simulator(bench)
+    sim.add_clock(1.0 / 100e6, domain="sync")
+    sim.add_clock(1.0 / 66e6, domain="ftdi")
+    sim.add_clock(1.0 / 37e6, domain="pixel")
+
+    rng = random.Random(seed)
+    totals = { name: 0 for name in TELEMETRY_COUNTERS }
+    level_max = [ 0, 0 ]
+    received = []
+
+    # Strobes stop a third of the way through
+    def strobe_proc(frequency, strobes):
+        def proc():
+            for _ in range(int(cycles // 3 * frequency / 100e6)):
+                for name, signal in strobes:
+                    value = rng.random() < 0.4
+                    yield signal.eq(value)
+                    totals[name] += value
+                yield
+            for _, signal in strobes:
+                yield signal.eq(0)
+        return proc
+
+    def level_proc():
+        for cycle in range(cycles):
+            levels = [ rng.randrange(100), rng.randrange(8) ] if cycle < cycles // 2 else [ 3, 1 ]
+            yield dut.uplink_level.eq(levels[0])
+            yield dut.downlink_level.eq(levels[1])
+            level_max[0] = max(level_max[0], levels[0])
+            level_max[1] = max(level_max[1], levels[1])
+            yield
+
+    def sink_proc():
+        # Some backpressure, as the uplink arbiter would give
+        for cycle in range(cycles):
+            yield bench.packetizer.o_ready.eq(cycle % 4 != 0)
+            yield
+            if (yield bench.packetizer.o_valid) and (yield bench.packetizer.o_ready):
+                received.append((yield bench.packetizer.o_data))
+
+    sim.add_sync_process(strobe_proc(66e6, [ ("pushed", dut.pushed), ("pulled", dut.pulled), ("txe_stall", dut.txe_stall) ]), domain="ftdi")
+    sim.add_sync_process(strobe_proc(100e6, [ ("uplink_stall", dut.uplink_stall), ("sample_drops", dut.sample_drop) ]), domain="sync")
+    sim.add_sync_process(strobe_proc(37e6, [ ("pixel_drops", dut.pixel_drop) ]), domain="pixel")
+    # A change of pixel clock divider resets the pixel domain mid count
+    def pixel_reset_proc():
+        for _ in range(40):
+            yield
+        yield bench.pixel.rst.eq(1)
+        for _ in range(3):
+            yield
+        yield bench.pixel.rst.eq(0)
+
+    sim.add_sync_process(level_proc, domain="sync")
+    sim.add_sync_process(sink_proc, domain="sync")
+    sim.add_sync_process(pixel_reset_proc, domain="pixel")
+
+    os.makedirs("sim", exist_ok=True)
+    with sim.write_vcd("sim/telemetry_1.vcd"):
+        sim.run()
+
+    n = packet_words(TELEMETRY_PAYLOAD_WORDS)
+    packets = [ received[i:i+n] for i in range(0, len(received) - n + 1, n) ]
+    assert len(packets) >= cycles // interval - 2, "expected a status every {} cycles, got {}".format(interval, len(packets))
+    statuses = []
+    for packet in packets:
+        assert packet[0] == PACKET_SYNC
+        assert packet[1] == (STREAM_TELEMETRY << 12) | TELEMETRY_PAYLOAD_WORDS
+        assert packet[-1] == crc16(packet[:-1]), "bad crc"
+        statuses.append(telemetry_fields(packet[PACKET_HEADER_WORDS:-1]))
+
+    for previous, status in zip(statuses, statuses[1:]):
+        assert status["cycles"] - previous["cycles"] == interval
+        assert all(status[name] >= previous[name] for name in TELEMETRY_COUNTERS)
+    last = statuses[-1]
+    for name in TELEMETRY_COUNTERS[1:]:
+        assert last[name] == totals[name], "{}: {} counted, {} strobed".format(name, last[name], totals[name])
+    assert max(s["uplink_level_max"] for s in statuses) == level_max[0]
+    assert max(s["downlink_level_max"] for s in statuses) == level_max[1]
+    assert (last["uplink_level_max"], last["downlink_level_max"]) == (3, 1)
+    print("telemetry: {} statuses ok, last {}".format(len(statuses), last))
+
+if __name__ == "__main__":
+    sim_telemetry_1()
@@ -7,35 +7,104 @@ from tkinter import TOP
 from amaranth import *
 from amaranth.cli import *
 from amaranth.back import verilog
-from amaranth.sim import Simulator
+from simulation import Simulator, SIM_BACKENDS, default_backend
+from tracing import trace
+from build_cache import cached_build
 from amaranth.build.dsl import DiffPairs
+from amaranth.lib.fifo import AsyncFIFO, AsyncFIFOBuffered
 
 from amaranth import *
 from fixed_point import SignalFixedPoint
 
 
-from samplemux import SampleMux
-from scanning import PixelScan
+from samplemux import SampleMux, SamplePacker, stream_payload_words
+from scanning import PixelScan, PathScan, ScanRegisters
+from accumulator import Accumulator
 from backscatter import Backscatter
 from sem_board import OpenSemPlatform
 from xadc import XADC
 from ft60x import FT60X_Sync245
+from packetizer import Packetizer, PacketArbiter, STREAM_SAMPLES, STREAM_REGISTERS, STREAM_TELEMETRY
+from telemetry import Telemetry, TELEMETRY_PAYLOAD_WORDS
+from commands import CommandDecoder, CommitHandshake, TARGET_XADC, TARGET_PIXEL_CLOCK, TARGET_PATH_SCAN, TARGET_PIXEL_SCAN, TARGET_ACCUMULATOR, TARGET_SAMPLE_MUX, TARGET_SAMPLE_PACKER
+from clocking import PixelClock
 from ledbar import LedBar
 from dac import DAC
 from pwm import PWM
 
+# Sample sources streamed to the host, as SampleMux inputs
+SAMPLE_SOURCES = [ "xadc", "sum", "x_diff", "y_diff", "cross", "x_contrast", "y_contrast", "cross_contrast" ]
+
+# Routes the host can select between (see SampleMux): one source per sample, or
+# x_diff and y_diff side by side (top 8 of their 14 bits each)
+SAMPLE_ROUTE_XADC           = 0
+SAMPLE_ROUTE_SUM            = 1
+SAMPLE_ROUTE_X_DIFF         = 2
+SAMPLE_ROUTE_Y_DIFF         = 3
+SAMPLE_ROUTE_CROSS          = 4
+SAMPLE_ROUTE_XY             = 5
+SAMPLE_ROUTE_X_CONTRAST     = 6
+SAMPLE_ROUTE_Y_CONTRAST     = 7
+SAMPLE_ROUTE_CROSS_CONTRAST = 8
+SAMPLE_ROUTES = [
+    [ (0, 0x0fff, 0) ],
+    [ (1, 0x3fff, 0) ],
+    [ (2, 0x3fff, 0) ],
+    [ (3, 0x3fff, 0) ],
+    [ (4, 0x3fff, 0) ],
+    [ (2, 0x3fc0, -6), (3, 0x3fc0, 2) ],
+    [ (5, 0x0fff, 0) ],
+    [ (6, 0x0fff, 0) ],
+    [ (7, 0x0fff, 0) ],
+]
+
+# Sample widths on the uplink the host can select between (see SamplePacker):
+# 16 bit words, or samples packed at the width of the XADC, of backscatter
+# routes, or of accumulated sums, alone or with their 12 bit counts. Samples
+# saturate at the width. Each sample packet's header gives the mode as its
+# format.
+STREAM_MODE_WORDS  = 0
+STREAM_MODE_PACK12 = 1
+STREAM_MODE_PACK14 = 2
+STREAM_MODE_PACK24 = 3
+STREAM_MODE_SUMS   = 4
+STREAM_MODES = [ 16, 12, 14, 24, (24, 12) ]
+
 # Top-level module glues everything together
+# Build parameters, for choosing from build variants (see sweep_build.py):
+#   counter_bits          : bits of the LED bar ramp counter, at least 16
+#   dac_capacitor         : DAC output filter capacitor
+#   dac_resistors         : DAC resistors, one on R1E3 (with the PWM on R1E5),
+#                           or two on R1E3 and R1E5 (no PWM)
+#   dac_frac_bits         : DAC fixed point fraction bits
+#   dac_guard_bits        : DAC search precision beyond frac_bits, or None
+#                           for the exact search (see DAC)
+#   fifo_depth_to_ft60x   : FT60X uplink FIFO depth
+#   fifo_depth_from_ft60x : FT60X downlink FIFO depth
+#   pixel_fifo_depth      : depth of the FIFO taking samples from pixel to sync
+#   telemetry_interval    : sync cycles between status packets (see telemetry.py)
 class Top(Elaboratable):
-    def __init__(self):
-        pass
+    def __init__(self, counter_bits=26, dac_capacitor=1e-7, dac_resistors=[1e3], dac_frac_bits=20, dac_guard_bits=None,
+                 fifo_depth_to_ft60x=128, fifo_depth_from_ft60x=8, pixel_fifo_depth=512, telemetry_interval=1 << 20):
+        assert counter_bits >= 16
+        assert 1 <= len(dac_resistors) <= 2
+        self.counter_bits = counter_bits
+        self.dac_capacitor = dac_capacitor
+        self.dac_resistors = list(dac_resistors)
+        self.dac_frac_bits = dac_frac_bits
+        self.dac_guard_bits = dac_guard_bits
+        self.fifo_depth_to_ft60x = fifo_depth_to_ft60x
+        self.fifo_depth_from_ft60x = fifo_depth_from_ft60x
+        self.pixel_fifo_depth = pixel_fifo_depth
+        self.telemetry_interval = telemetry_interval
     
     def elaborate(self, platform):
         m = Module()
         
         #params
         period = 1.0/100e6
-        dac_cap=1e-7
-        dac_res=[1e3]
+        dac_cap=self.dac_capacitor
+        dac_res=self.dac_resistors
         
         # Get references to external signals
         leds = Cat([platform.request("led", i) for i in range(8)])
@@ -43,27 +112,75 @@ class Top(Elaboratable):
         dac_scan_y1 = platform.request("R1E5")
         
         # Setup the submodules and connect their signals
-        # m.submodules.pixel_scan = PixelScan()
-        # m.submodules.backscatter = Backscatter(12)
-        # m.submodules.sample_mux = SampleMux(16, [12,12,12,12] )
+        m.submodules.pixel_clock = PixelClock()
+        m.submodules.pixel_scan = PixelScan()
+        m.submodules.scan_registers = ScanRegisters(m.submodules.pixel_scan)
+        m.submodules.path_scan = PathScan()
+        m.submodules.backscatter = Backscatter(12, contrast=True)
+        backscatter = m.submodules.backscatter
+        backscatter_outputs = [ backscatter.sum, backscatter.x_diff, backscatter.y_diff, backscatter.cross,
+                                backscatter.x_contrast, backscatter.y_contrast, backscatter.cross_contrast ]
+        m.submodules.sample_mux = SampleMux(16,
+            [ 12 ] + [ len(o) for o in backscatter_outputs ],
+            SAMPLE_ROUTES, domain="pixel"
+        )
+        # 24 bit sums leave 12 bits of growth for averaging 12 bit XADC
+        # samples, and 10 bits for 14 bit backscatter ones
+        m.submodules.accumulator = Accumulator(sample_bits=16, output_bits=24)
         m.submodules.xadc = XADC(
             platform.request("analog_secondary_electron"),
         )
         m.submodules.ft600 = FT60X_Sync245(
             ftdi_resource = platform.request("ft600"),
+            fifo_depth_to_ft60x = self.fifo_depth_to_ft60x,
+            fifo_depth_from_ft60x = self.fifo_depth_from_ft60x,
+        )
+        word_bits = 8*m.submodules.ft600.data_bytes
+        # Sample packets hold whole packing periods of every stream mode
+        sample_payload_words = stream_payload_words(STREAM_MODES, word_bits)
+        m.submodules.sample_packer = SamplePacker(
+            len(m.submodules.accumulator.o_sample), STREAM_MODES, sample_payload_words, word_bits=word_bits
+        )
+        m.submodules.packetizer = Packetizer(
+            stream_id=STREAM_SAMPLES, payload_words=sample_payload_words, word_bits=word_bits, count_items=True
+        )
+        m.submodules.register_packetizer = Packetizer(
+            stream_id=STREAM_REGISTERS, payload_words=2, word_bits=word_bits
+        )
+        m.submodules.telemetry = Telemetry(interval=self.telemetry_interval)
+        m.submodules.telemetry_packetizer = Packetizer(
+            stream_id=STREAM_TELEMETRY, payload_words=TELEMETRY_PAYLOAD_WORDS, word_bits=word_bits
+        )
+        m.submodules.uplink = PacketArbiter([
+            m.submodules.packetizer, m.submodules.register_packetizer, m.submodules.telemetry_packetizer
+        ])
+        # Host commands, to the register port of each TARGET_*
+        targets = {
+            TARGET_XADC:        m.submodules.xadc.drp,
+            TARGET_PIXEL_CLOCK: m.submodules.pixel_clock.port,
+            TARGET_PATH_SCAN:   m.submodules.path_scan.port,
+            TARGET_PIXEL_SCAN:  m.submodules.scan_registers.port,
+            TARGET_ACCUMULATOR: m.submodules.accumulator.port,
+            TARGET_SAMPLE_MUX:  m.submodules.sample_mux.port,
+            TARGET_SAMPLE_PACKER: m.submodules.sample_packer.port,
+        }
+        assert sorted(targets) == list(range(len(targets))), "command targets must be numbered 0..n-1"
+        m.submodules.commands = CommandDecoder(
+            [ targets[t] for t in range(len(targets)) ],
+            word_bits=word_bits, data_bytes=m.submodules.ft600.data_bytes
         )
         m.submodules.dac = DAC(
             delta_time=period, capacitor=dac_cap, resistors=dac_res,
-            output_pwm=dac_scan_y0
+            output_pwm=dac_scan_y0 if len(dac_res) == 1 else Cat(dac_scan_y0, dac_scan_y1), frac_bits=self.dac_frac_bits,
+            guard_bits=self.dac_guard_bits
         )
-        m.submodules.pwm = PWM()
-        m.submodules.pwm.pwm = dac_scan_y1
+        if len(dac_res) == 1:
+            m.submodules.pwm = PWM()
+            m.submodules.pwm.pwm = dac_scan_y1
                
         # Three clock domains, all rising edge
         #   sync and ftdi are similar clocks speeds, possibly out of phase
-        #   pixel is derived from sync, possibly the same
-        # m.domains.sync = ClockDomain("sync")
-        # m.domains.pixel = ClockDomain("pixel")
+        #   pixel is derived from sync by PixelClock, at a host programmable rate
         
         # One cycle at 100Mhz is 10ns.
         # Bit n flips at [2**n * 1e-8] second intervals
@@ -72,19 +189,16 @@ class Top(Elaboratable):
         # 16-23 bits: 655.36us, 1.31072ms, 2.62144ms, 5.24288ms, 10.48576ms, 20.97152ms, 41.94304ms, 83.88608ms,
         # 24-31 bits: 167.77216ms, 335.54432ms, 671.08864ms, 1.34217728s, 2.68435456s, 5.36870912s, 10.73741824s, 21.47483648s
         # 32-39 bits: 42.94967296s, 85.89934592s, 171.79869184s, 343.59738368s, 687.19476736s, 1374.38953472s, 2748.77906944s, 5497.55813888s
-        counter_bits = 26
+        counter_bits = self.counter_bits
         counter = Signal(counter_bits+1)
         sawtooth_int = Mux( ~counter[counter_bits], counter[:counter_bits], C(2**counter_bits-1) - counter[:counter_bits] )[:counter_bits] # each ramp lasts 671.08864ms
         
         m.submodules.ledbar = LedBar(counter_bits,8)
         
         m.d.comb += [
-            # Let's just set the pixel clock equal to main clock for now          
-            # ClockSignal(domain="sync").eq(board_clock),
-            # ClockSignal(domain="pixel").eq(board_clock),
-            
-            # m.submodules.pixel_scan.x_steps.eq(C(4095)),
-            # m.submodules.pixel_scan.y_steps.eq(C(4095)),
+            # Raster scanning pauses (at the end of its frame) when held by
+            # the host, or whilst a path plays
+            m.submodules.pixel_scan.hold.eq(m.submodules.scan_registers.hold | m.submodules.path_scan.running),
             
             m.submodules.ledbar.value.eq(sawtooth_int),
             # m.submodules.ledbar.value.eq(m.submodules.xadc.adc_sample_value),
@@ -96,20 +210,170 @@ class Top(Elaboratable):
         
         m.d.sync += [            
             counter.eq(counter + 1),
-            
-            m.submodules.dac.input.eq( SignalFixedPoint(value=sawtooth_int, frac_bits=sawtooth_int.shape().width) ),
-            m.submodules.pwm.input.eq( sawtooth_int[-16:]),
-            
-            # m.submodules.pixel_scan.hold.eq(0),     
             leds.eq(m.submodules.ledbar.bar),
         ]
+
+        # The y beam follows the path whilst one plays, else the raster. Its
+        # position crosses from pixel to the DAC in sync by commits: each time
+        # the last has been taken, a changed position is held and committed.
+        # There is no x DAC on the board yet (the raster's x ramp is analog),
+        # so PathScan.x is not used.
+        path_scan = m.submodules.path_scan
+        m.submodules.beam_cdc = beam_cdc = CommitHandshake(i_domain="pixel", o_domain="sync")
+        scan_y = Mux(path_scan.running, path_scan.y, m.submodules.pixel_scan.dac_y)
+        beam_y_pixel = Signal(16)
+        beam_y = Signal(16)
+        with m.If(~beam_cdc.pending):
+            m.d.pixel += beam_y_pixel.eq(scan_y)
+        m.d.comb += [
+            beam_cdc.commit.eq(scan_y != beam_y_pixel),
+            beam_cdc.o_take.eq(beam_cdc.o_pending),
+        ]
+        with m.If(beam_cdc.o_pending):
+            m.d.sync += beam_y.eq(beam_y_pixel)
+        m.d.sync += m.submodules.dac.input.eq(SignalFixedPoint(value=beam_y, frac_bits=len(beam_y)))
+        if len(dac_res) == 1:
+            m.d.sync += m.submodules.pwm.input.eq(beam_y)
         
-        with m.If(m.submodules.xadc.adc_sample_ready):
-            m.d.sync += [
-                # Stream counter out over USB
-                m.submodules.ft600.fifo_to_f60x.w_data.eq( Cat( m.submodules.xadc.adc_sample_value, C(0000), C(11) ) ),
-                m.submodules.ft600.fifo_to_f60x.w_en.eq(1)
-            ]
+        # Samples are captured in the pixel domain, one per scanned pixel (or
+        # path point, when a path is playing), and tagged with their position.
+        # XADC samples cross into the pixel domain, each strobing the
+        # accumulator as it arrives. The accumulator sums them over bins, lines
+        # or frames, and its results cross back to sync, to be packed at the
+        # stream mode's width (saturating) and packetized. The end of each
+        # frame or path follows its last result across, flushing the packet
+        # being filled, so that a frame is sent whole without waiting on the
+        # next.
+        #   pixel_cdc word : sample[23:0], column[39:24], line[55:40], frame[71:56],
+        #                    count[83:72], result[84], frame end[85]
+        pixel_scan = m.submodules.pixel_scan
+        sample_mux = m.submodules.sample_mux
+        accumulator = m.submodules.accumulator
+        xadc = m.submodules.xadc
+        m.submodules.sample_cdc = sample_cdc = AsyncFIFO(
+            width=len(xadc.adc_sample_value), depth=4, w_domain="sync", r_domain="pixel"
+        )
+        m.submodules.pixel_cdc = pixel_cdc = AsyncFIFOBuffered(
+            width=86, depth=self.pixel_fifo_depth, w_domain="pixel", r_domain="sync"
+        )
+
+        # Backscatter results cross alongside. Its quadrant detector inputs are
+        # not on the board yet, so none arrive.
+        m.submodules.backscatter_cdc = backscatter_cdc = AsyncFIFO(
+            width=len(Cat(backscatter_outputs)), depth=4, w_domain="sync", r_domain="pixel"
+        )
+
+        latest_sample = Signal(len(xadc.adc_sample_value))
+        latest_backscatter = Signal(len(Cat(backscatter_outputs)))
+        # Pulse with each new latest sample
+        sample_fresh = Signal()
+        backscatter_fresh = Signal()
+        # Reset-less, so frames are numbered on across changes of pixel clock
+        frame = Signal(16, reset_less=True)
+        m.d.comb += [
+            sample_cdc.w_data.eq(xadc.adc_sample_value),
+            sample_cdc.w_en.eq(xadc.adc_sample_ready),
+            sample_cdc.r_en.eq(1),
+
+            backscatter_cdc.w_data.eq(Cat(backscatter_outputs)),
+            backscatter_cdc.w_en.eq(backscatter.o_valid),
+            backscatter_cdc.r_en.eq(1),
+
+            sample_mux.input_samples[0].eq(latest_sample),
+            Cat(sample_mux.input_samples[1:]).eq(latest_backscatter),
+            sample_mux.input_strobes[0].eq(sample_fresh),
+            Cat(sample_mux.input_strobes[1:]).eq(Repl(backscatter_fresh, len(backscatter_outputs))),
+
+            accumulator.i_sample.eq(sample_mux.output_sample),
+            accumulator.i_valid.eq(Mux(path_scan.running, path_scan.sample, pixel_scan.scanning) & sample_mux.output_strobe),
+            accumulator.i_last.eq(Mux(path_scan.running, path_scan.sample, pixel_scan.sample)),
+            accumulator.i_column.eq(Mux(path_scan.running, path_scan.col, pixel_scan.column)),
+            accumulator.i_line.eq(Mux(path_scan.running, path_scan.row, pixel_scan.line)),
+            accumulator.i_frame.eq(Mux(path_scan.running, path_scan.frame, frame)),
+            accumulator.i_frame_end.eq(Mux(path_scan.running, path_scan.path_done, pixel_scan.blank_y)),
+
+            pixel_cdc.w_data.eq(Cat(accumulator.o_sample, accumulator.o_column, accumulator.o_line, accumulator.o_frame,
+                                    accumulator.o_count, accumulator.o_valid, accumulator.o_frame_end)),
+            pixel_cdc.w_en.eq(accumulator.o_valid | accumulator.o_frame_end),
+        ]
+        m.d.pixel += [
+            sample_fresh.eq(sample_cdc.r_rdy),
+            backscatter_fresh.eq(backscatter_cdc.r_rdy),
+        ]
+        with m.If(sample_cdc.r_rdy):
+            m.d.pixel += latest_sample.eq(sample_cdc.r_data)
+        with m.If(backscatter_cdc.r_rdy):
+            m.d.pixel += latest_backscatter.eq(backscatter_cdc.r_data)
+        with m.If(pixel_scan.blank_y):
+            m.d.pixel += frame.eq(frame + 1)
+
+        # Stream samples out over USB in framed packets
+        sample_packer = m.submodules.sample_packer
+        packetizer = m.submodules.packetizer
+        uplink = m.submodules.uplink
+        fifo_to_f60x = m.submodules.ft600.fifo_to_f60x
+        result = pixel_cdc.r_data[84]
+        frame_end = pixel_cdc.r_data[85]
+        m.d.comb += [
+            sample_packer.i_sample.eq(pixel_cdc.r_data[0:24]),
+            sample_packer.i_column.eq(pixel_cdc.r_data[24:40]),
+            sample_packer.i_line.eq(pixel_cdc.r_data[40:56]),
+            sample_packer.i_frame.eq(pixel_cdc.r_data[56:72]),
+            sample_packer.i_count.eq(pixel_cdc.r_data[72:84]),
+            sample_packer.i_valid.eq(pixel_cdc.r_rdy & result),
+            # A frame end alone is taken straight away
+            pixel_cdc.r_en.eq(sample_packer.i_ready | ~result),
+            sample_packer.i_flush.eq(pixel_cdc.r_rdy & pixel_cdc.r_en & frame_end),
+
+            packetizer.i_data.eq(sample_packer.o_data),
+            packetizer.column.eq(sample_packer.o_column),
+            packetizer.line.eq(sample_packer.o_line),
+            packetizer.frame.eq(sample_packer.o_frame),
+            packetizer.format.eq(sample_packer.mode),
+            packetizer.items.eq(sample_packer.o_items),
+            packetizer.flush.eq(sample_packer.o_flush),
+            packetizer.i_valid.eq(sample_packer.o_valid),
+            sample_packer.o_ready.eq(packetizer.i_ready),
+
+            # All bytes of each packet word are valid
+            fifo_to_f60x.w_data.eq( Cat( uplink.o_data, Repl(C(1), m.submodules.ft600.data_bytes) ) ),
+            fifo_to_f60x.w_en.eq(uplink.o_valid),
+            uplink.o_ready.eq(fifo_to_f60x.w_rdy),
+        ]
+
+        # Host commands come in over USB, register reads are answered on the uplink
+        commands = m.submodules.commands
+        fifo_from_f60x = m.submodules.ft600.fifo_from_f60x
+        m.d.comb += [
+            commands.i_data.eq(fifo_from_f60x.r_data),
+            commands.i_valid.eq(fifo_from_f60x.r_rdy),
+            fifo_from_f60x.r_en.eq(commands.i_ready),
+
+            m.submodules.register_packetizer.i_data.eq(commands.resp_data),
+            m.submodules.register_packetizer.i_valid.eq(commands.resp_valid),
+            commands.resp_ready.eq(m.submodules.register_packetizer.i_ready),
+        ]
+
+        # Status packets on the uplink: link traffic and stalls, fifo
+        # high-water marks, and samples dropped by the CDC fifos, whose
+        # writers don't wait for room
+        telemetry = m.submodules.telemetry
+        telemetry_packetizer = m.submodules.telemetry_packetizer
+        ft600 = m.submodules.ft600
+        m.d.comb += [
+            telemetry.uplink_level.eq(fifo_to_f60x.w_level),
+            telemetry.downlink_level.eq(fifo_from_f60x.r_level),
+            telemetry.uplink_stall.eq(uplink.o_valid & ~fifo_to_f60x.w_rdy),
+            telemetry.sample_drop.eq(sample_cdc.w_en & ~sample_cdc.w_rdy),
+            telemetry.pixel_drop.eq(accumulator.o_valid & ~pixel_cdc.w_rdy),
+            telemetry.pushed.eq(ft600.pushed),
+            telemetry.pulled.eq(ft600.pulled),
+            telemetry.txe_stall.eq(ft600.txe_stall),
+
+            telemetry_packetizer.i_data.eq(telemetry.o_data),
+            telemetry_packetizer.i_valid.eq(telemetry.o_valid),
+            telemetry.o_ready.eq(telemetry_packetizer.i_ready),
+        ]
         
         return m
 
@@ -128,6 +392,8 @@ if __name__ == "__main__":
     
     p_build = p_action.add_parser("build", 
         help="build design to binary bitstream")
+    p_build.add_argument("--no-cache", action="store_true",
+        help="run a full build, without the build cache")
 
     p_simulate = p_action.add_parser(
         "simulate", help="simulate the design")
@@ -143,6 +409,27 @@ if __name__ == "__main__":
     p_simulate.add_argument("-c", "--clocks", dest="sync_clocks",
         metavar="COUNT", type=int, required=True,
         help="simulate for COUNT 'sync' clock periods")
+    p_simulate.add_argument("-b", "--backend",
+        choices=SIM_BACKENDS, default=default_backend(),
+        help="simulate with BACKEND (default: %(default)s)")
+    p_simulate.add_argument("-t", "--trace", dest="trace_patterns",
+        metavar="PATTERN", action="append",
+        help="trace signals matching PATTERN (e.g. 'ft60x.*') to TRACE-DIR rather than VCD; repeatable")
+    p_simulate.add_argument("--trace-dir",
+        metavar="TRACE-DIR", default="sim/trace",
+        help="write the trace to TRACE-DIR (default: %(default)s)")
+    p_simulate.add_argument("--trace-start",
+        metavar="CYCLE", type=int, default=0,
+        help="trace from 'sync' clock CYCLE")
+    p_simulate.add_argument("--trace-stop",
+        metavar="CYCLE", type=int,
+        help="trace until 'sync' clock CYCLE")
+    p_simulate.add_argument("--trace-trigger",
+        metavar="SIGNAL[=VALUE]",
+        help="start tracing when SIGNAL is non-zero (or VALUE)")
+    p_simulate.add_argument("--trace-cycles",
+        metavar="COUNT", type=int,
+        help="trace at most COUNT 'sync' clock periods")
 
     args = parser.parse_args()    
     
@@ -156,11 +443,28 @@ if __name__ == "__main__":
                 print(output)
         case "simulate":
             fragment = Fragment.get(design, platform)
-            sim = Simulator(fragment)
+            sim = Simulator(fragment, backend=args.backend)
             sim.add_clock(args.sync_period)
-            with sim.write_vcd(vcd_file=args.vcd_file):
+            if args.trace_patterns:
+                trigger = None
+                if args.trace_trigger:
+                    name, _, value = args.trace_trigger.partition("=")
+                    signals = [ s for s, names in sim.signal_names().items() if name in names ]
+                    if not signals:
+                        raise KeyError("no signal named {!r} to trigger on".format(name))
+                    signal = signals[0]
+                    trigger = signal == int(value, 0) if value else signal.bool()
+                recording = trace(sim, args.trace_dir, args.trace_patterns, start=args.trace_start,
+                                  stop=args.trace_stop, cycles=args.trace_cycles, trigger=trigger)
+            else:
+                recording = sim.write_vcd(vcd_file=args.vcd_file, gtkw_file=args.gtkw_file)
+            with recording:
                 sim.run_until(args.sync_period * args.sync_clocks, run_passive=True)
+            print(sim.stats)
         case "build":            
-            products = platform.build(design, do_program=False)
+            if args.no_cache:
+                products = platform.build(design, do_program=False)
+            else:
+                products = cached_build(platform, design, do_program=False)
         case None:
             parser.print_help()
\ No newline at end of file
@@ -0,0 +1,302 @@
+import os
+import json
+import contextlib
+from fnmatch import fnmatchcase
+
+import numpy as np
+from amaranth import *
+from amaranth.hdl.ast import SignalDict
+from amaranth.sim import Passive
+
+# Selective, windowed waveform tracing, as a compact alternative to VCD for
+# long runs. Only signals whose hierarchical name ("pixel_scan.pos_x") matches
+# one of the patterns are traced, and only within a window of clock cycles:
+#
+#   start, stop : cycles of the trace domain (stop exclusive)
+#   trigger     : a Value, the window opens at the first cycle from start it
+#                 is true
+#   cycles      : maximum window length, from when it opens
+#
+# Traced signals are recorded as they change: for each, a file of change
+# times (ps, uint64) and one of values (the smallest integer dtype that fits,
+# or rows of uint64 words beyond 64 bits), appended in chunks. index.json
+# describes them. Trace loads them back through mmap, and samples them at
+# each clock cycle as arrays.
+#
+#   with trace(sim, "sim/trace", [ "pixel_scan.*", "ft60x.*" ], start=1000, stop=5000):
+#       sim.run()
+#   t = Trace("sim/trace")
+#   pos_x = t["pixel_scan.pos_x"]
+
+def _value_dtype(width, signed):
+    for bits in [ 8, 16, 32, 64 ]:
+        if width <= bits:
+            return "{}int{}".format("" if signed else "u", bits), 0
+    return "uint64", (width + 63) // 64
+
+# Observer of value changes (see simulation.Simulator.observe), of the signals
+# whose names (as from Simulator.signal_names, the first being the one a
+# signal is traced as) match a pattern
+class TraceWriter:
+    def __init__(self, names, directory, patterns=("*",), *, period, phase, start=0, stop=None, cycles=None, trigger=False, chunk=1 << 16):
+        self.directory = directory
+        self.period = period
+        self.phase = phase
+        self.chunk = chunk
+        self.cycles = cycles
+
+        self.signals = SignalDict()
+        self.entries = []
+        for signal, aliases in names.items():
+            if any(fnmatchcase(name, pattern) for name in aliases for pattern in patterns):
+                dtype, words = _value_dtype(len(signal), signal.shape().signed)
+                self.signals[signal] = len(self.entries)
+                self.entries.append({ "name": aliases[0], "aliases": aliases[1:], "width": len(signal),
+                                      "signed": signal.shape().signed, "dtype": dtype, "words": words, "changes": 0 })
+        self.last = [ None ] * len(self.entries)
+        for signal, index in self.signals.items():
+            self.last[index] = signal.reset
+        self.times = [ [] for _ in self.entries ]
+        self.values = [ [] for _ in self.entries ]
+
+        # Window, in ps. With a trigger, it opens when triggered.
+        self.begin = phase + start * period if start else 0
+        self.end = phase + stop * period if stop is not None else None
+        self.armed = not trigger
+        self.opened = None
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        for index in range(len(self.entries)):
+            for suffix in [ "t", "v" ]:
+                open(self._path(index, suffix), "wb").close()
+
+    def _path(self, index, suffix):
+        return os.path.join(self.directory, "{}.{}".format(index, suffix))
+
+    def _record(self, index, timestamp, value):
+        self.times[index].append(timestamp)
+        self.values[index].append(value)
+        if len(self.times[index]) >= self.chunk:
+            self._flush(index)
+
+    def _flush(self, index):
+        if not self.times[index]:
+            return
+        entry = self.entries[index]
+        times = np.array(self.times[index], dtype="uint64")
+        if entry["words"]:
+            mask = (1 << entry["width"]) - 1
+            values = np.array([ [ ((v & mask) >> (64 * w)) & 0xffffffffffffffff for w in range(entry["words"]) ]
+                                for v in self.values[index] ], dtype="uint64")
+        else:
+            values = np.array(self.values[index], dtype=entry["dtype"])
+        with open(self._path(index, "t"), "ab") as f:
+            times.tofile(f)
+        with open(self._path(index, "v"), "ab") as f:
+            values.tofile(f)
+        entry["changes"] += len(times)
+        self.times[index].clear()
+        self.values[index].clear()
+
+    # Opens the window: every traced signal's value is recorded at its start
+    def open(self, timestamp):
+        if self.opened is not None:
+            return
+        self.opened = timestamp
+        if self.cycles is not None:
+            end = timestamp + self.cycles * self.period
+            self.end = end if self.end is None else min(self.end, end)
+        for index, value in enumerate(self.last):
+            self._record(index, timestamp, value)
+
+    def trigger(self, timestamp):
+        self.armed = True
+        self.open(max(timestamp, self.begin))
+
+    def update(self, timestamp, signal, value):
+        if self.closed:
+            return
+        if self.end is not None and timestamp >= self.end:
+            self.closed = True
+            return
+        if self.opened is None and self.armed and timestamp >= self.begin:
+            self.open(self.begin)
+        index = self.signals.get(signal)
+        if index is None or value == self.last[index]:
+            return
+        self.last[index] = value
+        if self.opened is not None:
+            self._record(index, timestamp, value)
+
+    def close(self, timestamp):
+        for index in range(len(self.entries)):
+            self._flush(index)
+        end = timestamp if self.end is None else min(self.end, timestamp)
+        index = { "period": self.period, "phase": self.phase, "begin": self.opened, "end": end, "signals": self.entries }
+        with open(os.path.join(self.directory, "index.json"), "w") as f:
+            json.dump(index, f, indent=1)
+
+# Traces a simulation (see simulation.Simulator) while in the context. Cycles
+# count the clock of domain, which must have been added.
+@contextlib.contextmanager
+def trace(sim, directory, patterns=("*",), *, domain="sync", start=0, stop=None, cycles=None, trigger=None, chunk=1 << 16):
+    period = int(sim.periods[domain] * 1e12)
+    phase = int(sim.phases[domain] * 1e12)
+    writer = TraceWriter(sim.signal_names(), directory, patterns, period=period, phase=phase,
+                         start=start, stop=stop, cycles=cycles, trigger=trigger is not None, chunk=chunk)
+
+    if trigger is not None:
+        def trigger_proc():
+            yield Passive()
+            for _ in range(start):
+                yield
+            while not (yield trigger):
+                yield
+            writer.trigger(sim.now)
+        sim.add_sync_process(trigger_proc, domain=domain)
+
+    try:
+        with sim.observe(writer):
+            yield writer
+    finally:
+        writer.close(sim.now)
+
+# A trace written by trace(), its signals loaded through mmap
+class Trace:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "index.json")) as f:
+            index = json.load(f)
+        self.period = index["period"]
+        self.phase = index["phase"]
+        self.begin = index["begin"]
+        self.end = index["end"]
+        self.entries = {}
+        self.aliases = {}
+        for i, entry in enumerate(index["signals"]):
+            entry["index"] = i
+            self.entries[entry["name"]] = entry
+            for name in [ entry["name"] ] + entry["aliases"]:
+                self.aliases.setdefault(name, entry["name"])
+
+    @property
+    def names(self):
+        return list(self.entries)
+
+    # Names of traced signals matching any of the patterns
+    def select(self, *patterns):
+        return [ name for name, entry in self.entries.items()
+                 if any(fnmatchcase(n, p) for n in [ name ] + entry["aliases"] for p in patterns) ]
+
+    def _memmap(self, entry, suffix, dtype, shape):
+        if entry["changes"] == 0:
+            return np.zeros(shape, dtype=dtype)
+        path = os.path.join(self.directory, "{}.{}".format(entry["index"], suffix))
+        return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+    # (times in ps, values) of each change of a signal, from the window opening
+    def changes(self, name):
+        entry = self.entries[self.aliases[name]]
+        n = entry["changes"]
+        times = self._memmap(entry, "t", "uint64", (n,))
+        values = self._memmap(entry, "v", entry["dtype"], (n, entry["words"]) if entry["words"] else (n,))
+        return times, values
+
+    # Cycles of the window, as numbered from the start of the simulation
+    def cycles(self):
+        if self.begin is None:
+            return np.arange(0)
+        first = -(-(self.begin - self.phase) // self.period)
+        last = -(-(self.end - self.phase) // self.period)
+        return np.arange(max(first, 0), last)
+
+    # Values of a signal just after each clock edge
+    def sample(self, name, cycles=None):
+        cycles = self.cycles() if cycles is None else np.asarray(cycles)
+        times, values = self.changes(name)
+        at = self.phase + cycles.astype("uint64") * np.uint64(self.period)
+        return values[np.maximum(np.searchsorted(times, at, side="right") - 1, 0)]
+
+    def __getitem__(self, name):
+        return self.sample(name)
+
+    # Sampled values of every signal matching the patterns
+    def load(self, *patterns, cycles=None):
+        return { name: self.sample(name, cycles) for name in self.select(*patterns) }
+
+# Traces a counter in a submodule (a wide and a signed copy too) through a
+# start/stop window and a triggered one, checking Trace.sample and
+# Trace.changes against the values a testbench process saw at each cycle
+def sim_tracing_1():
+    from simulation import Simulator
+    from amaranth.sim import Settle
+
+    class Counter(Elaboratable):
+        def __init__(self):
+            self.count = Signal(8)
+            self.slow = Signal(6)
+            self.wide = Signal(72)
+            self.small = Signal(signed(5))
+
+        def elaborate(self, platform):
+            m = Module()
+            m.d.sync += self.count.eq(self.count + 1)
+            m.d.comb += [
+                self.slow.eq(self.count >> 2),
+                self.wide.eq(Cat(self.count, Const(0, 56), ~self.count)),
+                self.small.eq(self.count[:5]),
+            ]
+            return m
+
+    names = [ "counter.count", "counter.slow", "counter.wide", "counter.small" ]
+    for backend, start, stop, cycles, trigger_at in [ (backend, *window) for backend in [ "pysim", "cxxrtl" ]
+                                                      for window in [ (20, 80, None, None), (10, 200, 30, 37) ] ]:
+        m = Module()
+        counter = m.submodules.counter = Counter()
+        sim = Simulator(m, backend=backend)
+        sim.add_clock(1e-6)
+
+        # Values just after each cycle's clock edge. Sync processes first run
+        # after the edge of cycle 0.
+        seen = [ None ]
+        def process():
+            for _ in range(120):
+                yield
+                yield Settle()
+                seen.append([ (yield counter.count), (yield counter.slow), (yield counter.wide), (yield counter.small) ])
+        sim.add_sync_process(process)
+
+        directory = "sim/tracing_1"
+        trigger = None if trigger_at is None else counter.count == trigger_at
+        with trace(sim, directory, [ "counter.count", "counter.s*", "counter.wide" ], start=start, stop=stop, cycles=cycles, trigger=trigger):
+            sim.run()
+
+        t = Trace(directory)
+        assert sorted(t.names) == sorted(names), t.names
+        window = t.cycles()
+        if trigger_at is None:
+            assert list(window) == list(range(start, stop)), window
+        else:
+            # Opening at the edge that ends the first cycle the trigger is true
+            assert len(window) == cycles, window
+            assert seen[window[0]][0] == trigger_at + 1, (window[0], seen[window[0]])
+
+        for i, name in enumerate(names):
+            sampled = t.sample(name)
+            if name == "counter.wide":
+                sampled = [ int(low) | (int(high) << 64) for low, high in sampled ]
+            expected = [ seen[c][i] for c in window ]
+            assert [ int(v) for v in sampled ] == expected, (backend, name, list(sampled[:8]), expected[:8])
+
+        # Changes after the window opens, at clock edges
+        times, values = t.changes("counter.slow")
+        assert times[0] == t.begin
+        edges = [ t.phase + c * t.period for c in window[1:] if seen[c][1] != seen[c - 1][1] ]
+        assert [ int(x) for x in times if x > t.begin ] == edges, (list(times), edges)
+        assert [ int(v) for x, v in zip(times, values) if x > t.begin ] == \
+            [ seen[c][1] for c in window[1:] if seen[c][1] != seen[c - 1][1] ]
+    print("tracing: windowed and triggered traces ok, on pysim and cxxrtl")
+
+if __name__ == "__main__":
+    sim_tracing_1()
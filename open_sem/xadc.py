@@ -1,6 +1,7 @@
 import os
 from amaranth import *
-from amaranth.sim import Simulator
+from simulation import Simulator
+from commands import RegisterPort
 
 # https://www.xilinx.com/support/documentation/user_guides/ug480_7Series_XADC.pdf
 # Configuration Registers
@@ -31,124 +32,407 @@ from amaranth.sim import Simulator
 #   == 0000010000100000 = 0x0420
 
 
-# Configure the Internal Xilinx ADC for continuous single channel sampling
+# Sequencer registers (0x48 - 0x4F) hold one bit per channel:
+# 0x48/0x4A/0x4C/0x4E: on-chip channels, 0x49/0x4B/0x4D/0x4F: VAUX[15:0]
+#   0x48 SEQCHSEL0 channel select, 0x4A SEQAVG0 averaging enable,
+#   0x4C SEQINMODE0 bipolar mode, 0x4E SEQACQ0 extended settling time
+
+# Channel (DRP status register) addresses, also reported on CHANNEL output
+CH_TEMP    = 0x00
+CH_VCCINT  = 0x01
+CH_VCCAUX  = 0x02
+CH_VPVN    = 0x03
+CH_VREFP   = 0x04
+CH_VREFN   = 0x05
+CH_VCCBRAM = 0x06
+def CH_VAUX(n):
+    assert 0 <= n < 16
+    return 0x10 + n
+
+# SEQ field of register 0x41
+SEQ_DEFAULT      = 0b0000
+SEQ_CONTINUOUS   = 0b0010
+SEQ_SINGLE       = 0b0011
+SEQ_SIMULTANEOUS = 0b0100
+
+# AVG field of register 0x40 by number of samples averaged
+AVG_BITS = { 0 : 0b00, 16 : 0b01, 64 : 0b10, 256 : 0b11 }
+
+# Bit position of on-chip channels within 0x48 / 0x4A
+SEQ_ONCHIP_BIT = {
+    CH_TEMP : 8, CH_VCCINT : 9, CH_VCCAUX : 10, CH_VPVN : 11,
+    CH_VREFP : 12, CH_VREFN : 13, CH_VCCBRAM : 14,
+}
+
+# Configure the Internal Xilinx ADC for continuous sampling.
+# By default (one channel, VP/VN) this is single channel mode. Given a list of
+# channels, the channel sequencer is used instead. With simultaneous=True both
+# ADC's convert together: each channel VAUX[n], n<8 on ADC A is paired with
+# VAUX[n+8] on ADC B, so every conversion yields two tagged samples.
 class XADC(Elaboratable):
-    def __init__(self, diff_pair):
-        # continuously sample from VP/VN
-        self.channel = C(0x03) 
-        
+    def __init__(self, diff_pair, *, aux_pairs={}, channels=[CH_VPVN], simultaneous=False, averaging=0, clock_divisor=4):
+        assert len(channels) > 0
+        assert averaging in AVG_BITS
+        if simultaneous:
+            assert all(CH_VAUX(0) <= ch < CH_VAUX(8) for ch in channels), "simultaneous mode samples VAUX[0..7] (paired with VAUX[8..15])"
+
+        self.simultaneous = simultaneous
+        self.averaging = averaging
+        self.clock_divisor = clock_divisor
+
+        # Channels sequenced on ADC A, and every channel we'll produce samples for
+        self.sequence = list(channels)
+        self.channels = self.sequence + ([ch + 8 for ch in channels] if simultaneous else [])
+
         ############################################################
         # Module Output
-        
+
+        # Most recent sample of any channel (tagged by channel address)
         self.adc_sample_ready = Signal()
-        self.adc_sample_value = Signal(12) 
-        
+        self.adc_sample_value = Signal(12)
+        self.adc_sample_channel = Signal(5)
+        # High with the last sample of each pass through the sequence
+        self.adc_sample_eos = Signal()
+
+        # Per channel samples, ordered as self.channels
+        self.channel_ready = [ Signal(name="ch{:02x}_ready".format(ch)) for ch in self.channels ]
+        self.channel_value = [ Signal(12, name="ch{:02x}_value".format(ch)) for ch in self.channels ]
+
+        # Host register access to the DRP
+        self.drp = RegisterPort("xadc_drp")
+
         # Module Input
         self.vp = diff_pair.p
         self.vn = diff_pair.n
-        
+        self.vauxp = Cat([ aux_pairs[i].p if i in aux_pairs else C(0) for i in range(16) ])
+        self.vauxn = Cat([ aux_pairs[i].n if i in aux_pairs else C(0) for i in range(16) ])
+
         ############################################################
         ## Signals from XADC sub-module
-        
+
         # XADC: Alarms (out)
         # self.alarm = Signal(8)
         # self.ot    = Signal()
-        
-        # XADC: Status (out)  
-        # self.channel = Signal(7)
+
+        # XADC: Status (out)
+        self.channel = Signal(5)
         self.eoc     = Signal()
-        # self.eos     = Signal()
+        self.eos     = Signal()
         # self.busy    = Signal()
 
         # XADC: DRP: Dynamic Reconfiguration Port (out/in)
-        # self.dwe  = Signal()
+        self.dwe  = Signal()
         self.den  = Signal()
         self.drdy = Signal()
-        # self.dadr = Signal(7)
-        # self.di   = Signal(16)
+        self.dadr = Signal(7)
+        self.di   = Signal(16)
         self.do   = Signal(16)
 
+    # Initial values for configuration and sequencer registers
+    def config_registers(self):
+        single = not self.simultaneous and len(self.sequence) == 1
+        seq = SEQ_SINGLE if single else (SEQ_SIMULTANEOUS if self.simultaneous else SEQ_CONTINUOUS)
+
+        regs = {
+            # CAVG=0, AVG, MUX=0, BU=0 (unipolar), EC=0 (continuous), ACQ=0, CH (single channel mode only)
+            0x40 : (AVG_BITS[self.averaging] << 12) | (self.sequence[0] if single else 0),
+            # SEQ, all alarms disabled, no calibration coefficients applied
+            0x41 : (seq << 12) | 0x0f0f,
+            # CD, PD=10 (power down ADC B) unless we are using it
+            0x42 : (self.clock_divisor << 8) | ((0b00 if self.simultaneous else 0b10) << 4),
+        }
+
+        if not single:
+            onchip, aux = 0, 0
+            for ch in self.sequence:
+                if ch >= CH_VAUX(0):
+                    aux |= 1 << (ch - CH_VAUX(0))
+                else:
+                    onchip |= 1 << SEQ_ONCHIP_BIT[ch]
+            regs[0x48] = onchip
+            regs[0x49] = aux
+            if self.averaging:
+                regs[0x4A] = onchip
+                regs[0x4B] = aux
+
+        return regs
+
     def elaborate(self, platform):
         m = Module()
 
-        # 48h to 4Fh        
+        # 48h to 4Fh
         m.submodules.xadc = Instance("XADC",
             # From UG480
             # [0x40,0x42] Config registers
-            p_INIT_40=0x0003, p_INIT_41=0x3f0f, p_INIT_42=0x0420,
             # [0x43,0x47] Factory test registers - don't touch
             # [0x48,0x4F] Channel Sequence registers
-            # p_INIT_48=0x4701, p_INIT_49=0x000f,
-            # p_INIT_4A=0x4700, p_INIT_4B=0x0000,
-            # p_INIT_4C=0x0000, p_INIT_4D=0x0000,
-            # p_INIT_4E=0x0000, p_INIT_4F=0x0000,
+            **{ "p_INIT_{:02X}".format(addr) : value for addr, value in self.config_registers().items() },
             # [0x50,0x5F] Alarm registers
             # p_INIT_50=0xb5ed, p_INIT_51=0x5999,
             # p_INIT_52=0xa147, p_INIT_53=0xdddd,
             # p_INIT_54=0xa93a, p_INIT_55=0x5111,
             # p_INIT_56=0x91eb, p_INIT_57=0xae4e,
             # p_INIT_58=0x5999, p_INIT_5C=0x5111,
-            
+
             # o_ALM       = self.alarm,
             # o_OT        = self.ot,
-            
-            # o_CHANNEL   = self.channel,
+
+            o_CHANNEL   = self.channel,
             o_EOC       = self.eoc,
-            # o_EOS       = self.eos,
+            o_EOS       = self.eos,
             # o_BUSY      = self.busy,
-            
+
             i_VP        = self.vp,
             i_VN        = self.vn,
-            i_VAUXP     = C(0),
-            i_VAUXN     = C(0),
-            
+            i_VAUXP     = self.vauxp,
+            i_VAUXN     = self.vauxn,
+
             i_CONVST    = C(0),
             i_CONVSTCLK = C(0),
             i_RESET     = ResetSignal(),
             i_DCLK      = ClockSignal(),
-            i_DWE       = C(0),
+            i_DWE       = self.dwe,
             i_DEN       = self.den,
             o_DRDY      = self.drdy,
-            i_DADDR     = self.channel,
-            i_DI        = C(0),
+            i_DADDR     = self.dadr,
+            i_DI        = self.di,
             o_DO        = self.do
         )
-        
+
         # Used for rising edge detection
         last_eoc = Signal()
         m.d.sync += [last_eoc.eq(self.eoc)]
-        
-        m.d.comb += [           
-            # Immediately request read from DRP at end of conversion
-            # Data will arrive at self.do once self.drdy is high
-            # den must only be high for one DCLK (according to docs)
-            self.den.eq(self.eoc & ~last_eoc),
-            
-            # User facing signal for new sample
-            self.adc_sample_ready.eq(self.drdy)
+
+        # CHANNEL and EOS are only valid alongside EOC, so keep hold of them
+        # until the DRP is free to read the result.
+        eoc_pending = Signal()
+        pending_channel = Signal(5)
+        pending_eos = Signal()
+        sample_read = Signal()
+        reading_sample = Signal()
+        reading_eos = Signal()
+
+        with m.If(self.eoc & ~last_eoc):
+            m.d.sync += [
+                eoc_pending.eq(1),
+                pending_channel.eq(self.channel),
+                pending_eos.eq(self.eos),
+            ]
+        with m.Elif(sample_read):
+            m.d.sync += eoc_pending.eq(0)
+
+        m.d.sync += [
+            self.adc_sample_ready.eq(0),
+            self.drp.ack.eq(0),
         ]
-        
-        with m.If(self.drdy):
-            # output is 12 MSB's of data-out at address 'channel' (0x03)
-            m.d.sync += [ self.adc_sample_value.eq(self.do >> 4) ]
-        
+
+        # Read result register(s) from DRP at end of each conversion, or serve
+        # a host access in between. Data will arrive at self.do once self.drdy
+        # is high. den must only be high for one DCLK (according to docs)
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(eoc_pending):
+                    m.d.comb += sample_read.eq(1)
+                    m.d.sync += [
+                        self.dadr.eq(pending_channel),
+                        reading_sample.eq(1),
+                        reading_eos.eq(pending_eos),
+                    ]
+                    m.next = "READ_A"
+                with m.Elif(self.drp.stb & ~self.drp.ack):
+                    m.d.sync += [
+                        self.dadr.eq(self.drp.addr),
+                        reading_sample.eq(0),
+                    ]
+                    m.next = "HOST"
+
+            with m.State("READ_A"):
+                m.d.comb += self.den.eq(1)
+                m.next = "WAIT_A"
+
+            with m.State("WAIT_A"):
+                with m.If(self.drdy):
+                    if self.simultaneous:
+                        # ADC B result for the paired channel is 8 registers along
+                        m.d.sync += self.dadr.eq(self.dadr + 8)
+                        m.next = "READ_B"
+                    else:
+                        m.next = "IDLE"
+
+            with m.State("READ_B"):
+                m.d.comb += self.den.eq(1)
+                m.next = "WAIT_B"
+
+            with m.State("WAIT_B"):
+                with m.If(self.drdy):
+                    m.next = "IDLE"
+
+            with m.State("HOST"):
+                m.d.comb += [
+                    self.den.eq(1),
+                    self.dwe.eq(self.drp.we),
+                    self.di.eq(self.drp.wdata),
+                ]
+                m.next = "HOST_WAIT"
+
+            with m.State("HOST_WAIT"):
+                with m.If(self.drdy):
+                    m.d.sync += [
+                        self.drp.ack.eq(1),
+                        self.drp.rdata.eq(self.do),
+                    ]
+                    m.next = "IDLE"
+
+        with m.If(self.drdy & reading_sample):
+            # output is 12 MSB's of data-out at address 'dadr'
+            last = (self.dadr >= CH_VAUX(8)) if self.simultaneous else C(1)
+            m.d.sync += [
+                self.adc_sample_ready.eq(1),
+                self.adc_sample_value.eq(self.do >> 4),
+                self.adc_sample_channel.eq(self.dadr),
+                self.adc_sample_eos.eq(reading_eos & last),
+            ]
+
+        # Demultiplex into per channel outputs
+        for ch, ready, value in zip(self.channels, self.channel_ready, self.channel_value):
+            m.d.comb += ready.eq(self.adc_sample_ready & (self.adc_sample_channel == ch))
+            with m.If(self.drdy & reading_sample & (self.dadr == ch)):
+                m.d.sync += value.eq(self.do >> 4)
+
         return m
-   
-# def sim_xadc_1():
-#     dut = XADC()
-#     sim = Simulator(dut)
-#     sim.add_clock(1e-6/100,domain="pixel")
-
-#     def loopback_proc():
-#         # yield dut.hold.eq(0)
-#         while True:
-#             yield
-        
-#     sim.add_sync_process(loopback_proc, domain="pixel")
-    
-#     os.makedirs("sim", exist_ok=True)
-#     with sim.write_vcd("sim/xadc_1.vcd"):
-#         sim.run_until(1e-3) # 1ms
-        
-# if __name__ == "__main__":
-#     sim_xadc_1()
\ No newline at end of file
+
+# XADC with a model of its conversions and DRP: conversions through the
+# sequence (in turn, or in simultaneous pairs) must each be read back from
+# their status register and tagged with their channel, whilst the host reads
+# and writes DRP registers through CommandDecoder (TARGET_XADC)
+def sim_xadc_1():
+    import random
+    from types import SimpleNamespace
+    from amaranth.sim import Settle, Passive
+    from commands import CommandDecoder, command_word, OP_READ, OP_WRITE, TARGET_XADC
+    random.seed(6)
+
+    for channels, simultaneous in [ ([ CH_VPVN, CH_VAUX(1), CH_TEMP ], False), ([ CH_VAUX(0), CH_VAUX(2) ], True) ]:
+        pair = lambda: SimpleNamespace(p=Signal(), n=Signal())
+        dut = XADC(pair(), aux_pairs={ i: pair() for i in range(16) }, channels=channels, simultaneous=simultaneous)
+        commands = CommandDecoder([ dut.drp ])
+        regs = dut.config_registers()
+
+        # The sequencer registers select the channels sequenced
+        onchip = sum(1 << SEQ_ONCHIP_BIT[ch] for ch in channels if ch < CH_VAUX(0))
+        aux = sum(1 << (ch - CH_VAUX(0)) for ch in channels if ch >= CH_VAUX(0))
+        assert (regs[0x48], regs[0x49]) == (onchip, aux), regs
+        assert regs[0x41] >> 12 == (SEQ_SIMULTANEOUS if simultaneous else SEQ_CONTINUOUS), regs
+
+        class Bench(Elaboratable):
+            def elaborate(self, platform):
+                m = Module()
+                m.submodules.xadc = dut
+                m.submodules.commands = commands
+                return m
+
+        sim = Simulator(Bench())
+        sim.add_clock(1.0 / 100e6, domain="sync")
+
+        converted = []
+        samples = []
+        writes = []
+        responses = []
+
+        # drdy a few cycles after den, as the XADC's DRP
+        def drp_proc():
+            yield Passive()
+            while True:
+                yield Settle()
+                if (yield dut.den):
+                    addr, we, di = (yield dut.dadr), (yield dut.dwe), (yield dut.di)
+                    for _ in range(random.randint(1, 4)):
+                        yield
+                    if we:
+                        regs[addr] = di
+                        writes.append((addr, di))
+                    yield dut.do.eq(regs.get(addr, 0))
+                    yield dut.drdy.eq(1)
+                    yield
+                    yield dut.drdy.eq(0)
+                else:
+                    yield
+
+        # Conversions through the sequence, each result in its status
+        # register (ADC B's 8 along) as EOC pulses
+        def adc_proc():
+            for _ in range(4):
+                for i, ch in enumerate(channels):
+                    for _ in range(26):
+                        yield
+                    for c in [ ch, ch + 8 ] if simultaneous else [ ch ]:
+                        value = random.getrandbits(12)
+                        regs[c] = (value << 4) | random.getrandbits(4)
+                        converted.append((c, value, i == len(channels) - 1 and c >= ch + 8 * simultaneous))
+                    yield dut.channel.eq(ch)
+                    yield dut.eos.eq(i == len(channels) - 1)
+                    yield dut.eoc.eq(1)
+                    yield
+                    yield dut.eoc.eq(0)
+                    yield dut.eos.eq(0)
+            for _ in range(40):
+                yield
+
+        def monitor_proc():
+            yield Passive()
+            while True:
+                yield Settle()
+                if (yield dut.adc_sample_ready):
+                    samples.append(((yield dut.adc_sample_channel), (yield dut.adc_sample_value), (yield dut.adc_sample_eos)))
+                    ch = yield dut.adc_sample_channel
+                    index = dut.channels.index(ch)
+                    assert (yield dut.channel_ready[index]) and (yield dut.channel_value[index]) == samples[-1][1]
+                yield
+
+        # Host accesses over the command path, amongst the conversions
+        words = [
+            command_word(OP_READ, TARGET_XADC, 0x41), 0,
+            command_word(OP_WRITE, TARGET_XADC, 0x42), 0x0520,
+            command_word(OP_READ, TARGET_XADC, 0x42), 0,
+        ]
+
+        def host_proc():
+            for w in words:
+                for _ in range(random.randint(0, 30)):
+                    yield
+                yield commands.i_data.eq(Cat(C(w, 16), C(0b11, 2)))
+                yield commands.i_valid.eq(1)
+                yield Settle()
+                while not (yield commands.i_ready):
+                    yield
+                    yield Settle()
+                yield
+                yield commands.i_valid.eq(0)
+
+        def resp_proc():
+            yield Passive()
+            yield commands.resp_ready.eq(1)
+            while True:
+                yield Settle()
+                if (yield commands.resp_valid):
+                    responses.append((yield commands.resp_data))
+                yield
+
+        sim.add_sync_process(drp_proc, domain="sync")
+        sim.add_sync_process(adc_proc, domain="sync")
+        sim.add_sync_process(monitor_proc, domain="sync")
+        sim.add_sync_process(host_proc, domain="sync")
+        sim.add_sync_process(resp_proc, domain="sync")
+
+        os.makedirs("sim", exist_ok=True)
+        with sim.write_vcd("sim/xadc_1.vcd"):
+            sim.run()
+
+        assert samples == converted, (samples, converted)
+        assert writes == [ (0x42, 0x0520) ], writes
+        assert responses == [ command_word(OP_READ, TARGET_XADC, 0x41), dut.config_registers()[0x41],
+                              command_word(OP_READ, TARGET_XADC, 0x42), 0x0520 ], [ hex(r) for r in responses ]
+    print("xadc: sequenced and simultaneous conversions, and host DRP accesses ok")
+
+if __name__ == "__main__":
+    sim_xadc_1()
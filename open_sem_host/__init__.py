@@ -0,0 +1,5 @@
+# Host side library for the OpenSEM FPGA uplink (see open_sem/packetizer.py)
+from .protocol import *
+from .decoder import StreamDecoder, FrameRing, split_fifo_words, unpack_bits
+from . import commands
+from .telemetry import LinkMonitor, parse_telemetry, TELEMETRY_PAYLOAD_WORDS
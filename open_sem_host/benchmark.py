@@ -0,0 +1,78 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from .protocol import *
+from .decoder import StreamDecoder
+
+# Write a synthetic capture of `frames` raster frames of 12 bit samples, packetized
+# exactly as the FPGA does it, as 16 bit words (stream mode 0). Each frame ends
+# with a flush, so its last packet is partial unless the frame fills it: the
+# count gives its samples, and the rest of its payload is zero.
+# Returns the frames written so they can be compared.
+def make_capture(path, width, height, frames, payload_words=SAMPLES_PAYLOAD_WORDS, seed=0):
+    rng = np.random.default_rng(seed)
+    pixels = width * height
+    per_frame = -(-pixels // payload_words)
+    plen = packet_words(payload_words)
+
+    images = rng.integers(0, 1 << 12, size=(frames, height, width), dtype=np.uint16)
+    samples = np.zeros(per_frame * payload_words, dtype=WORD_DTYPE)
+    seq = 0
+    with open(path, "wb") as f:
+        for frame in range(frames):
+            packets = np.zeros((per_frame, plen), dtype=WORD_DTYPE)
+            start = np.arange(per_frame) * payload_words
+            samples[:pixels] = images[frame].reshape(-1)
+            packets[:, HDR_SYNC] = PACKET_SYNC
+            packets[:, HDR_STREAM] = stream_word(STREAM_SAMPLES, payload_words)
+            packets[:, HDR_SEQ] = (seq + np.arange(per_frame)) & 0xffff
+            packets[:, HDR_FRAME] = frame
+            packets[:, HDR_LINE] = start // width
+            packets[:, HDR_COLUMN] = start % width
+            packets[:, HDR_COUNT] = np.minimum(pixels - start, payload_words)
+            packets[:, PACKET_HEADER_WORDS:-PACKET_TRAILER_WORDS] = samples.reshape(per_frame, payload_words)
+            packets[:, -1] = crc16_rows(packets[:, :-1])
+            seq += per_frame
+            f.write(packets.tobytes())
+    return images
+
+def run(width=2048, height=2048, frames=8, payload_words=SAMPLES_PAYLOAD_WORDS, verify_crc=True, target_mbps=200.0):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "capture.bin")
+        images = make_capture(path, width, height, frames, payload_words)
+        size = os.path.getsize(path)
+
+        received = []
+        def on_frame(number, frame):
+            # Frame buffers are reused, so only check (not keep) them
+            received.append(number)
+            assert np.array_equal(frame, images[number]), "frame {} decoded incorrectly".format(number)
+
+        decoder = StreamDecoder(width, height, payload_words, verify_crc=verify_crc,
+            on_frame=on_frame, ring_frames=2)
+        start = time.perf_counter()
+        decoder.read_file(path)
+        decoder.flush()
+        elapsed = time.perf_counter() - start
+
+    assert received == list(range(frames)), "missing frames"
+    mbps = size / elapsed / 1e6
+    print("decoded {:.1f} MB in {:.3f}s: {:.1f} MB/s ({} target {:.0f} MB/s, crc {})".format(
+        size / 1e6, elapsed, mbps, "meets" if mbps >= target_mbps else "MISSES",
+        target_mbps, "on" if verify_crc else "off"))
+    print(decoder.stats())
+    return mbps
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the OpenSEM uplink decoder")
+    parser.add_argument("--width", type=int, default=2048)
+    parser.add_argument("--height", type=int, default=2048)
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument("--payload-words", type=int, default=SAMPLES_PAYLOAD_WORDS)
+    parser.add_argument("--no-crc", action="store_true", help="skip CRC verification")
+    args = parser.parse_args()
+    run(args.width, args.height, args.frames, args.payload_words, not args.no_crc)
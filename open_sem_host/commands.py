@@ -0,0 +1,304 @@
+import numpy as np
+
+from .protocol import WORD_DTYPE, STREAM_REGISTERS, STREAM_MODES
+
+# Host to FPGA command format. Must match open_sem/commands.py
+#
+#   word 0 : opcode[15:12], target[11:7], address[6:0]
+#   word 1 : data (ignored for reads)
+OP_WRITE = 0xA
+OP_READ  = 0xB
+OP_WRITE_BLOCK = 0xC
+
+TARGET_XADC = 0
+TARGET_PIXEL_CLOCK = 1
+TARGET_PATH_SCAN = 2
+TARGET_PIXEL_SCAN = 3
+TARGET_ACCUMULATOR = 4
+TARGET_SAMPLE_MUX = 5
+TARGET_SAMPLE_PACKER = 6
+
+# Longest block write. Must match open_sem/commands.py
+MAX_BLOCK_WORDS = 2048
+
+def command_word(op, target, address):
+    assert 0 <= target < 32 and 0 <= address < 128
+    return (op << 12) | (target << 7) | address
+
+# Encode commands as bytes ready to write to the FT60x
+def write_register(target, address, value):
+    return np.array([command_word(OP_WRITE, target, address), value], dtype=WORD_DTYPE).tobytes()
+
+# Up to MAX_BLOCK_WORDS words to one address, with a single header
+def write_block(target, address, values):
+    values = np.asarray(values, dtype=WORD_DTYPE)
+    assert len(values) <= MAX_BLOCK_WORDS
+    header = np.array([command_word(OP_WRITE_BLOCK, target, address), len(values)], dtype=WORD_DTYPE)
+    return header.tobytes() + values.tobytes()
+
+def read_register(target, address):
+    return np.array([command_word(OP_READ, target, address), 0], dtype=WORD_DTYPE).tobytes()
+
+# A command in progress takes at most MAX_BLOCK_WORDS + 1 more words, written
+# as zeros, and zero headers are skipped, so this many zero words put the FPGA
+# back in step
+def resync(words=MAX_BLOCK_WORDS + 2):
+    return bytes(2 * words)
+
+# Register read responses arrive as two word packets on STREAM_REGISTERS.
+# Returns (target, address, value)
+def parse_register_response(payload):
+    header, value = int(payload[0]), int(payload[1])
+    return (header >> 7) & 0x1f, header & 0x7f, value
+
+############################################################
+# XADC runtime configuration over the DRP (see UG480 and open_sem/xadc.py)
+
+XADC_AVG_BITS = { 0 : 0b00, 16 : 0b01, 64 : 0b10, 256 : 0b11 }
+
+# Config register 0: averaging and (in single channel mode) the channel
+def xadc_config0(channel, averaging=0):
+    return (XADC_AVG_BITS[averaging] << 12) | channel
+
+# Config register 2: ADC clock divisor, and power down of ADC B
+def xadc_config2(clock_divisor, power_down_b=True):
+    assert 2 <= clock_divisor < 256
+    return (clock_divisor << 8) | ((0b10 if power_down_b else 0b00) << 4)
+
+def xadc_configure(channel=0x03, averaging=0, clock_divisor=4, power_down_b=True):
+    return write_register(TARGET_XADC, 0x42, xadc_config2(clock_divisor, power_down_b)) \
+         + write_register(TARGET_XADC, 0x40, xadc_config0(channel, averaging))
+
+############################################################
+# Pixel clock (see open_sem/clocking.py)
+
+PIXEL_CLOCK_ADDR_DIVIDER = 0
+PIXEL_CLOCK_ADDR_STATUS  = 1
+
+# Pixel clock = 100 MHz * 10 / divider. The smallest divider keeps it within
+# the pixel domain's fmax, as in open_sem/clocking.py: 8..126 (125 MHz .. 7.9 MHz).
+# Slower pixel rates, such as the XADC's 1 MSPS, come from dwelling on each
+# pixel (see scan_dwell and the dwell of path_raster / path_list).
+PIXEL_FMAX = 125e6
+PIXEL_DIVIDER_MAX = 126
+
+def pixel_divider_min(input_frequency=100e6, vco_multiply=10, fmax=PIXEL_FMAX):
+    return max(1, -(-round(input_frequency * vco_multiply) // round(fmax)))
+
+PIXEL_DIVIDER_MIN = pixel_divider_min()
+
+def pixel_clock_frequency(divider, input_frequency=100e6, vco_multiply=10):
+    return input_frequency * vco_multiply / divider
+
+def pixel_clock_divider(divider):
+    assert PIXEL_DIVIDER_MIN <= divider <= PIXEL_DIVIDER_MAX, "pixel clock divider out of range"
+    return write_register(TARGET_PIXEL_CLOCK, PIXEL_CLOCK_ADDR_DIVIDER, divider)
+
+# Status register: bit 0 locked, bit 1 reprogramming
+def read_pixel_clock_status():
+    return read_register(TARGET_PIXEL_CLOCK, PIXEL_CLOCK_ADDR_STATUS)
+
+############################################################
+# Scan paths (see PathScan in open_sem/scanning.py)
+
+PATH_SOURCE_RASTER = 0
+PATH_SOURCE_LIST   = 1
+
+PATH_ORDER_LINEAR     = 0
+PATH_ORDER_SERPENTINE = 1
+PATH_ORDER_INTERLACED = 2
+PATH_ORDER_RANDOM     = 3
+
+PATH_ADDR_CONTROL = 0
+PATH_ADDR_DWELL   = 1
+PATH_ADDR_WIDTH   = 2
+PATH_ADDR_HEIGHT  = 3
+PATH_ADDR_X_BEGIN = 4
+PATH_ADDR_Y_BEGIN = 5
+PATH_ADDR_X_STEP  = 6
+PATH_ADDR_Y_STEP  = 7
+PATH_ADDR_POINTS  = 8
+PATH_ADDR_COMMIT  = 9
+PATH_ADDR_RESTART = 10
+
+def path_control(enable=True, source=PATH_SOURCE_RASTER, order=PATH_ORDER_LINEAR, jitter_bits=0):
+    return int(enable) | (source << 1) | (order << 2) | (jitter_bits << 4)
+
+# Status register: bit 0 commit pending, bit 1 running, bit 2 bank being
+# loaded, bit 3 overrun. A commit stays pending until the path playing ends;
+# writes sent meanwhile are dropped and set overrun (cleared by reading the
+# status), so wait for pending to clear before sending the next path.
+def read_path_status():
+    return read_register(TARGET_PATH_SCAN, PATH_ADDR_COMMIT)
+
+def path_raster(width, height, x_begin=0, y_begin=0, x_step=1, y_step=1, dwell=1,
+                order=PATH_ORDER_LINEAR, jitter_bits=0):
+    registers = [
+        (PATH_ADDR_CONTROL, path_control(True, PATH_SOURCE_RASTER, order, jitter_bits)),
+        (PATH_ADDR_DWELL, dwell),
+        (PATH_ADDR_WIDTH, width),
+        (PATH_ADDR_HEIGHT, height),
+        (PATH_ADDR_X_BEGIN, x_begin),
+        (PATH_ADDR_Y_BEGIN, y_begin),
+        (PATH_ADDR_X_STEP, x_step),
+        (PATH_ADDR_Y_STEP, y_step),
+    ]
+    return b"".join(write_register(TARGET_PATH_SCAN, a, v) for a, v in registers) \
+         + write_register(TARGET_PATH_SCAN, PATH_ADDR_COMMIT, 0)
+
+# Upload a list of points ((N, 2) array of x, y) and commit it. The list is
+# streamed as one block write into the bank not playing.
+def path_list(points, dwell=1, order=PATH_ORDER_LINEAR, jitter_bits=0):
+    points = np.asarray(points, dtype=WORD_DTYPE).reshape(-1, 2)
+    return write_register(TARGET_PATH_SCAN, PATH_ADDR_RESTART, 0) \
+         + write_register(TARGET_PATH_SCAN, PATH_ADDR_CONTROL, path_control(True, PATH_SOURCE_LIST, order, jitter_bits)) \
+         + write_register(TARGET_PATH_SCAN, PATH_ADDR_DWELL, dwell) \
+         + write_register(TARGET_PATH_SCAN, PATH_ADDR_WIDTH, len(points)) \
+         + write_block(TARGET_PATH_SCAN, PATH_ADDR_POINTS, points.ravel()) \
+         + write_register(TARGET_PATH_SCAN, PATH_ADDR_COMMIT, 0)
+
+def path_stop():
+    return write_register(TARGET_PATH_SCAN, PATH_ADDR_CONTROL, path_control(enable=False)) \
+         + write_register(TARGET_PATH_SCAN, PATH_ADDR_COMMIT, 0)
+
+############################################################
+# Raster scan region and subsampling (see ScanRegisters in open_sem/scanning.py)
+
+SCAN_ADDR_X_BEGIN    = 0
+SCAN_ADDR_Y_BEGIN    = 1
+SCAN_ADDR_X_GRAD     = 2
+SCAN_ADDR_Y_GRAD     = 3
+SCAN_ADDR_X_STEPS    = 4
+SCAN_ADDR_Y_STEPS    = 5
+SCAN_ADDR_ROI_X      = 6
+SCAN_ADDR_ROI_Y      = 7
+SCAN_ADDR_ROI_WIDTH  = 8
+SCAN_ADDR_ROI_HEIGHT = 9
+SCAN_ADDR_SUBSAMPLE  = 10
+SCAN_ADDR_HOLD       = 11
+SCAN_ADDR_COMMIT     = 12
+SCAN_ADDR_DWELL      = 13
+
+def scan_subsample(stride=0, bin=0):
+    assert 0 <= stride < 8 and 0 <= bin < 8
+    return stride | (bin << 4)
+
+# Status register: bit 0 commit pending, bit 1 overrun. Writes sent whilst a
+# commit is pending are dropped and set overrun (cleared by reading the
+# status), so wait for pending to clear before writing after a commit.
+def read_scan_status():
+    return read_register(TARGET_PIXEL_SCAN, SCAN_ADDR_COMMIT)
+
+# Scan a region of interest of the full area, in steps from its top-left
+# (width, height of 0 for the rest of the area; the scan clamps regions past
+# its end). The beam moves 2^stride steps between pixels and rows, and one
+# sample is sent per 2^bin pixels along a row. Takes effect from the next frame.
+def scan_region(roi_x=0, roi_y=0, width=0, height=0, stride=0, bin=0):
+    assert 0 <= roi_x < 4096 and 0 <= roi_y < 4096
+    assert 0 <= width <= 4096 and 0 <= height <= 4096
+    registers = [
+        (SCAN_ADDR_ROI_X, roi_x),
+        (SCAN_ADDR_ROI_Y, roi_y),
+        (SCAN_ADDR_ROI_WIDTH, width),
+        (SCAN_ADDR_ROI_HEIGHT, height),
+        (SCAN_ADDR_SUBSAMPLE, scan_subsample(stride, bin)),
+    ]
+    return b"".join(write_register(TARGET_PIXEL_SCAN, a, v) for a, v in registers) \
+         + write_register(TARGET_PIXEL_SCAN, SCAN_ADDR_COMMIT, 0)
+
+# Full area and beam parameters (see PixelScan)
+def scan_area(x_steps=4095, y_steps=4095, x_begin=0, y_begin=0, x_grad=0, y_grad=0):
+    registers = [
+        (SCAN_ADDR_X_STEPS, x_steps),
+        (SCAN_ADDR_Y_STEPS, y_steps),
+        (SCAN_ADDR_X_BEGIN, x_begin),
+        (SCAN_ADDR_Y_BEGIN, y_begin),
+        (SCAN_ADDR_X_GRAD, x_grad),
+        (SCAN_ADDR_Y_GRAD, y_grad),
+    ]
+    return b"".join(write_register(TARGET_PIXEL_SCAN, a, v) for a, v in registers) \
+         + write_register(TARGET_PIXEL_SCAN, SCAN_ADDR_COMMIT, 0)
+
+# Pixel clocks spent on each pixel: pixel rate = pixel clock / dwell
+def scan_dwell(dwell=1):
+    assert 1 <= dwell < 1 << 16
+    return write_register(TARGET_PIXEL_SCAN, SCAN_ADDR_DWELL, dwell) \
+         + write_register(TARGET_PIXEL_SCAN, SCAN_ADDR_COMMIT, 0)
+
+# Hold raster scanning at the end of the current frame (or resume it)
+def scan_hold(hold=True):
+    return write_register(TARGET_PIXEL_SCAN, SCAN_ADDR_HOLD, int(hold)) \
+         + write_register(TARGET_PIXEL_SCAN, SCAN_ADDR_COMMIT, 0)
+
+############################################################
+# On-FPGA averaging (see Accumulator in open_sem/accumulator.py). Results are
+# sums of the samples averaged, kept to 24 bits. Each ADC conversion counts
+# once, so the count varies with the pixel clock against the sample rate:
+# stream mode STREAM_MODE_SUMS sends each sum with its count (12 bits,
+# saturating), which StreamDecoder passes to on_counts, to divide by. Sums
+# saturate at narrower stream modes (see stream_mode). Line mode tags lines
+# as line >> k_log2.
+#
+# A mode written whilst the last is still waiting for a frame end (status
+# bit 0) is dropped, setting overrun (status bit 1, cleared by reading it).
+
+ACC_MODE_OFF   = 0
+ACC_MODE_PIXEL = 1
+ACC_MODE_LINE  = 2
+ACC_MODE_FRAME = 3
+
+ACC_ADDR_CONTROL = 0
+ACC_ADDR_STATUS  = 1
+
+# Taken up at the next frame end
+def accumulate(mode=ACC_MODE_OFF, k_log2=0):
+    return write_register(TARGET_ACCUMULATOR, ACC_ADDR_CONTROL, mode | (k_log2 << 2))
+
+def read_accumulate_status():
+    return read_register(TARGET_ACCUMULATOR, ACC_ADDR_STATUS)
+
+############################################################
+# Sample source routing (see SampleMux in open_sem/samplemux.py, and the
+# routes of Top in open_sem/top.py)
+
+SAMPLE_ROUTE_XADC           = 0 # raw secondary electron sample, 12 bits
+SAMPLE_ROUTE_SUM            = 1 # backscatter quadrant sum, 14 bits
+SAMPLE_ROUTE_X_DIFF         = 2 # backscatter x difference, offset by 2^13
+SAMPLE_ROUTE_Y_DIFF         = 3 # backscatter y difference, offset by 2^13
+SAMPLE_ROUTE_CROSS          = 4 # backscatter cross term, offset by 2^13
+SAMPLE_ROUTE_XY             = 5 # x_diff[13:6] in bits 7:0, y_diff[13:6] in bits 15:8
+SAMPLE_ROUTE_X_CONTRAST     = 6 # 2048 * (1 + x difference / sum), 12 bits
+SAMPLE_ROUTE_Y_CONTRAST     = 7 # 2048 * (1 + y difference / sum), 12 bits
+SAMPLE_ROUTE_CROSS_CONTRAST = 8 # 2048 * (1 + cross / sum), 12 bits
+
+SAMPLE_MUX_ADDR_ROUTE  = 0
+SAMPLE_MUX_ADDR_ROUTES = 1
+
+def sample_route(route):
+    return write_register(TARGET_SAMPLE_MUX, SAMPLE_MUX_ADDR_ROUTE, route)
+
+def read_sample_routes():
+    return read_register(TARGET_SAMPLE_MUX, SAMPLE_MUX_ADDR_ROUTES)
+
+############################################################
+# Sample width on the uplink (see SamplePacker in open_sem/samplemux.py, and
+# STREAM_MODES of Top in open_sem/top.py). Samples saturate at the width and
+# are packed LSB first across words. A new mode is taken up between packets,
+# which give it in their header, so StreamDecoder follows a change of mode
+# mid-stream. Packets close at the end of each frame, so a change made whilst
+# the scan holds (see scan_hold) starts with the next frame.
+
+STREAM_MODE_WORDS  = 0 # 16 bit words
+STREAM_MODE_PACK12 = 1 # 12 bits, the XADC
+STREAM_MODE_PACK14 = 2 # 14 bits, backscatter routes
+STREAM_MODE_PACK24 = 3 # 24 bits, accumulated sums
+STREAM_MODE_SUMS   = 4 # 24 bit accumulated sums, each with its 12 bit count
+
+STREAM_ADDR_MODE = 0
+
+def stream_mode(mode):
+    assert 0 <= mode < len(STREAM_MODES)
+    return write_register(TARGET_SAMPLE_PACKER, STREAM_ADDR_MODE, mode)
+
+def read_stream_mode():
+    return read_register(TARGET_SAMPLE_PACKER, STREAM_ADDR_MODE)
@@ -0,0 +1,368 @@
+import math
+import numpy as np
+
+from .protocol import *
+
+# Fixed set of preallocated frame buffers which are reused in turn, so that
+# decoding never allocates once running. With counts, each frame has a buffer
+# of sample counts too.
+class FrameRing:
+    def __init__(self, frames, height, width, dtype=np.uint16, counts=False):
+        self.buffers = np.zeros((frames, height, width), dtype=dtype)
+        self.counts = np.zeros((frames, height, width), dtype=np.uint16) if counts else None
+        self.frame_numbers = np.full(frames, -1, dtype=np.int64)
+        self.next_slot = 0
+
+    def acquire(self, frame_number):
+        slot = self.next_slot
+        self.next_slot = (self.next_slot + 1) % len(self.buffers)
+        self.frame_numbers[slot] = frame_number
+        self.buffers[slot].fill(0)
+        if self.counts is not None:
+            self.counts[slot].fill(0)
+        return slot
+
+    def __getitem__(self, slot):
+        return self.buffers[slot]
+
+# Split raw FT60X fifo words (data in the low bits, byte-enable validity bits above)
+# into data words, dropping any word that was not fully valid.
+def split_fifo_words(fifo_words, data_bytes=2):
+    fifo_words = np.asarray(fifo_words)
+    data_bits = 8 * data_bytes
+    be = (fifo_words >> data_bits) & ((1 << data_bytes) - 1)
+    data = fifo_words & ((1 << data_bits) - 1)
+    return data[be == (1 << data_bytes) - 1].astype(WORD_DTYPE)
+
+# Unpack words from BitPacker (see open_sem/samplemux.py) into a (beats, channels)
+# array. Channels are packed LSB first, contiguously across words; trailing
+# bits of a last partial beat are dropped. Flush padding can hold whole beats
+# of zeros, so pass the count of beats if known.
+#
+# Leading dimensions are kept, so (packets, words) unpacks to (packets, beats,
+# channels), each packet on its own.
+def unpack_bits(words, channel_bits, word_bits=16, beats=None):
+    words = np.asarray(words, dtype=np.uint64)
+    lead, n_words = words.shape[:-1], words.shape[-1]
+    beat_bits = sum(channel_bits)
+    starts = np.cumsum([0] + list(channel_bits[:-1]))
+
+    # Whole packing periods which fit a uint64 are joined and shifted apart
+    period = math.lcm(beat_bits, word_bits)
+    period_words = period // word_bits
+    if period <= 64 and n_words % period_words == 0:
+        periods = words.reshape(lead + (n_words // period_words, period_words))
+        periods = (periods << (np.arange(period_words, dtype=np.uint64) * np.uint64(word_bits))).sum(axis=-1, dtype=np.uint64)
+        offsets = (np.arange(period // beat_bits)[:, None] * beat_bits + starts[None, :]).astype(np.uint64)
+        masks = (np.uint64(1) << np.asarray(channel_bits, dtype=np.uint64)) - np.uint64(1)
+        out = (periods[..., None, None] >> offsets) & masks
+        out = out.reshape(lead + (-1, len(channel_bits)))
+    else:
+        bits = (words[..., None] >> np.arange(word_bits, dtype=np.uint64)) & np.uint64(1)
+        bits = bits.reshape(lead + (-1,))
+        n_beats = bits.shape[-1] // beat_bits
+        rows = bits[..., :n_beats * beat_bits].reshape(lead + (n_beats, beat_bits))
+        out = np.empty(lead + (n_beats, len(channel_bits)), dtype=np.uint64)
+        for i, (start, n) in enumerate(zip(starts, channel_bits)):
+            out[..., i] = rows[..., start:start + n] @ (np.uint64(1) << np.arange(n, dtype=np.uint64))
+    return out if beats is None else out[..., :beats, :]
+
+# Turns raw uplink bytes into frames. Bytes can be pushed in with feed() (e.g. from
+# a USB read callback), or pulled from a file or pipe with read_from().
+#
+# Each sample packet gives the stream mode its samples are packed in as its
+# format (see commands.stream_mode), and the count of samples it holds: they
+# are unpacked at the widths stream_modes gives for the format, so a change of
+# mode mid-stream is followed packet by packet. Modes which send each sample
+# (an accumulated sum) with its count of samples fill a frame of counts too,
+# passed to on_counts before the frame goes to on_frame, to divide by.
+#
+# Packets are located by SYNC word, then whole runs of same-sized packets are
+# viewed as a (packets, packet_words) array so that header checks, CRC and the
+# scatter of payload into frames are all vectorized across packets.
+class StreamDecoder:
+    def __init__(self, width, height, payload_words=SAMPLES_PAYLOAD_WORDS, stream_id=STREAM_SAMPLES,
+            ring_frames=4, on_frame=None, on_packet=None, verify_crc=True, buffer_bytes=1 << 23,
+            stream_modes=STREAM_MODES, on_counts=None):
+        channels = [ stream_channels(mode) for mode in stream_modes ]
+        assert all(payload_words * 16 % sum(c) == 0 for c in channels), "packets must hold whole samples"
+        self.width = width
+        self.height = height
+        self.payload_words = payload_words
+        self.stream_channels = channels
+        self.stream_id = stream_id
+        self.verify_crc = verify_crc
+
+        # on_frame(frame_number, frame_array) is called once a frame is complete,
+        # after on_counts(frame_number, counts_array) if it was sent with counts.
+        # on_packet(stream_id, header, payload) receives packets of other streams.
+        self.on_frame = on_frame
+        self.on_counts = on_counts
+        self.on_packet = on_packet
+
+        sample_bits = max(c[0] for c in channels)
+        self.ring = FrameRing(ring_frames, height, width, np.uint16 if sample_bits <= 16 else np.uint32,
+            counts=any(len(c) > 1 for c in channels))
+        self.current_frame = None
+        self.current_slot = None
+        self.current_counted = False
+
+        # Staging buffer holds bytes not yet decoded (at most one partial packet between calls)
+        self.buffer = np.zeros(buffer_bytes, dtype=np.uint8)
+        self.fill = 0
+
+        self.payload_offsets = np.arange(payload_words * 16 // min(sum(c) for c in channels))
+
+        # Statistics
+        self.packets = 0
+        self.frames = 0
+        self.crc_errors = 0
+        self.dropped_packets = 0
+        self.resync_bytes = 0
+        self.last_seq = {}
+
+    ############################################################
+    # Input
+
+    def feed(self, data):
+        data = np.frombuffer(data, dtype=np.uint8)
+        while len(data):
+            n = min(len(data), len(self.buffer) - self.fill)
+            self.buffer[self.fill:self.fill+n] = data[:n]
+            self.fill += n
+            data = data[n:]
+            self._decode()
+
+    def read_from(self, stream, chunk_bytes=1 << 22):
+        # Read straight into the staging buffer to avoid an extra copy
+        chunk_bytes = min(chunk_bytes, len(self.buffer) // 2)
+        view = memoryview(self.buffer)
+        while True:
+            space = min(chunk_bytes, len(self.buffer) - self.fill)
+            n = stream.readinto(view[self.fill:self.fill+space])
+            if not n:
+                break
+            self.fill += n
+            self._decode()
+
+    def read_file(self, path, chunk_bytes=1 << 22):
+        with open(path, "rb", buffering=0) as f:
+            self.read_from(f, chunk_bytes)
+
+    # Emit the frame being assembled, even if incomplete
+    def flush(self):
+        self._finish_frame()
+
+    ############################################################
+    # Decode
+
+    def _decode(self):
+        # Byte offset of the decode position. Resyncing may move it to an odd byte.
+        start = 0
+        words = self._words(start)
+        pos = 0
+
+        while len(words) - pos >= PACKET_HEADER_WORDS:
+            if words[pos] != PACKET_SYNC:
+                # Search bytes rather than words in case the stream has slipped by a byte
+                b = self.buffer[start + 2*pos:self.fill]
+                candidates = np.flatnonzero((b[:-1] == PACKET_SYNC & 0xff) & (b[1:] == PACKET_SYNC >> 8))
+                skip = int(candidates[0]) if len(candidates) else len(b) - 1
+                self.resync_bytes += skip
+                start += 2*pos + skip
+                words = self._words(start)
+                pos = 0
+                continue
+
+            stream_id, format, payload_words = stream_fields(int(words[pos + HDR_STREAM]))
+            plen = packet_words(payload_words)
+            k = (len(words) - pos) // plen
+            if k == 0:
+                break
+
+            # View the run of packets that follows as a 2D array and find where
+            # it ends (or changes format)
+            packets = words[pos:pos + k*plen].reshape(k, plen)
+            ok = (packets[:, HDR_SYNC] == PACKET_SYNC) & (packets[:, HDR_STREAM] == words[pos + HDR_STREAM])
+            run = k if ok.all() else int(np.argmin(ok))
+            packets = packets[:run]
+
+            if self.verify_crc:
+                good = crc16_rows(packets[:, :-1]) == packets[:, -1]
+                if not good.all():
+                    if not good[0]:
+                        # Not a real packet, or corrupt. Skip the SYNC and resync.
+                        self.crc_errors += 1
+                        pos += 1
+                        continue
+                    run = int(np.argmin(good))
+                    packets = packets[:run]
+
+            self._check_sequence(stream_id, packets[:, HDR_SEQ])
+            if stream_id == self.stream_id and payload_words == self.payload_words \
+                    and format < len(self.stream_channels):
+                self._assemble(packets, self.stream_channels[format])
+            elif self.on_packet:
+                for p in packets:
+                    self.on_packet(stream_id, p[:PACKET_HEADER_WORDS], p[PACKET_HEADER_WORDS:-PACKET_TRAILER_WORDS])
+
+            self.packets += run
+            pos += run * plen
+
+        # Keep the undecoded tail for next time
+        consumed = start + 2*pos
+        remaining = self.fill - consumed
+        self.buffer[:remaining] = self.buffer[consumed:self.fill]
+        self.fill = remaining
+
+    def _words(self, start):
+        n_words = (self.fill - start) // WORD_DTYPE.itemsize
+        return self.buffer[start:start + n_words * WORD_DTYPE.itemsize].view(WORD_DTYPE)
+
+    def _check_sequence(self, stream_id, seq):
+        seq = seq.astype(np.int64)
+        last = self.last_seq.get(stream_id)
+        if last is not None:
+            seq_all = np.concatenate(([last], seq))
+        else:
+            seq_all = seq
+        gaps = (np.diff(seq_all) - 1) & 0xffff
+        self.dropped_packets += int(gaps.sum())
+        self.last_seq[stream_id] = int(seq[-1])
+
+    def _assemble(self, packets, channels):
+        frame_numbers = packets[:, HDR_FRAME]
+
+        # Split into runs belonging to the same frame
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(frame_numbers)) + 1, [len(packets)]))
+        for a, b in zip(starts[:-1], starts[1:]):
+            frame_number = int(frame_numbers[a])
+            if frame_number != self.current_frame:
+                self._finish_frame()
+                self.current_frame = frame_number
+                self.current_slot = self.ring.acquire(frame_number)
+            targets = [ self.ring[self.current_slot] ]
+            if len(channels) > 1:
+                targets.append(self.ring.counts[self.current_slot])
+                self.current_counted = True
+            self._scatter(packets[a:b], targets, channels)
+
+    # Scatter the channels of the payload into targets (frames), one each
+    def _scatter(self, packets, targets, channels):
+        lines = packets[:, HDR_LINE].astype(np.int64)
+        columns = packets[:, HDR_COLUMN].astype(np.int64)
+        payload = packets[:, PACKET_HEADER_WORDS:-PACKET_TRAILER_WORDS]
+
+        counts = packets[:, HDR_COUNT].astype(np.int64)
+        if channels == [ 16 ]:
+            beats = payload[..., None]
+        else:
+            beats = unpack_bits(payload, channels)
+        n = self.payload_words * 16 // sum(channels)
+        offsets = self.payload_offsets[:n]
+
+        start = lines * self.width + columns
+        pixels = self.width * self.height
+
+        # Common case: full packets covering consecutive pixels, but for the
+        # partial last packet of a frame
+        whole = len(packets) - int(counts[-1] != n)
+        if whole and (counts[:whole] == n).all() and (np.diff(start[:whole + 1]) == n).all() \
+                and start[whole - 1] + n <= pixels:
+            for c, target in enumerate(targets):
+                target.reshape(-1)[start[0]:start[whole - 1] + n] = beats[:whole, :, c].reshape(-1)
+        else:
+            whole = 0
+        if whole < len(packets):
+            index = start[whole:, None] + offsets[None, :]
+            valid = (offsets[None, :] < counts[whole:, None]) & (index < pixels)
+            for c, target in enumerate(targets):
+                target.reshape(-1)[index[valid]] = beats[whole:, :, c][valid]
+
+    def _finish_frame(self):
+        if self.current_frame is None:
+            return
+        self.frames += 1
+        if self.on_counts and self.current_counted:
+            self.on_counts(self.current_frame, self.ring.counts[self.current_slot])
+        if self.on_frame:
+            self.on_frame(self.current_frame, self.ring[self.current_slot])
+        self.current_frame = None
+        self.current_slot = None
+        self.current_counted = False
+
+    def stats(self):
+        return {
+            "packets" : self.packets,
+            "frames" : self.frames,
+            "crc_errors" : self.crc_errors,
+            "dropped_packets" : self.dropped_packets,
+            "resync_bytes" : self.resync_bytes,
+        }
+
+# Decodes sample packets as the FPGA sends them, 252 words each: frames in
+# each of the 16, 12 and 14 bit modes and one with counts, each frame ending
+# in a partial packet. The stream starts with an odd number of bytes of noise,
+# is fed in odd sized chunks, has one packet corrupted and one dropped, whose
+# pixels must stay zero.
+def check_decoder():
+    width, height = 50, 21
+    pixels = width * height
+    rng = np.random.default_rng(1)
+
+    # BitPacker's packing: channels LSB first, contiguously across words
+    def pack(beats, channel_bits, payload_words):
+        value, bits = 0, 0
+        for beat in beats:
+            for sample, n in zip(beat, channel_bits):
+                value |= int(sample) << bits
+                bits += n
+        return [ (value >> (16 * i)) & 0xffff for i in range(payload_words) ]
+
+    formats = [ 0, 0, 1, 1, 2, 2, 4 ]
+    frames, counts, packets = [], [], []
+    seq = 0
+    for number, format in enumerate(formats):
+        channels = stream_channels(STREAM_MODES[format])
+        # The 16 bit mode carries 12 bit samples, so no byte pair of its payload is SYNC
+        bits = 12 if channels == [ 16 ] else channels[0]
+        frame = rng.integers(0, 1 << bits, size=pixels)
+        count = rng.integers(1, 1 << channels[1], size=pixels) if len(channels) > 1 else None
+        frames.append(frame)
+        counts.append(count)
+        n = SAMPLES_PAYLOAD_WORDS * 16 // sum(channels)
+        for start in range(0, pixels, n):
+            samples = min(n, pixels - start)
+            beats = zip(frame[start:start + samples], count[start:start + samples]) if count is not None \
+                else ([ s ] for s in frame[start:start + samples])
+            words = [ PACKET_SYNC, stream_word(STREAM_SAMPLES, SAMPLES_PAYLOAD_WORDS, format), seq & 0xffff,
+                      number, start // width, start % width, samples ] + pack(beats, channels, SAMPLES_PAYLOAD_WORDS)
+            words.append(int(crc16_rows(np.array([ words ], dtype=WORD_DTYPE))[0]))
+            packets.append((number, start, samples, np.array(words, dtype=WORD_DTYPE)))
+            seq += 1
+
+    # Corrupt a packet of frame 1, drop one of frame 3: both are lost
+    corrupt, drop = 7, 16
+    assert packets[corrupt][0] == 1 and packets[drop][0] == 3
+    packets[corrupt][3][PACKET_HEADER_WORDS + 3] ^= 0x0100
+    for number, start, samples, _ in [ packets[corrupt], packets[drop] ]:
+        frames[number][start:start + samples] = 0
+    stream = b"\x00\x01\x02" + b"".join(p[3].tobytes() for i, p in enumerate(packets) if i != drop)
+
+    received, received_counts = {}, {}
+    decoder = StreamDecoder(width, height, ring_frames=len(formats),
+        on_frame=lambda number, frame: received.setdefault(number, frame.reshape(-1).copy()),
+        on_counts=lambda number, frame: received_counts.setdefault(number, frame.reshape(-1).copy()))
+    for offset in range(0, len(stream), 1001):
+        decoder.feed(stream[offset:offset + 1001])
+    decoder.flush()
+
+    assert sorted(received) == list(range(len(formats))), sorted(received)
+    for number, frame in enumerate(frames):
+        assert np.array_equal(received[number], frame), (number, np.flatnonzero(received[number] != frame)[:8])
+    assert sorted(received_counts) == [ formats.index(4) ], sorted(received_counts)
+    assert np.array_equal(received_counts[formats.index(4)], counts[formats.index(4)])
+    stats = decoder.stats()
+    assert stats == { "packets": len(packets) - 2, "frames": len(formats), "crc_errors": 1,
+                      "dropped_packets": 2, "resync_bytes": 3 + 2 * packet_words(SAMPLES_PAYLOAD_WORDS) - 2 }, stats
+    print("decoder: 16, 12, 14 bit and counted sample packets decoded, losses accounted for")
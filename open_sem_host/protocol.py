@@ -0,0 +1,81 @@
+import numpy as np
+
+# Uplink packet format. Must match open_sem/packetizer.py
+#
+#   word 0          : SYNC (0xA55A)
+#   word 1          : stream_id[15:12], format[11:9], payload_words[8:0]
+#   word 2          : sequence counter (per stream, wraps)
+#   word 3          : frame number of first payload word
+#   word 4          : line number of first payload word
+#   word 5          : column of first payload word
+#   word 6          : count of valid payload words (remainder is zero padding),
+#                     or for sample packets, of the samples packed into them
+#   word 7..7+N-1   : payload
+#   word 7+N        : CRC-16/CCITT (poly 0x1021, init 0xffff) of words 0..7+N-1
+PACKET_SYNC = 0xA55A
+PACKET_HEADER_WORDS = 7
+PACKET_TRAILER_WORDS = 1
+CRC_POLY = 0x1021
+CRC_INIT = 0xffff
+
+HDR_SYNC   = 0
+HDR_STREAM = 1
+HDR_SEQ    = 2
+HDR_FRAME  = 3
+HDR_LINE   = 4
+HDR_COLUMN = 5
+HDR_COUNT  = 6
+
+STREAM_SAMPLES = 0
+STREAM_REGISTERS = 1
+STREAM_TELEMETRY = 2
+
+# Sample width of each stream mode, or (sample width, count width) for modes
+# sending each sample with its count, which sample packets give as their
+# format (see commands.stream_mode). Must match STREAM_MODES in open_sem/top.py
+STREAM_MODES = [ 16, 12, 14, 24, (24, 12) ]
+
+def stream_channels(mode):
+    return list(mode) if isinstance(mode, (list, tuple)) else [ mode ]
+
+# Payload of sample packets: whole packing periods of every stream mode (see
+# commands.stream_mode). Must match stream_payload_words(STREAM_MODES) in open_sem/top.py
+SAMPLES_PAYLOAD_WORDS = 252
+
+# FT600 words arrive little endian over USB
+WORD_DTYPE = np.dtype("<u2")
+
+def packet_words(payload_words):
+    return PACKET_HEADER_WORDS + payload_words + PACKET_TRAILER_WORDS
+
+def stream_word(stream_id, payload_words, format=0):
+    return (stream_id << 12) | (format << 9) | payload_words
+
+# stream_id, format, payload_words of a stream word
+def stream_fields(word):
+    return word >> 12, (word >> 9) & 0x7, word & 0x1ff
+
+def crc16_word(crc, word):
+    for i in reversed(range(16)):
+        bit = ((word >> i) & 1) ^ ((crc >> 15) & 1)
+        crc = ((crc << 1) & 0xffff) ^ (CRC_POLY if bit else 0)
+    return crc
+
+def _make_crc_table():
+    # For a 16 bit register fed 16 bits at a time, crc16_word(crc, w) == crc16_word(0, crc ^ w),
+    # so a single 64K entry table advances the crc by a whole word.
+    table = np.zeros(1 << 16, dtype=np.uint16)
+    bits = [crc16_word(0, 1 << i) for i in range(16)]
+    for i, b in enumerate(bits):
+        # Linear in the input, so build the table up from single bit entries
+        table[1 << i : 2 << i] = table[0 : 1 << i] ^ b
+    return table
+
+CRC_TABLE = _make_crc_table()
+
+# CRC of each row of a (packets, words) array, vectorized across packets
+def crc16_rows(words):
+    crc = np.full(words.shape[0], CRC_INIT, dtype=np.uint16)
+    for j in range(words.shape[1]):
+        crc = CRC_TABLE[crc ^ words[:, j]]
+    return crc
@@ -0,0 +1,99 @@
+from .protocol import STREAM_TELEMETRY
+
+# Status packets on STREAM_TELEMETRY. Must match open_sem/telemetry.py
+#
+#   word 0-1   : sync cycles, when the status was taken
+#   word 2-3   : words pushed to the ft60x
+#   word 4-5   : words pulled from the ft60x
+#   word 6-7   : ftdi cycles waiting on txe with uplink data to push
+#   word 8-9   : sync cycles the uplink waited on a full fifo_to_f60x
+#   word 10-11 : XADC samples dropped, sample_cdc being full
+#   word 12-13 : pixel samples dropped, pixel_cdc being full
+#   word 14    : fifo_to_f60x high-water mark, since the last status
+#   word 15    : fifo_from_f60x high-water mark, since the last status
+#
+# Counters are 32 bit, low word first, and wrap.
+TELEMETRY_COUNTERS = [ "cycles", "pushed", "pulled", "txe_stall", "uplink_stall", "sample_drops", "pixel_drops" ]
+TELEMETRY_LEVELS = [ "uplink_level_max", "downlink_level_max" ]
+TELEMETRY_PAYLOAD_WORDS = 2*len(TELEMETRY_COUNTERS) + len(TELEMETRY_LEVELS)
+
+SYNC_FREQUENCY = 100e6
+FTDI_FREQUENCY = 100e6
+
+def parse_telemetry(payload):
+    payload = [ int(w) for w in payload ]
+    fields = {}
+    for i, name in enumerate(TELEMETRY_COUNTERS):
+        fields[name] = payload[2*i] | (payload[2*i + 1] << 16)
+    for i, name in enumerate(TELEMETRY_LEVELS):
+        fields[name] = payload[2*len(TELEMETRY_COUNTERS) + i]
+    return fields
+
+# Link statistics from successive status packets. Pass on_packet to
+# StreamDecoder as its on_packet, or update() with each status payload.
+#
+#   seconds            : time since the previous status
+#   uplink_words_per_s : words pushed to the ft60x per second (and MB/s)
+#   txe_stall          : fraction of ftdi cycles waiting on txe
+#   uplink_stall       : fraction of sync cycles the uplink fifo was full
+#   sample_drops, pixel_drops : samples dropped since the previous status
+class LinkMonitor:
+    def __init__(self, sync_frequency=SYNC_FREQUENCY, ftdi_frequency=FTDI_FREQUENCY, word_bytes=2, on_status=None):
+        self.sync_frequency = sync_frequency
+        self.ftdi_frequency = ftdi_frequency
+        self.word_bytes = word_bytes
+
+        # on_status(status) is called with each status after the first
+        self.on_status = on_status
+
+        self.last = None
+        self.status = None
+        self.statuses = 0
+        self.sample_drops = 0
+        self.pixel_drops = 0
+        self.uplink_level_max = 0
+        self.downlink_level_max = 0
+
+    def on_packet(self, stream_id, header, payload):
+        if stream_id == STREAM_TELEMETRY and len(payload) == TELEMETRY_PAYLOAD_WORDS:
+            self.update(payload)
+
+    def update(self, payload):
+        fields = parse_telemetry(payload)
+        self.statuses += 1
+        self.uplink_level_max = max(self.uplink_level_max, fields["uplink_level_max"])
+        self.downlink_level_max = max(self.downlink_level_max, fields["downlink_level_max"])
+        last, self.last = self.last, fields
+        if last is None:
+            return None
+
+        delta = { name: (fields[name] - last[name]) & 0xffffffff for name in TELEMETRY_COUNTERS }
+        if delta["cycles"] == 0:
+            return None
+        seconds = delta["cycles"] / self.sync_frequency
+        self.sample_drops += delta["sample_drops"]
+        self.pixel_drops += delta["pixel_drops"]
+        self.status = {
+            "seconds" : seconds,
+            "uplink_words_per_s" : delta["pushed"] / seconds,
+            "uplink_mbps" : delta["pushed"] * self.word_bytes / seconds / 1e6,
+            "downlink_words_per_s" : delta["pulled"] / seconds,
+            "txe_stall" : delta["txe_stall"] / (seconds * self.ftdi_frequency),
+            "uplink_stall" : delta["uplink_stall"] / delta["cycles"],
+            "sample_drops" : delta["sample_drops"],
+            "pixel_drops" : delta["pixel_drops"],
+            "uplink_level_max" : fields["uplink_level_max"],
+            "downlink_level_max" : fields["downlink_level_max"],
+        }
+        if self.on_status:
+            self.on_status(self.status)
+        return self.status
+
+    def stats(self):
+        return {
+            "statuses" : self.statuses,
+            "sample_drops" : self.sample_drops,
+            "pixel_drops" : self.pixel_drops,
+            "uplink_level_max" : self.uplink_level_max,
+            "downlink_level_max" : self.downlink_level_max,
+        }